@@ -1 +1 @@
-from .winter import Terminal, Input, ProgramState, Program, centerString
\ No newline at end of file
+from .winter import Terminal, Input, KeyDecoder, Backend, WindowsConsole, PosixConsole, VirtualTerminal, StreamConsole, Writer, Session, SessionServer, ProgramState, TextEvent, PasteEvent, Job, Timer, Program, Profiler, Recorder, Recording, Widget, Box, Label, ListView, VirtualList, LogView, Field, GapBuffer, TextInput, Form, WidgetState, Canvas, FrameBuffer, Screen, Layer, Output, measureString, layoutString, centerString, leftString, rightString, justifyString
\ No newline at end of file
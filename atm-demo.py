@@ -12,78 +12,251 @@ CONTROLS:
 
 from winter import *
 from math import ceil
+from array import array
+from time import monotonic
+import json, os, struct
+
+class Ledger:
+    # accounts are stored in columns indexed by name, every change is appended to a journal that is
+    # fsynced in groups and folded into a snapshot once it grows, startup loads the snapshot and replays the journal
+    magic = b"WLDG"
+    header = struct.Struct("<4sBQQ")
+    commitInterval = 0.05
+    compactAfter = 10000
+
+    def __init__(self):
+        self.journal = None
+        # schedule(delay, callback): runs the group commit later, without it changes wait for the next one
+        self.schedule = None
+        self.Reset()
+    def Reset(self):
+        self.names = []
+        self.pins = array("q")
+        self.balances = array("d")
+        self.index = {}
+        self.removed = 0
+        self.order = None
+
+    def __len__(self):
+        return len(self.index)
+    def __contains__(self, account):
+        return self.index.get(account.name) == account.row
+    def Exists(self, name):
+        return name in self.index
+    def Find(self, name):
+        row = self.index.get(name)
+        if row is not None:
+            return Account(name, row)
+    def Slice(self, start, stop):
+        if not self.removed:
+            return [Account(self.names[row], row) for row in range(start, min(stop, len(self.names)))]
+        if self.order is None:
+            self.order = [row for (row, name) in enumerate(self.names) if name is not None]
+        return [Account(self.names[row], row) for row in self.order[start:stop]]
+    def Names(self, start, stop):
+        # Slice without the Account objects
+        if not self.removed:
+            return self.names[start:stop]
+        if self.order is None:
+            self.order = [row for (row, name) in enumerate(self.names) if name is not None]
+        return [self.names[row] for row in self.order[start:stop]]
+
+    # records are lists: ["R", name, pin] registers, ["B", name, balance, ...] sets balances, ["X", name] removes, ["C"] clears
+    def Apply(self, record):
+        kind = record[0]
+        if kind == "B":
+            for i in range(1, len(record), 2):
+                self.balances[self.index[record[i]]] = record[i + 1]
+        elif kind == "R":
+            if record[1] in self.index:
+                self.Apply(["X", record[1]])
+            self.index[record[1]] = len(self.names)
+            if self.order is not None:
+                self.order.append(len(self.names))
+            self.names.append(record[1])
+            self.pins.append(record[2])
+            self.balances.append(0)
+        elif kind == "X":
+            row = self.index.pop(record[1], None)
+            if row is not None:
+                self.names[row] = None
+                self.removed += 1
+                self.order = None
+        elif kind == "C":
+            self.Reset()
+    def Change(self, record):
+        self.Apply(record)
+        if self.journal:
+            self.pending.append(json.dumps(record) + "\n")
+            self.records += 1
+            if monotonic() - self.committed >= self.commitInterval:
+                self.Commit()
+            elif len(self.pending) == 1 and self.schedule:
+                # one timer per group, an idle ledger doesn't wake anything up
+                self.schedule(self.commitInterval - (monotonic() - self.committed), self.Commit)
+
+    def Register(self, name, pin):
+        self.Change(["R", name, pin])
+        return Account(name, self.index[name])
+    def Remove(self, account):
+        self.Change(["X", account.name])
+    def Update(self, *changes):
+        # (account, balance) pairs are journaled as one record, so a transfer is never half applied
+        record = ["B"]
+        for (account, balance) in changes:
+            record += [account.name, balance]
+        self.Change(record)
+    def Clear(self):
+        self.Change(["C"])
+
+    def Open(self, path):
+        self.Reset()
+        self.path = path
+        if os.path.exists(path + ".snapshot"):
+            with open(path + ".snapshot", "rb") as f:
+                (magic, version, count, size) = self.header.unpack(f.read(self.header.size))
+                if magic != self.magic or version != 1:
+                    raise ValueError(f"{path}.snapshot is not a ledger snapshot")
+                self.names = f.read(size).decode().split("\0") if count else []
+                self.pins.fromfile(f, count)
+                self.balances.fromfile(f, count)
+            self.index = dict(zip(self.names, range(count)))
+        (good, self.records) = (0, 0)
+        if os.path.exists(path + ".journal"):
+            with open(path + ".journal", "rb") as f:
+                for line in f:
+                    # a torn record at the end was never committed, it is cut off before appending
+                    try:
+                        self.Apply(json.loads(line))
+                    except ValueError:
+                        break
+                    good += len(line)
+                    self.records += 1
+        self.journal = open(path + ".journal", "ab")
+        self.journal.truncate(good)
+        self.pending = []
+        self.committed = monotonic()
+        return self
+    def Commit(self):
+        # group commit: everything changed since the last commit is written and fsynced at once
+        if not self.journal:
+            return
+        self.Sync()
+        if self.records >= self.compactAfter:
+            self.Compact()
+    def Sync(self):
+        if self.pending:
+            self.journal.write("".join(self.pending).encode())
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.pending.clear()
+        self.committed = monotonic()
+    def Compact(self):
+        # replaying the old journal over the new snapshot gives the same state, so a crash between
+        # replacing the snapshot and truncating the journal loses nothing
+        self.Sync()
+        (names, pins, balances) = (self.names, self.pins, self.balances)
+        if self.removed:
+            rows = [row for (row, name) in enumerate(names) if name is not None]
+            names = [names[row] for row in rows]
+            pins = array("q", (pins[row] for row in rows))
+            balances = array("d", (balances[row] for row in rows))
+        data = "\0".join(names).encode()
+        with open(self.path + ".snapshot.tmp", "wb") as f:
+            f.write(self.header.pack(self.magic, 1, len(names), len(data)))
+            f.write(data)
+            pins.tofile(f)
+            balances.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".snapshot.tmp", self.path + ".snapshot")
+        self.journal.truncate(0)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.records = 0
+    def Close(self):
+        if self.journal:
+            self.Sync()
+            if self.records:
+                self.Compact()
+            self.journal.close()
+            self.journal = None
 
 class Account:
-    all = []
+    # a view of one ledger row, the ledger holds the data
+    __slots__ = ("name", "row")
     @staticmethod
     def Exists(name):
-        for account in Account.all:
-            if account.name == name:
-                return True
+        return Account.all.Exists(name)
     @staticmethod
     def Find(name):
-        for account in Account.all:
-            if account.name == name:
-                return account
+        return Account.all.Find(name)
     @staticmethod
     def Register(name, pin, confirmPIN):
         if pin != confirmPIN:
             return "PIN unconfirmed"
         if Account.Exists(name):
             return "An account with this name already exists"
-        Account.all.append(Account(name, pin))
+        Account.all.Register(name, pin)
         return f"Successfully registered {Terminal.EnableStyle('bold', gen = True) + Terminal.SetColor('cyan', gen = True)}{name}{Terminal.ResetStyle(gen = True)}"
     @staticmethod
     def Remove(account, confirm):
         if account in Account.all:
             if confirm:
-                Account.all.remove(account)
+                Account.all.Remove(account)
                 return f"Successfully removed {Terminal.EnableStyle('bold', gen = True) + Terminal.SetColor('cyan', gen = True)}{account.name}{Terminal.ResetStyle(gen = True)}"
             else:
                 return "Operation cancelled"
         else:
             return "Account not registered"
     
-    def __init__(self, name, pin, balance = 0):
+    def __init__(self, name, row):
         self.name = name
-        self.pin = pin
-        self.balance = balance
+        self.row = row
+    @property
+    def pin(self):
+        return Account.all.pins[self.row]
+    @property
+    def balance(self):
+        return Account.all.balances[self.row]
     def Deposit(self, sum):
-        self.balance += sum
+        Account.all.Update((self, self.balance + sum))
         return f"Successfully deposited {Terminal.EnableStyle('bold', gen = True) + Terminal.SetColor('green', gen = True)}{sum}{Terminal.ResetStyle(gen = True)}"
     def Withdraw(self, sum):
         if self.balance >= sum:
-            self.balance -= sum
+            Account.all.Update((self, self.balance - sum))
             return f"Successfully withdrawn {Terminal.EnableStyle('bold', gen = True) + Terminal.SetColor('green', gen = True)}{sum}{Terminal.ResetStyle(gen = True)}"
         else:
             return "Withdrawn sum exceeds the balance"
     def Send(self, recipient, sum):
         if recipient == self.name:
             return "Cannot send money to self"
-        if Account.Exists(recipient):
+        other = Account.Find(recipient)
+        if other:
             if self.balance >= sum:
-                self.balance -= sum
-                Account.Find(recipient).balance += sum
+                Account.all.Update((self, self.balance - sum), (other, other.balance + sum))
                 return f"Successfully sent {Terminal.EnableStyle('bold', gen = True) + Terminal.SetColor('green', gen = True)}{sum}{Terminal.ResetStyle(gen = True)} to {Terminal.EnableStyle('bold', gen = True) + Terminal.SetColor('cyan', gen = True)}{recipient}{Terminal.ResetStyle(gen = True)}"
             else:
                 return "Sent sum exceeds the balance"
         return "Recipient not found"
 
-window = Program(40, 15, "Winter Bank ATM", killKey = "escape")
+# the demo runs from memory, __main__ opens the ledger files
+Account.all = Ledger()
+ledgerPath = "atm-ledger"
+
+window = Program(40, 15, "Winter Bank ATM", killKey = "escape", fps = 0)
 
 # generic scene classes
 
-class Message(ProgramState):
+class Message(WidgetState):
     def __init__(self, message = "Something went wrong...\nPress [ESC] to exit", nextScreen = None):
+        super().__init__()
         self.message = message
         self.nextScreen = nextScreen
     def Enter(self, prev):
-        window.Clear()
-        Terminal.ResetStyle()
-        for (i, l) in zip(range(self.message.count('\n') + 1), self.message.split('\n')):
-            Terminal.SetCursorPosition(1, 8 - ceil(self.message.count('\n') / 2) + i)
-            Terminal.Print(centerString(l, window.width))
-        Terminal.Flush()
+        self.root = Box(1, 1, window.width, window.height)
+        self.root.Add(Label(self.message, 0, 7 - ceil(self.message.count('\n') / 2), window.width))
+        super().Enter(prev)
     def Keypress(self, key):
         if key == "enter":
             if self.nextScreen:
@@ -97,45 +270,27 @@ class MenuItem:
         if self.action:
             self.action(self)
 
-class Menu(ProgramState):
+class Menu(WidgetState):
     def __init__(self, header = "", items = [], decorator = Terminal.EnableStyle('bold', gen = True) + Terminal.SetColor('yellow', gen = True)):
+        super().__init__()
         self.header = header
         self.items = items
         self.decorator = decorator
         self.selected = 0
     def Enter(self, prev):
-        window.Clear()
-        Terminal.ResetStyle()
         lineCount = self.header.count('\n') + 1
-        for (i, l) in zip(range(lineCount), self.header.split('\n')):
-            Terminal.SetCursorPosition(1, 2 + i)
-            Terminal.Print(centerString(l, window.width))
-        for (i, v) in zip(range(len(self.items)), self.items):
-            Terminal.SetCursorPosition(1, 3 + lineCount + i)
-            Terminal.Print(centerString(f"{self.decorator if i == self.selected else ''}{v.name}{Terminal.ResetStyle(gen = True)}", window.width))
-        Terminal.Flush()
+        self.root = Box(1, 1, window.width, window.height)
+        self.root.Add(Label(self.header, 0, 1, window.width))
+        self.focus = self.root.Add(self.CreateList(2 + lineCount, window.height - 3 - lineCount))
+        super().Enter(prev)
+    def CreateList(self, y, height):
+        return ListView(self.items, 0, y, window.width, selected = min(self.selected, max(len(self.items) - 1, 0)), decorator = self.decorator)
     def Keypress(self, key):
-        Terminal.ResetStyle()
-        lineCount = self.header.count('\n') + 1
-        if 0 <= self.selected < len(self.items):
-            Terminal.SetCursorPosition(1, 3 + lineCount + self.selected)
-            Terminal.Print(centerString(self.items[self.selected].name, window.width))
-            if key == "enter":
-                self.items[self.selected].Select()
-                return
-        if key == "up":
-            if self.selected - 1 >= 0:
-                self.selected -= 1
-        elif key == "down":
-            if self.selected + 1 < len(self.items):
-                self.selected += 1
-        for (i, v) in zip(range(len(self.items)), self.items):
-            Terminal.SetCursorPosition(1, 3 + lineCount + i)
-            Terminal.Print(centerString(f"{self.decorator if i == self.selected else ''}{v.name}{Terminal.ResetStyle(gen = True)}", window.width))
-        Terminal.Flush()
+        super().Keypress(key)
+        self.selected = self.focus.selected
 
 class DialogValue:
-    def __init__(self, name, type = "int", values = None, value = None, validate = lambda x: True, encrypt = lambda x: x):
+    def __init__(self, name, type = "int", values = None, value = None, validate = lambda x: True, encrypt = None):
         self.name = name
         self.type = type
         self.values = values
@@ -159,6 +314,12 @@ class DialogValue:
             except ValueError:
                 pass
             return False
+    def Accepts(self, value):
+        pv = self.value
+        self.value = value
+        valid = self.IsValid()
+        self.value = pv
+        return valid
     def Convert(self):
         if self.IsValid():
             if self.values:
@@ -178,8 +339,9 @@ class DialogValue:
                 pass
         return None
 
-class Dialog(ProgramState):
+class Dialog(WidgetState):
     def __init__(self, operation, header = "", params = [DialogValue("Continue?", "bool", ("Yes", "No"))], nextScreen = None, decorator = Terminal.EnableStyle("bold", gen = True) + Terminal.SetColor("yellow", gen = True)):
+        super().__init__()
         self.operation = operation
         self.header = header
         self.values = params
@@ -188,60 +350,43 @@ class Dialog(ProgramState):
         self.decorator = decorator
     def Enter(self, prev):
         self.prev = prev
-        window.Clear()
-        Terminal.ResetStyle()
         lineCount = self.header.count('\n') + 1
-        for (i, l) in zip(range(lineCount), self.header.split('\n')):
-            Terminal.SetCursorPosition(1, 2 + i)
-            Terminal.Print(centerString(l, window.width))
-        for (i, v) in zip(range(len(self.values)), self.values):
-            Terminal.SetCursorPosition(1, 3 + lineCount + i)
-            Terminal.Print(centerString(f"{self.decorator if i == self.selected else ''}{v.name}{Terminal.ResetStyle(gen = True)}: {'< ' if v.values and v.value > 0 else ''}{v.values[v.value] if v.values else v.encrypt(v.value)}{' >' if v.values and v.value < len(v.values) - 1 else ''}", window.width))
-        Terminal.Flush()
+        self.root = Box(1, 1, window.width, window.height)
+        self.root.Add(Label(self.header, 0, 1, window.width))
+        self.inputs = []
+        for (i, v) in enumerate(self.values):
+            if v.values:
+                widget = Field(v.name, v.value, 0, 2 + lineCount + i, window.width, choices = v.values, decorator = self.decorator)
+            else:
+                widget = TextInput(v.name, v.value, 4, 2 + lineCount + i, window.width - 8, validate = v.Accepts, encrypt = v.encrypt, decorator = self.decorator)
+            self.inputs.append(self.root.Add(widget))
+        self.Select(self.selected)
+        super().Enter(prev)
+    def Select(self, i):
+        if self.focus:
+            self.focus.Set(focused = False)
+        self.selected = i
+        self.focus = self.inputs[i]
+        self.focus.Set(focused = True)
     def Keypress(self, key):
-        Terminal.ResetStyle()
-        lineCount = self.header.count('\n') + 1
-        if 0 <= self.selected < len(self.values):
-            v = self.values[self.selected]
-            Terminal.SetCursorPosition(1, 3 + lineCount + self.selected)
-            Terminal.Print(centerString(f"{v.name}: {'< ' if v.values and v.value > 0 else ''}{v.values[v.value] if v.values else v.encrypt(v.value)}{' >' if v.values and v.value < len(v.values) - 1 else ''}", window.width))
-            if key == "left":
-                if v.values and v.value - 1 >= 0:
-                    v.value -= 1
-            elif key == "right":
-                if v.values and v.value + 1 < len(v.values):
-                    v.value += 1
-            elif key == "backspace":
-                if v.type != "bool" and not v.values:
-                    v.value = v.value[:-1]
-            elif not key in ("up", "down", "enter") and not v.values:
-                if key == "space":
-                    key = " "
-                pv = v.value
-                v.value += key
-                if not v.IsValid():
-                    v.value = pv
         if key == "up":
             if self.selected > 0:
-                self.selected -= 1
+                self.Select(self.selected - 1)
         elif key == "down":
             if self.selected < len(self.values) - 1:
-                self.selected += 1
+                self.Select(self.selected + 1)
         elif key == "enter":
-            valid = True
-            for v in self.values:
-                if not v.IsValid():
-                    valid = False
-            if valid:
+            for (v, widget) in zip(self.values, self.inputs):
+                v.value = widget.value
+            if all(v.IsValid() for v in self.values):
                 window.SwitchState(Message(self.operation(*(v.Convert() for v in self.values)), self.nextScreen))
-                return
         elif key == "ctrl+z" and self.prev:
             window.SwitchState(self.prev)
-            return
-        for (i, v) in zip(range(len(self.values)), self.values):
-            Terminal.SetCursorPosition(1, 3 + lineCount + i)
-            Terminal.Print(centerString(f"{self.decorator if i == self.selected else ''}{v.name}{Terminal.ResetStyle(gen = True)}: {'< ' if v.values and v.value > 0 else ''}{v.values[v.value] if v.values else v.encrypt(v.value)}{' >' if v.values and v.value < len(v.values) - 1 else ''}", window.width))
-        Terminal.Flush()
+        else:
+            super().Keypress(key)
+    def Text(self, text):
+        # typed characters and pastes arrive as one edit
+        self.focus.Insert(text)
 
 # screens
 
@@ -249,16 +394,24 @@ class StartScreen(Menu):
     def __init__(self):
         super().__init__(f"Welcome to {Terminal.EnableStyle('bold', gen = True) + Terminal.SetColor('cyan', gen = True)}Winter Bank{Terminal.ResetStyle(gen = True)}", [])
     def Enter(self, prev):
-        self.items = []
-        for i in range(len(Account.all)):
-            account = Account.all[i]
-            self.items.append(MenuItem(account.name, lambda i: window.SwitchState(PINScreen(Account.Find(i.name)))))
-        self.items += [MenuItem("<register>", lambda *_: window.SwitchState(Dialog(Account.Register, "Register an account", [
+        self.register = MenuItem("<register>", lambda *_: window.SwitchState(Dialog(Account.Register, "Register an account", [
             DialogValue("name", "string"),
-            DialogValue("PIN", "int", validate = lambda p: p < 10**4, encrypt = lambda p: " ".join(f"{"*" * len(p):_<4}")),
-            DialogValue("confirm PIN", "int", validate = lambda p: p < 10**4, encrypt = lambda p: " ".join(f"{"*" * len(p):_<4}"))
-        ], self)))]
+            DialogValue("PIN", "int", validate = lambda p: p < 10**4, encrypt = lambda p: " ".join(f"{'*' * len(p):_<4}")),
+            DialogValue("confirm PIN", "int", validate = lambda p: p < 10**4, encrypt = lambda p: " ".join(f"{'*' * len(p):_<4}"))
+        ], self)))
         super().Enter(prev)
+    def Items(self, start, stop):
+        # accounts are only turned into menu items when they scroll into view
+        n = len(Account.all)
+        items = [MenuItem(account.name, lambda i: window.SwitchState(PINScreen(Account.Find(i.name)))) for account in Account.all.Slice(start, min(stop, n))]
+        return items + [self.register] if start <= n < stop else items
+    def Keys(self, start, stop):
+        # filtering indexes the names only, a million accounts stay in the ledger's columns
+        n = len(Account.all)
+        names = Account.all.Names(start, min(stop, n))
+        return names + [self.register.name] if start <= n < stop else names
+    def CreateList(self, y, height):
+        return VirtualList(None, 0, y, window.width, height, provider = self.Items, count = lambda: len(Account.all) + 1, selected = self.selected, decorator = self.decorator, keys = self.Keys)
 
 class PINScreen(ProgramState):
     def __init__(self, account, attempts = 3):
@@ -266,12 +419,12 @@ class PINScreen(ProgramState):
         self.account = account
         self.correct = str(account.pin)
         self.attemptsLeft = attempts
+    def Static(self, layer):
+        layer.Print(1, 7, centerString(f"Enter PIN for {Terminal.EnableStyle('bold', gen = True) + Terminal.SetColor('cyan', gen = True)}{self.account.name}{Terminal.ResetStyle(gen = True)}:", window.width))
     def Enter(self, prev):
         self.prev = prev
         window.Clear()
         Terminal.ResetStyle()
-        Terminal.SetCursorPosition(1, 7)
-        Terminal.Print(centerString(f"Enter PIN for {Terminal.EnableStyle('bold', gen = True) + Terminal.SetColor('cyan', gen = True)}{self.account.name}{Terminal.ResetStyle(gen = True)}:", window.width))
         Terminal.SetCursorPosition(1, 8)
         Terminal.Print(centerString(" ".join("_" * len(self.correct)), window.width))
         Terminal.SetCursorPosition(1, 9)
@@ -323,4 +476,14 @@ class AccountScreen(Menu):
             ]
             super().Enter(prev)
 
-window.Run(StartScreen())
+def ScheduleCommit(delay, callback):
+    # the commit outlives the screen that made the change
+    window.After(delay, callback).state = None
+
+if __name__ == "__main__":
+    Account.all.Open(ledgerPath)
+    Account.all.schedule = ScheduleCommit
+    try:
+        window.Run(StartScreen())
+    finally:
+        Account.all.Close()
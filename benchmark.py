@@ -0,0 +1,193 @@
+'''
+
+RENDERING BENCHMARKS FOR THE winter LIBRARY
+
+Drives the ATM demo (Program, Menu, Dialog, Message and PIN states) headlessly
+through a VirtualTerminal with scripted keystrokes and reports, per scenario:
+frames/sec, keypress-to-flush latency percentiles, bytes and escape sequences
+per frame and allocated bytes per frame.
+
+USAGE:
+python benchmark.py                              | run all scenarios and print the results
+python benchmark.py -o run.json                  | also save the results
+python benchmark.py --compare run.json           | fail if a metric regressed against a saved run
+python benchmark.py --budget budgets.json        | fail if a metric exceeds its budget
+python benchmark.py --recording session.wrec     | add a scenario replaying the input of a recorded session
+
+budgets.json maps scenario -> metric -> maximum, e.g. {"menu": {"bytes_per_frame": 60}}
+
+'''
+
+from winter import *
+from argparse import ArgumentParser
+from importlib.util import spec_from_file_location, module_from_spec
+from time import perf_counter as timer
+import json, os, sys, tracemalloc
+
+demoPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "atm-demo.py")
+
+def loadDemo():
+    spec = spec_from_file_location("atm_demo", demoPath)
+    demo = module_from_spec(spec)
+    spec.loader.exec_module(demo)
+    return demo
+
+# scenarios register their accounts and return the key script, the kill key is appended by runScenario
+
+def menuScenario(demo, rounds):
+    for i in range(8):
+        demo.Account.Register(f"user{i}", 1234, 1234)
+    return (["down"] * 8 + ["up"] * 8) * rounds
+
+def registerScenario(demo, rounds):
+    keys = []
+    for i in range(rounds):
+        keys += ["down"] * i + ["enter"] + list(f"user{i}") + ["down"] + list("1234") + ["down"] + list("1234") + ["enter", "enter"]
+    return keys
+
+def sessionScenario(demo, rounds):
+    demo.Account.Register("alice", 1234, 1234)
+    demo.Account.Register("bob", 1234, 1234)
+    keys = ["enter"] + list("1234") + ["enter"]
+    for i in range(rounds):
+        keys += ["enter"] + list("100") + ["enter", "enter"]
+        keys += ["down", "down", "enter"] + list("bob") + ["down"] + list("10") + ["enter", "enter"]
+        keys += ["down", "enter"] + list("5") + ["enter", "enter"]
+    return keys
+
+scenarios = {
+    "menu": menuScenario,
+    "register": registerScenario,
+    "session": sessionScenario
+}
+
+def percentile(values: list, p: float):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def runScenario(demo, name: str, rounds: int, trace: bool = False):
+    demo.Account.all.Clear()
+    keys = scenarios[name](demo, rounds)
+    vt = VirtualTerminal(demo.window.width + 2, demo.window.height + 3, keys + [demo.window.killKey], batch = 1)
+    Terminal.Use(vt)
+    window = demo.window
+    window.exit, window.currentState, window.fps = False, None, 0
+    allocs, last = [], [0]
+    if trace:
+        write = vt.Write
+        def tracedWrite(data):
+            current, peak = tracemalloc.get_traced_memory()
+            allocs.append(max(peak - last[0], 0))
+            tracemalloc.reset_peak()
+            last[0] = current
+            return write(data)
+        vt.Write = tracedWrite
+        tracemalloc.start()
+        last[0] = tracemalloc.get_traced_memory()[0]
+    start = timer()
+    window.Run(demo.StartScreen())
+    elapsed = timer() - start
+    if trace:
+        tracemalloc.stop()
+    return (vt, elapsed, allocs)
+
+def measure(demo, name: str, rounds: int):
+    vt, elapsed, _ = runScenario(demo, name, rounds)
+    frames = [f for f in vt.frames if f["latency"] is not None]
+    latencies = [f["latency"] * 1000 for f in frames]
+    _, _, allocs = runScenario(demo, name, rounds, trace = True)
+    return {
+        "frames": vt.flushes,
+        "fps": vt.flushes / elapsed if elapsed else 0,
+        "latency_p50_ms": percentile(latencies, 50),
+        "latency_p90_ms": percentile(latencies, 90),
+        "latency_p99_ms": percentile(latencies, 99),
+        "bytes_per_frame": sum(f["bytes"] for f in frames) / len(frames) if frames else 0,
+        "max_bytes_per_frame": max((f["bytes"] for f in frames), default = 0),
+        "escapes_per_frame": sum(f["escapes"] for f in frames) / len(frames) if frames else 0,
+        "alloc_bytes_per_frame": sum(allocs) / len(allocs) if allocs else 0
+    }
+
+# metrics where a higher value is better, everything else regresses when it grows
+higherIsBetter = ("fps",)
+timingMetrics = ("fps", "latency_p50_ms", "latency_p90_ms", "latency_p99_ms")
+
+def compare(current: dict, baseline: dict, tolerance: float, timeTolerance: float):
+    failures = []
+    for (scenario, metrics) in current.items():
+        for (metric, value) in metrics.items():
+            old = baseline.get(scenario, {}).get(metric)
+            if old is None or metric == "frames":
+                continue
+            limit = timeTolerance if metric in timingMetrics else tolerance
+            if metric in higherIsBetter:
+                if value < old * (1 - limit):
+                    failures.append(f"{scenario}.{metric}: {value:.3f} < {old:.3f}")
+            elif value > old * (1 + limit) and value - old > 1e-9:
+                failures.append(f"{scenario}.{metric}: {value:.3f} > {old:.3f}")
+    return failures
+
+def checkBudget(current: dict, budget: dict):
+    failures = []
+    for (scenario, limits) in budget.items():
+        for (metric, limit) in limits.items():
+            value = current.get(scenario, {}).get(metric)
+            if value is None:
+                continue
+            if metric in higherIsBetter:
+                if value < limit:
+                    failures.append(f"{scenario}.{metric}: {value:.3f} below budget {limit}")
+            elif value > limit:
+                failures.append(f"{scenario}.{metric}: {value:.3f} over budget {limit}")
+    return failures
+
+def main(argv = None):
+    parser = ArgumentParser(description = "winter rendering benchmarks")
+    parser.add_argument("scenario", nargs = "*", help = f"scenarios to run: {', '.join(scenarios)} (default: all)")
+    parser.add_argument("-r", "--rounds", type = int, default = 20, help = "repetitions of each scenario's key script")
+    parser.add_argument("-o", "--output", help = "save the results as JSON")
+    parser.add_argument("--compare", help = "JSON results of a previous run to compare against")
+    parser.add_argument("--tolerance", type = float, default = 0.10, help = "allowed relative regression of byte and allocation metrics")
+    parser.add_argument("--time-tolerance", type = float, default = 0.50, help = "allowed relative regression of fps and latency")
+    parser.add_argument("--budget", help = "JSON file with absolute per-metric budgets")
+    parser.add_argument("--recording", action = "append", default = [], help = "recording (see Program.Record) whose input is replayed as an extra scenario")
+    args = parser.parse_args(argv)
+    for path in args.recording:
+        # recorded sessions start from an empty ledger and end with their own kill key, rounds don't apply
+        scenarios[os.path.splitext(os.path.basename(path))[0]] = lambda demo, rounds, path = path: Recording(path).Keys()
+    for name in args.scenario:
+        if not name in scenarios:
+            parser.error(f"unknown scenario: {name}")
+
+    demo = loadDemo()
+    backend = Terminal.backend
+    results = {}
+    try:
+        for name in args.scenario or scenarios:
+            results[name] = measure(demo, name, args.rounds)
+    finally:
+        Terminal.Use(backend)
+
+    for (name, metrics) in results.items():
+        print(name)
+        for (metric, value) in metrics.items():
+            print(f"  {metric:<22}{value:>12.3f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2)
+
+    failures = []
+    if args.compare:
+        with open(args.compare) as f:
+            failures += compare(results, json.load(f), args.tolerance, args.time_tolerance)
+    if args.budget:
+        with open(args.budget) as f:
+            failures += checkBudget(results, json.load(f))
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
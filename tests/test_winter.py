@@ -0,0 +1,1448 @@
+'''
+
+REGRESSION TESTS FOR THE winter LIBRARY
+
+Everything runs headlessly: what a Screen sends is fed to a VirtualTerminal, whose
+emulated grid must then match what the program drew. Time comes from a fake clock
+wherever the library schedules something, so no test depends on how fast it runs.
+
+USAGE:
+python -m pytest tests
+
+'''
+
+import asyncio, json, os, random, re, sys, time
+from importlib.util import spec_from_file_location, module_from_spec
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import winter
+from winter import *
+
+@pytest.fixture(autouse = True)
+def restoreTerminal():
+    backend = Terminal.backend
+    yield
+    Terminal.Detach()
+    Terminal.Use(backend)
+    Input.queue.clear()
+
+class Clock:
+    # stands in for the library's perf_counter, time only moves when a test advances it
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def Advance(self, seconds: float):
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(winter, "timer", clock)
+    return clock
+
+def headless(width: int = 20, height: int = 5, keys = (), **kwargs):
+    # a program on a VirtualTerminal its window just fits, the size isn't polled unless a test asks for it
+    vt = VirtualTerminal(width + 2, height + 2, keys)
+    Terminal.Use(vt)
+    program = Program(width, height, "T", **kwargs)
+    program.sizePollInterval = 0
+    return (program, vt)
+
+class Counter(ProgramState):
+    def __init__(self):
+        self.keys, self.updates = [], []
+
+    def Keypress(self, key: str):
+        self.keys.append(key)
+
+    def Update(self, dt: float):
+        self.updates.append(dt)
+
+def flush(screen: Screen, vt: VirtualTerminal):
+    data = "".join(screen.Diff()).encode()
+    vt.Write(data)
+    return data
+
+def assertShows(vt: VirtualTerminal, buffer: FrameBuffer):
+    # the emulated terminal has the same characters and pens as the buffer
+    assert vt.screen.back.chars == buffer.chars
+    assert vt.screen.back.pens == buffer.pens
+
+def waitFor(condition, timeout: float = 5):
+    # for work on other threads: the timeout only bounds a hang, nothing is asserted about the time taken
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+# user-001: double-buffered screen
+
+def randomFrame(screen: Screen, rng: random.Random, pens: list):
+    # random strings of narrow and wide characters written like a program would
+    for _ in range(rng.randint(1, 6)):
+        screen.x, screen.y = rng.randrange(screen.width), rng.randrange(screen.height)
+        screen.pen = rng.choice(pens)
+        screen.Write("".join(rng.choice("ab c界") for _ in range(rng.randint(1, 5))))
+
+def test_diff_matches_emulated_grid():
+    rng = random.Random(1)
+    vt, screen = VirtualTerminal(24, 8), Screen(24, 8)
+    for _ in range(300):
+        randomFrame(screen, rng, [Terminal.defaultPen])
+        flush(screen, vt)
+        assertShows(vt, screen.back)
+
+def test_unchanged_frame_sends_nothing():
+    vt, screen = VirtualTerminal(10, 2), Screen(10, 2)
+    screen.Write("hello")
+    flush(screen, vt)
+    assert flush(screen, vt) == b""
+    screen.x = 1
+    screen.Write("a")
+    # only the changed cell, reached however is cheapest
+    assert len(flush(screen, vt)) <= len(b"\x1b[1;2Ha")
+    assert vt.Line(0) == "hallo     "
+
+def test_attached_screen_collects_prints():
+    vt = VirtualTerminal(10, 2)
+    Terminal.Use(vt)
+    screen = Screen(10, 2)
+    Terminal.Attach(screen)
+    Terminal.SetCursorPosition(2, 1)
+    Terminal.Print("abc")
+    Terminal.Flush()
+    assert vt.Line(1) == "  abc     "
+    Terminal.SetCursorPosition(2, 1)
+    Terminal.Print("abd")
+    Terminal.Flush()
+    assert vt.Line(1) == "  abd     "
+    assert vt.frames[-1]["bytes"] <= len(b"\x1b[2;5Hd")
+
+def test_other_escapes_pass_through():
+    screen = Screen(20, 1)
+    screen.Write("\x1b]0;My title\x07ab\x1b7cd\x1b(B\x1b]2;x\x1b\\e\x1b[?25l")
+    assert "".join(screen.back.chars[0]) == "abcde" + " " * 15
+    assert screen.passthrough == ["\x1b]0;My title\x07", "\x1b7", "\x1b(B", "\x1b]2;x\x1b\\", "\x1b[?25l"]
+    # sent to the terminal ahead of the frame
+    assert "".join(screen.Diff()).startswith("\x1b]0;My title\x07\x1b7\x1b(B\x1b]2;x\x1b\\\x1b[?25l")
+
+# user-002: chunked output writer
+
+def test_output_joins_chunks_into_one_write():
+    vt = VirtualTerminal(10, 1)
+    out = Output(vt)
+    out.Write("ab")
+    out.Write("界")
+    assert out.Pending()
+    assert out.Flush() == 5
+    assert (out.flushes, out.writes, out.bytesWritten, out.lastFrameBytes) == (1, 1, 5, 5)
+    assert vt.flushes == 1 and vt.Line(0) == "ab界      "
+    # nothing pending: no write at all
+    assert out.Flush() == 0
+    assert (out.flushes, vt.flushes) == (1, 1)
+
+def test_output_clear_and_encoding():
+    vt = VirtualTerminal(10, 1)
+    out = Output(vt, "ascii")
+    out.Write("lost")
+    out.Clear()
+    assert not out.Pending() and out.Flush() == 0
+    out.Write("a界")
+    assert out.Flush() == 2
+    assert vt.Line(0).startswith("a?")
+
+def test_write_all_sends_everything():
+    from threading import Thread
+    data = bytes(range(256)) * 4096
+    r, w = os.pipe()
+    received = []
+    reader = Thread(target = lambda: received.extend(iter(lambda: os.read(r, 65536), b"")))
+    reader.start()
+    try:
+        assert winter.writeAll(w, data) >= 1
+    finally:
+        os.close(w)
+        reader.join()
+        os.close(r)
+    assert b"".join(received) == data
+
+# user-003: scheduling modes
+
+def test_idle_program_updates_only_on_input():
+    program, vt = headless(keys = ["a", "b", "escape"], fps = 0)
+    vt.batch = 1
+    state = Counter()
+    program.Run(state)
+    assert state.keys == ["a", "b"]
+    # one update per batch of input, nothing in between
+    assert len(state.updates) == 3
+
+def test_idle_program_waits_for_input(clock):
+    program, vt = headless(fps = 0)
+    program.Begin(Counter())
+    assert program.Timeout() is None
+    program.Finish()
+
+def test_fixed_rate_program_updates_on_schedule(clock):
+    program, vt = headless(fps = 8)
+    state = Counter()
+    program.Begin(state)
+    program.Step()
+    assert state.updates == [0]
+    program.Step()
+    assert len(state.updates) == 1 and program.Timeout() == 0.125
+    clock.Advance(0.0625)
+    program.Step()
+    assert len(state.updates) == 1 and program.Timeout() == 0.0625
+    clock.Advance(0.0625)
+    program.Step()
+    assert state.updates[-1] == 0.125
+    # a program that fell behind updates once and skips the missed ticks
+    clock.Advance(0.5)
+    program.Step()
+    program.Step()
+    assert state.updates[-1] == 0.5 and len(state.updates) == 3
+    assert program.Timeout() == 0.125
+    program.Finish()
+
+def test_free_running_program_updates_every_step(clock):
+    program, vt = headless()
+    state = Counter()
+    program.Begin(state)
+    for _ in range(3):
+        program.Step()
+    assert len(state.updates) == 3
+    program.Finish()
+
+# user-004: input decoding
+
+def test_decoder_names_sequences():
+    decoder = KeyDecoder()
+    keys = decoder.Feed(b"a\x1b[A\x1bOP\x1b[1;5A\x1b[3;2~\x1b[1;3P\x1bx\x1b\x7f\r\x7f")
+    assert keys == ["a", "up", "f1", "ctrl+up", "shift+delete", "alt+f1", "alt+x", "alt+backspace", "enter", "backspace"]
+
+def test_decoder_waits_for_split_input():
+    decoder = KeyDecoder()
+    data = "a界".encode() + b"\x1b[1;5"
+    assert decoder.Feed(data[:2]) == ["a"]
+    assert decoder.Feed(data[2:]) == ["界"]
+    assert decoder.Pending()
+    assert decoder.Feed(b"B") == ["ctrl+down"]
+    # a lone escape is only a key once no more input came to extend it
+    assert decoder.Feed(b"\x1b") == []
+    assert decoder.Feed(final = True) == ["escape"]
+
+def test_decoder_skips_unknown_sequences():
+    assert KeyDecoder().Feed(b"\x1b[99;99zq") == ["q"]
+
+@pytest.mark.skipif(os.name == "nt", reason = "needs a pty")
+def test_posix_console_reads_a_burst_at_once():
+    import termios
+    master, slave = os.openpty()
+    attrs = termios.tcgetattr(slave)
+    console = PosixConsole(slave, slave)
+    try:
+        console.Start()
+        assert termios.tcgetattr(slave) != attrs
+        os.write(master, b"ab\x1b[A\x1b[1;5C" + "界".encode())
+        assert console.Wait(5)
+        assert console.Read() == ["a", "b", "up", "ctrl+right", "界"]
+        console.Stop()
+        assert termios.tcgetattr(slave) == attrs
+    finally:
+        console.Stop()
+        os.close(master)
+        os.close(slave)
+
+class Failing(ProgramState):
+    def Enter(self, *args, **kwargs):
+        raise RuntimeError("broken state")
+
+def test_failing_state_restores_terminal(capsys):
+    program, vt = headless()
+    program.Run(Failing())
+    assert "broken state" in capsys.readouterr().out
+    assert vt.modes["?25"] and not vt.modes["?2004"]
+    assert Terminal.screen is None
+
+# user-005: text measurement and layout
+
+def test_measure_skips_escapes_and_counts_wide_characters():
+    assert measureString("plain") == 5
+    assert measureString("\x1b[1;31mred\x1b[0m") == 3
+    assert measureString("界a") == 3
+    assert measureString("é") == 1
+    assert measureString(Terminal.Escape("7m", gen = True) + "x") == 1
+
+def test_layout_alignments():
+    assert centerString("ab", 5) == " ab  "
+    assert leftString("ab", 5, ".") == "ab..."
+    assert rightString("ab", 5) == "   ab"
+    assert justifyString("a b c", 9) == "a   b   c"
+    assert justifyString("a b c", 8) == "a   b  c"
+    assert centerString("界", 4) == " 界 "
+    # colours don't take up room
+    assert rightString("\x1b[1mab\x1b[0m", 4) == "  \x1b[1mab\x1b[0m"
+
+def test_layout_crops_to_width():
+    assert leftString("abcdef", 3) == "abc"
+    assert rightString("abcdef", 3) == "def"
+    assert centerString("abcdef", 2) == "cd"
+    for align in ("left", "right", "center", "justify"):
+        for width in range(1, 6):
+            # a wide character cut in half is padded, the result always has the asked width
+            assert measureString(layoutString("a界b界c", width, align)) == width
+    assert leftString("a界b", 2) == "a "
+
+# user-006: pen tracking
+
+pens = [Terminal.defaultPen, Terminal.ParseSGR("1;31"), Terminal.ParseSGR("4;44"), Terminal.ParseSGR("38;5;200;7"), Terminal.ParseSGR("2;92")]
+
+def test_diff_matches_emulated_pens():
+    rng = random.Random(6)
+    vt, screen = VirtualTerminal(24, 8), Screen(24, 8)
+    for _ in range(300):
+        randomFrame(screen, rng, pens)
+        data = flush(screen, vt).decode()
+        assertShows(vt, screen.back)
+        # adjacent changes of pen are merged into one sequence
+        assert not re.search("\x1b\\[[0-9;]*m\x1b\\[[0-9;]*m", data)
+
+def test_transitions_are_minimal():
+    bold = Terminal.ParseSGR("1;31")
+    assert bold == (Terminal.styleBits[1], "31", None)
+    assert Terminal.ParseSGR("38;5;200;1") == (Terminal.styleBits[1], "38;5;200", None)
+    assert Terminal.Transition(bold, bold) == ""
+    # an unknown terminal pen always gets a full reset
+    assert Terminal.Transition(None, bold) == "\x1b[0;1;31m"
+    assert Terminal.Transition(Terminal.defaultPen, bold) == "\x1b[1;31m"
+    assert Terminal.Transition(bold, Terminal.ParseSGR("22", bold)) == "\x1b[22m"
+    assert Terminal.Transition(bold, Terminal.ParseSGR("4;44", bold)) == "\x1b[4;44m"
+    assert Terminal.Transition(bold, Terminal.defaultPen) == "\x1b[0m"
+
+def test_printed_styles_elide_repeats():
+    vt = VirtualTerminal(20, 1)
+    Terminal.Use(vt)
+    bold = Terminal.EnableStyle("bold", gen = True)
+    Terminal.Print(bold + "a" + Terminal.ResetStyle(gen = True) + bold + "b" + bold + "c")
+    Terminal.Flush()
+    # the reset and the repeated bold cancel out: one pen change for the whole line
+    assert vt.frames[-1]["escapes"] == 1
+    assert vt.Cell(2, 0) == ("c", Terminal.ParseSGR("1"))
+
+# user-007: cursor motion
+
+def test_cheapest_moves():
+    screen, pen = Screen(20, 4), Terminal.defaultPen
+    screen.Write("hello world")
+    assert screen.Move(None, None, 3, 2, pen) == "\x1b[3;4H"
+    assert screen.Move(5, 0, 5, 0, pen) == ""
+    assert screen.Move(5, 0, 3, 0, pen) == "\b\b"
+    assert screen.Move(5, 0, 0, 1, pen) == "\r\n"
+    assert screen.Move(4, 1, 4, 0, pen) == "\x1b[A"
+    assert screen.Move(8, 0, 8, 3, pen) == "\x1b[3B"
+    assert screen.Move(10, 3, 0, 0, pen) == "\x1b[H"
+    assert screen.Move(1, 0, 9, 0, pen) == "\x1b[8C"
+    # cells already on screen are re-printed when that's shorter, but only in the pen they were drawn with
+    assert screen.Move(0, 0, 2, 0, pen) == "he"
+    assert screen.Move(0, 0, 2, 0, Terminal.ParseSGR("1")) == "\x1b[2C"
+
+def test_moves_land_on_target_without_changing_cells():
+    rng = random.Random(7)
+    vt, screen = VirtualTerminal(16, 5), Screen(16, 5)
+    for _ in range(200):
+        randomFrame(screen, rng, pens[:2])
+        flush(screen, vt)
+        pen = rng.choice(pens[:2])
+        cx, cy = rng.randrange(16), rng.randrange(5)
+        x, y = rng.randrange(16), rng.randrange(5)
+        if screen.back.chars[y][x] == '':
+            continue
+        vt.Write((f"\x1b[{cy + 1};{cx + 1}H" + Terminal.SGR(pen) + screen.Move(cx, cy, x, y, pen)).encode())
+        assert vt.CursorPosition() == (x + 1, y + 1)
+        assertShows(vt, screen.back)
+        screen.cursorX, screen.cursorY, screen.terminalPen = x, y, pen
+
+# user-008: virtual terminal
+
+def test_scripted_keys_arrive_in_batches():
+    vt = VirtualTerminal(10, 2, ["a", "b", "c", "d", "e"], batch = 2, batches = (1,))
+    assert [vt.Read() for _ in range(4)] == [["a"], ["b", "c"], ["d", "e"], []]
+    assert not vt.Wait(1)
+    vt.batch = None
+    vt.SendBytes(b"\x1b[Ax\x1b")
+    vt.Send("enter")
+    assert vt.Wait(1) and vt.Read() == ["up", "x", "escape", "enter"]
+
+def test_frame_statistics(clock):
+    vt = VirtualTerminal(10, 2, ["a"])
+    vt.Write(b"\x1b[?25lab")
+    vt.Read()
+    clock.Advance(0.25)
+    vt.Write(b"\x1b[2;1Hc\x1b[1m")
+    assert (vt.bytes, vt.escapes, vt.flushes) == (19, 3, 2)
+    assert [f["bytes"] for f in vt.frames] == [8, 11]
+    # time from reading input to the frame that answers it
+    assert vt.frames[0]["latency"] is None and vt.frames[1]["latency"] == 0.25
+    assert vt.modes == {"?25": False}
+    assert vt.Text() == "ab        \nc         " and vt.CursorPosition() == (2, 2)
+    assert vt.Cell(0, 1) == ("c", Terminal.defaultPen)
+
+def test_resize_crops_like_a_terminal():
+    vt = VirtualTerminal(6, 2)
+    vt.Write(b"abcdef\r\nghijkl")
+    vt.Resize(3, 3)
+    assert vt.Size() == (3, 3)
+    assert [vt.Line(y) for y in range(3)] == ["abc", "ghi", "   "]
+
+# user-009: benchmarks
+
+def loadScript(name: str):
+    spec = spec_from_file_location(name.replace("-", "_"), os.path.join(root, name + ".py"))
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def test_compare_flags_regressions():
+    benchmark = loadScript("benchmark")
+    baseline = {"menu": {"frames": 10, "fps": 100, "bytes_per_frame": 50, "latency_p50_ms": 1}}
+    same = {"menu": {"frames": 99, "fps": 60, "bytes_per_frame": 54, "latency_p50_ms": 1.4}}
+    assert benchmark.compare(same, baseline, 0.10, 0.50) == []
+    worse = {"menu": {"frames": 10, "fps": 40, "bytes_per_frame": 56, "latency_p50_ms": 1}}
+    assert benchmark.compare(worse, baseline, 0.10, 0.50) == ["menu.fps: 40.000 < 100.000", "menu.bytes_per_frame: 56.000 > 50.000"]
+
+def test_budget_limits():
+    benchmark = loadScript("benchmark")
+    results = {"menu": {"fps": 50, "bytes_per_frame": 70}}
+    assert benchmark.checkBudget(results, {"menu": {"bytes_per_frame": 80, "fps": 10}, "other": {"fps": 1}}) == []
+    assert benchmark.checkBudget(results, {"menu": {"bytes_per_frame": 60, "fps": 60}}) == ["menu.bytes_per_frame: 70.000 over budget 60", "menu.fps: 50.000 below budget 60"]
+
+def test_benchmark_runs_the_demo(tmp_path, capsys):
+    benchmark = loadScript("benchmark")
+    output = tmp_path / "run.json"
+    assert benchmark.main(["menu", "-r", "1", "-o", str(output)]) == 0
+    results = json.loads(output.read_text())
+    assert results["menu"]["frames"] > 16 and results["menu"]["bytes_per_frame"] > 0
+    # a run compared against itself doesn't regress in size
+    budget = tmp_path / "budget.json"
+    budget.write_text(json.dumps({"menu": {"max_bytes_per_frame": results["menu"]["max_bytes_per_frame"]}}))
+    assert benchmark.main(["menu", "-r", "1", "--budget", str(budget)]) == 0
+    assert "menu" in capsys.readouterr().out
+
+# user-010: frame profiler
+
+def test_nested_phases_count_exclusive_time(clock):
+    profiler = Profiler(4)
+    profiler.Begin("keypress")
+    clock.Advance(1)
+    profiler.Begin("flush")
+    clock.Advance(2)
+    profiler.bytes += 100
+    profiler.End()
+    clock.Advance(0.5)
+    profiler.End()
+    profiler.EndFrame()
+    assert [profiler.samples[phase][0] for phase in ("input", "keypress", "update", "flush", "frame")] == [0, 1.5, 0, 2, 3.5]
+    assert profiler.outputBytes[0] == 100
+
+def test_profiler_keeps_the_last_frames(tmp_path, clock):
+    profiler = Profiler(4)
+    for i in range(6):
+        profiler.Begin("update")
+        clock.Advance(i)
+        profiler.End()
+        profiler.EndFrame()
+    # a ring of the 4 newest frames, oldest first
+    assert [profiler.samples["update"][i] for i in profiler.Frames()] == [2, 3, 4, 5]
+    assert profiler.Percentile("update", 50) == 4
+    stats = profiler.Stats()
+    assert stats["update"]["max"] == 5000 and stats["update"]["mean"] == 3500 and stats["bytes"]["max"] == 0
+    path = tmp_path / "profile.json"
+    profiler.Dump(str(path))
+    dump = json.loads(path.read_text())
+    assert [frame["update"] for frame in dump["frames"]] == [2000, 3000, 4000, 5000]
+    assert dump["stats"]["update"]["p90"] == 5000
+
+def test_hud_is_an_overlay():
+    program, vt = headless()
+    profiler = program.Profile(hud = True)
+    program.Begin(Counter())
+    border = vt.Line(6)
+    # the HUD is redrawn with every frame the program flushes
+    program.Step()
+    Terminal.Flush()
+    assert "ms" in vt.Line(6) and vt.Line(6) != border
+    assert program.screen.back.chars[6] == list(border)
+    profiler.hud = False
+    program.Step()
+    Terminal.Flush()
+    # what the HUD covered is shown again
+    assert vt.Line(6) == border and profiler.hudLayer is None
+    program.Finish()
+
+# user-011: widget tree
+
+class CountingLabel(Label):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.draws = 0
+
+    def Draw(self, screen: Screen, x: int, y: int):
+        self.draws += 1
+        super().Draw(screen, x, y)
+
+def widgetScreen(root: Widget):
+    vt = VirtualTerminal(20, 6)
+    Terminal.Use(vt)
+    Terminal.Attach(Screen(20, 6))
+    state = WidgetState(root)
+    state.Enter(None)
+    return (vt, state)
+
+def test_only_changed_rows_are_repainted():
+    root = Box(0, 0, 20, 6, "Menu", border = True)
+    title = root.Add(CountingLabel("Pick one", 1, 1, 18))
+    items = root.Add(ListView(["alpha", "beta", "gamma"], 1, 2, 18, decorator = "\x1b[7m"))
+    vt, state = widgetScreen(root)
+    assert vt.Line(0) == "┌────── Menu ──────┐" and "alpha" in vt.Line(2)
+    assert vt.Cell(9, 2)[1] == Terminal.ParseSGR("7") and vt.Cell(9, 3)[1] == Terminal.defaultPen
+    items.Keypress("down")
+    state.Update(0)
+    assert vt.Cell(9, 2)[1] == Terminal.defaultPen and vt.Cell(9, 3)[1] == Terminal.ParseSGR("7")
+    assertShows(vt, Terminal.screen.back)
+    assert title.draws == 1 and not root.damaged
+    # the two list rows and nothing else
+    assert vt.frames[-1]["bytes"] < 40
+
+def test_unchanged_tree_sends_nothing():
+    root = Widget(0, 0, 20, 6)
+    label = root.Add(CountingLabel("a", 0, 0, 10))
+    vt, state = widgetScreen(root)
+    flushes = vt.flushes
+    assert not label.Set(text = "a")
+    state.Update(0)
+    assert vt.flushes == flushes and label.draws == 1
+    assert label.Set(text = "b")
+    state.Update(0)
+    assert label.draws == 2 and vt.Line(0).startswith("    b")
+
+def test_moving_a_widget_repaints_its_old_place():
+    root = Widget(0, 0, 20, 6)
+    label = root.Add(Label("x", 0, 0, 1))
+    vt, state = widgetScreen(root)
+    label.Set(y = 3)
+    state.Update(0)
+    assert vt.Line(0)[0] == " " and vt.Line(3)[0] == "x"
+
+# user-012: virtual list
+
+class Provider:
+    # names of a million items, made on request and counted
+    def __init__(self, size: int = 1000000):
+        self.size, self.made = size, 0
+
+    def __call__(self, start: int, stop: int):
+        self.made += stop - start
+        return [f"item{i:07d}" for i in range(start, stop)]
+
+def test_only_the_visible_window_is_made():
+    provider = Provider()
+    items = VirtualList(x = 0, y = 0, width = 20, height = 4, provider = provider, count = provider.size, filterable = False)
+    vt, state = widgetScreen(items)
+    assert [vt.Line(y).strip() for y in range(4)] == ["item0000000", "item0000001", "item0000002", "item0000003"]
+    for key in ["end", "up", "pageup"]:
+        items.Keypress(key)
+        state.Update(0)
+    assert items.selected == 999994 and vt.Line(0).strip() == "item0999994"
+    assert provider.made < 20
+
+def test_filter_narrows_by_prefix():
+    names = ["Bob", "alice", "bill", "Carol", "bo"]
+    items = VirtualList(names, 0, 0, 20, 4)
+    vt, state = widgetScreen(items)
+    for key in "b":
+        items.Keypress(key)
+    assert [items.Item(i) for i in range(items.Size())] == ["bill", "bo", "Bob"]
+    items.Keypress("o")
+    assert [items.Item(i) for i in range(items.Size())] == ["bo", "Bob"]
+    state.Update(0)
+    assert vt.Line(3).startswith("filter: bo")
+    items.Keypress("backspace")
+    items.Keypress("backspace")
+    assert items.Size() == 5 and items.Item(0) == "Bob"
+    items.Keypress("z")
+    assert items.Size() == 0 and items.Item(0) is None
+
+def test_filter_keys_come_from_their_own_source():
+    provider = Provider(10000)
+    items = VirtualList(x = 0, y = 0, width = 20, height = 4, provider = provider, count = provider.size,
+                        keys = lambda start, stop: [f"item{i:07d}" for i in range(start, stop)])
+    items.SetFilter("item000099")
+    # the index is built without making a single item, only the matches on screen are
+    assert items.Size() == 10 and provider.made == 0
+    assert items.Item(0) == "item0000990" and provider.made == 3
+
+# user-013: hardware scrolling
+
+def test_log_appends_scroll_in_hardware():
+    root = Widget(0, 0, 20, 6)
+    log = root.Add(LogView(0, 1, 20, 4))
+    root.Add(Label("status", 0, 5, 20, align = "left"))
+    vt, state = widgetScreen(root)
+    for i in range(4):
+        log.Append(f"line {i}")
+    state.Update(0)
+    log.Append("line 4")
+    state.Update(0)
+    data = vt.frames[-1]
+    assert [vt.Line(y).strip() for y in range(1, 6)] == ["line 1", "line 2", "line 3", "line 4", "status"]
+    assertShows(vt, Terminal.screen.back)
+    # one scroll and the new line instead of four repainted lines
+    assert data["bytes"] < 30
+
+def test_scroll_keeps_cells_outside_columns():
+    vt, screen = VirtualTerminal(12, 6), Screen(12, 6)
+    for y in range(6):
+        screen.back.PutString(0, y, "|" + str(y) * 10 + "|")
+    flush(screen, vt)
+    screen.ScrollRegion(1, 4, 1, 1, 11)
+    flush(screen, vt)
+    assertShows(vt, screen.back)
+    assert vt.Line(1) == "|" + "2" * 10 + "|" and vt.Line(4) == "|          |"
+    screen.ScrollRegion(1, 4, -2)
+    flush(screen, vt)
+    assertShows(vt, screen.back)
+    assert vt.Line(3) == "|" + "2" * 10 + "|"
+
+def test_scroll_escapes():
+    assert Terminal.SetScrollRegion(1, 4, gen = True).rstrip("\0") == "\x1b[2;5r"
+    assert Terminal.ScrollUp(2, gen = True).rstrip("\0") == "\x1b[2S"
+    assert Terminal.ScrollDown(gen = True).rstrip("\0") == "\x1b[1T"
+
+# user-014: threaded writer
+
+class GatedTerminal(VirtualTerminal):
+    # a terminal whose writes block until the test opens the gate
+    def __init__(self, *args, **kwargs):
+        from threading import Event
+        super().__init__(*args, **kwargs)
+        self.entered, self.gate = Event(), Event()
+        self.data = []
+        self.error = None
+
+    def Write(self, data: bytes):
+        self.entered.set()
+        assert self.gate.wait(5)
+        if self.error:
+            raise self.error
+        self.data.append(data)
+        return super().Write(data)
+
+def test_writer_coalesces_frames_behind_a_slow_write():
+    vt = GatedTerminal(10, 1)
+    writer = Writer(vt, 1, sync = False)
+    writer.Start()
+    writer.Write(b"a")
+    assert vt.entered.wait(5)
+    writer.Write(b"b")
+    assert writer.Busy()
+    writer.Write(b"c")
+    vt.gate.set()
+    writer.Stop()
+    # order is kept, the frames that queued up went out in one write
+    assert vt.data == [b"a", b"bc"]
+    assert (writer.frames, writer.coalesced) == (2, 1)
+    assert vt.Line(0).startswith("abc")
+
+def test_writer_wraps_frames_in_synchronized_output():
+    vt = GatedTerminal(10, 1)
+    vt.gate.set()
+    writer = Writer(vt)
+    writer.Start()
+    writer.Write(b"x")
+    writer.Stop()
+    assert vt.data == [b"\x1b[?2026hx\x1b[?2026l"]
+    assert vt.modes == {"?2026": False}
+
+def test_writer_error_is_raised_to_the_program():
+    vt = GatedTerminal(10, 1)
+    vt.error = OSError("gone")
+    vt.gate.set()
+    writer = Writer(vt)
+    writer.Start()
+    writer.Write(b"x")
+    waitFor(lambda: not writer.running)
+    with pytest.raises(OSError):
+        writer.Write(b"y")
+    with pytest.raises(OSError):
+        writer.Stop()
+
+def test_busy_writer_skips_frames():
+    vt = GatedTerminal(10, 1)
+    Terminal.Use(vt)
+    screen = Screen(10, 1)
+    Terminal.Attach(screen)
+    writer = Terminal.StartWriter(1, sync = False)
+    for text in ["a", "b", "c", "d"]:
+        screen.x = 0
+        screen.Write(text)
+        Terminal.Flush()
+        if text == "a":
+            assert vt.entered.wait(5)
+    # "b" waits behind "a", "c" and "d" are skipped while the queue is full
+    assert writer.dropped == 2 and writer.deferred
+    vt.gate.set()
+    waitFor(lambda: not writer.Busy())
+    Terminal.Flush()
+    Terminal.StopWriter()
+    assert vt.Line(0)[0] == "d" and len(vt.data) == 3
+
+# user-015: hosted sessions
+
+async def waitForAsync(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.001)
+
+async def readUntil(reader: asyncio.StreamReader, text: bytes, timeout: float = 5):
+    data = b""
+    while not text in data:
+        chunk = await asyncio.wait_for(reader.read(65536), timeout)
+        assert chunk, "connection closed"
+        data += chunk
+    return data
+
+class Recipient(ProgramState):
+    def __init__(self, received: list):
+        self.received = received
+
+    def Keypress(self, key: str):
+        self.received.append(key)
+
+@pytest.mark.parametrize("fps", [None, 0])
+def test_hosted_session_receives_input(fps):
+    received = []
+    server = SessionServer(lambda: (Program(20, 5, "h", fps = fps), Recipient(received)), 40, 12, telnet = False)
+    home = Session.current
+    async def main():
+        listener = await server.Serve()
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"abc")
+        await waitForAsync(lambda: len(received) == 3)
+        writer.write(b"\x1b")
+        await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        listener.close()
+    asyncio.run(main())
+    assert received == ["a", "b", "c"]
+    assert not server.sessions and Session.current is home
+
+def test_readme_example_is_hosted():
+    # the hosting example of the README, without the line that serves forever
+    code = open(os.path.join(root, "README.md"), encoding = "utf-8").read().split("class Kiosk")[1].split("SessionServer(session)")[0]
+    example = {}
+    exec("from winter import *\nclass Kiosk" + code, example)
+    server = SessionServer(example["session"], telnet = False)
+    async def main():
+        listener = await server.Serve()
+        reader, writer = await asyncio.open_connection("127.0.0.1", listener.sockets[0].getsockname()[1])
+        await readUntil(reader, b"Hello from your own session!")
+        writer.write(b"\x1b")
+        await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        listener.close()
+    asyncio.run(main())
+
+def test_telnet_commands_are_stripped():
+    server = SessionServer(None, 80, 24)
+    backend, pending = StreamConsole(lambda data: None), [b""]
+    data = bytes((255, 251, 1)) + b"a" + bytes((255, 250, 31, 0, 100, 0))
+    assert server.Telnet(backend, pending, data) == b"a"
+    # a window size report split across reads
+    assert server.Telnet(backend, pending, bytes((30, 255, 240)) + b"\xff\xffb\r\0") == b"\xffb\r"
+    assert (backend.width, backend.height) == (100, 30) and pending == [b""]
+
+def test_sessions_keep_their_own_terminal():
+    first, second = VirtualTerminal(10, 1), VirtualTerminal(10, 1)
+    home = Session.current
+    try:
+        a, b = Session(first).Activate(), Session(second)
+        Terminal.Print(Terminal.EnableStyle("bold", gen = True) + "one")
+        Input.queue.append("x")
+        b.Activate()
+        assert Terminal.backend is second and not Input.queue and Terminal.pen is None
+        Terminal.Print("two")
+        Terminal.Flush()
+        a.Activate()
+        Terminal.Flush()
+    finally:
+        home.Activate()
+    assert first.Line(0).startswith("one") and first.Cell(0, 0)[1] == Terminal.ParseSGR("1")
+    assert second.Line(0).startswith("two") and second.Cell(0, 0)[1] == Terminal.defaultPen
+    assert list(a.queue) == ["x"]
+
+@pytest.mark.skipif(os.name == "nt", reason = "needs a pty")
+def test_pty_session_hangs_up():
+    server = SessionServer(lambda: (Program(20, 5, "p", fps = 0), ProgramState()), 40, 12)
+    async def main():
+        path = await server.OpenPty()
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        try:
+            os.write(fd, b"\x1b")
+            loop, data = asyncio.get_running_loop(), b""
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(loop.run_in_executor(None, os.read, fd, 65536), 5)
+                except OSError:
+                    break
+                if not chunk:
+                    break
+                data += chunk
+            # the window was drawn and the client got a hangup once the program ended, output
+            # the client hadn't read yet may go with it
+            assert "╔".encode() in data
+            await waitForAsync(lambda: not server.sessions)
+        finally:
+            os.close(fd)
+    asyncio.run(main())
+
+# user-016: async programs
+
+class Slow(ProgramState):
+    # an async handler that yields to the loop a few times before it's done
+    def __init__(self, program: Program):
+        self.program, self.log = program, []
+
+    async def Keypress(self, key: str):
+        self.log.append(key + "<")
+        for _ in range(3):
+            await asyncio.sleep(0)
+        self.log.append(key + ">")
+        if key == "b":
+            self.program.Exit()
+
+def test_async_keypresses_run_in_order():
+    program, vt = headless(keys = ["a", "b", "c"], fps = 0)
+    vt.batch = 1
+    state = Slow(program)
+    asyncio.run(program.RunAsync(state))
+    # b waits for a to finish, c is never handled
+    assert state.log == ["a<", "a>", "b<", "b>"]
+    assert vt.modes["?25"]
+
+class Crashing(ProgramState):
+    async def Update(self, dt: float):
+        await asyncio.sleep(0)
+        raise RuntimeError("async failure")
+
+def test_async_exception_ends_the_program(capsys):
+    program, vt = headless(fps = 0)
+    asyncio.run(program.RunAsync(Crashing()))
+    assert "async failure" in capsys.readouterr().out
+    assert vt.modes["?25"] and Terminal.screen is None and not program.tasks
+
+def test_async_hooks_need_run_async(capsys):
+    program, vt = headless(keys = ["a"], fps = 0)
+    program.Run(Slow(program))
+    assert "async state hooks require Program.RunAsync" in capsys.readouterr().out
+    assert vt.modes["?25"]
+
+# user-017: background jobs
+
+class Waking(VirtualTerminal):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wakes = 0
+
+    def Wake(self):
+        self.wakes += 1
+
+def test_job_results_are_delivered_on_the_main_loop():
+    from threading import Event, get_ident
+    vt = Waking(22, 7)
+    Terminal.Use(vt)
+    program = Program(20, 5, "T")
+    program.sizePollInterval = 0
+    program.Begin(Counter())
+    gate, results = Event(), []
+    program.Submit(lambda: gate.wait(5) and get_ident(), then = results.append)
+    program.Submit(lambda: gate.wait(5) and 1 / 0, error = lambda e: results.append(type(e)))
+    program.Step()
+    assert results == [] and program.Busy()
+    gate.set()
+    # the waiting loop is woken for each finished job
+    waitFor(lambda: vt.wakes == 2)
+    assert results == []
+    program.Step()
+    assert ZeroDivisionError in results and get_ident() not in results and len(results) == 2
+    assert not program.Busy() and not program.jobs
+    program.Finish()
+
+def test_unhandled_job_error_is_raised_on_the_main_loop():
+    program, vt = headless()
+    program.Begin(Counter())
+    program.Submit(lambda: 1 / 0)
+    waitFor(lambda: program.finished)
+    with pytest.raises(ZeroDivisionError):
+        program.Step()
+    program.Abort()
+
+def test_jobs_of_a_left_state_are_dropped():
+    from threading import Event
+    program, vt = headless()
+    program.Begin(Counter())
+    gate, results = Event(), []
+    program.Submit(gate.wait, 5, then = results.append)
+    program.SwitchState(Counter())
+    gate.set()
+    waitFor(lambda: program.finished)
+    program.Step()
+    assert results == [] and not program.jobs
+    program.Finish()
+
+def test_spinner_gives_the_title_back(clock):
+    from threading import Event
+    vt = VirtualTerminal(22, 7)
+    Terminal.Use(vt)
+    # the spinner lands on the right half of a wide character
+    program = Program(20, 5, "a界界界界界界界")
+    program.sizePollInterval = 0
+    program.Begin(Counter())
+    title = vt.Line(0)
+    gate = Event()
+    program.Submit(gate.wait, 5)
+    program.Step()
+    spinning = vt.Line(0)
+    assert spinning != title and spinning[-4:-2] in [f"{c} " for c in program.spinner]
+    assertShows(vt, program.screen.back)
+    clock.Advance(program.spinnerInterval)
+    program.Step()
+    assert vt.Line(0) != spinning
+    gate.set()
+    waitFor(lambda: program.finished)
+    program.Step()
+    assert vt.Line(0) == title
+    assertShows(vt, program.screen.back)
+    program.Finish()
+
+@pytest.mark.skipif(os.name == "nt", reason = "needs a pty")
+def test_wake_interrupts_a_console_wait():
+    from select import select
+    master, slave = os.openpty()
+    console = PosixConsole(slave, slave)
+    try:
+        console.Start()
+        console.Wake()
+        # returns for the wake without input, and takes the wake byte so the next wait blocks again
+        assert not console.Wait(5)
+        assert not select([console.wakeFDs[0]], [], [], 0)[0]
+    finally:
+        console.Stop()
+        os.close(master)
+        os.close(slave)
+
+# user-018: timers
+
+def test_after_fires_once(clock):
+    program, vt = headless(fps = 0)
+    program.Begin(Counter())
+    fired = []
+    t = program.After(0.5, fired.append, "a")
+    program.Step()
+    assert fired == [] and program.Timeout() == 0.5
+    clock.Advance(0.5)
+    program.Step()
+    clock.Advance(5)
+    program.Step()
+    assert fired == ["a"] and t.cancelled and program.Timeout() is None
+    program.Finish()
+
+def test_every_skips_missed_ticks(clock):
+    program, vt = headless(fps = 0)
+    program.Begin(Counter())
+    ticks = []
+    t = program.Every(0.25, lambda: ticks.append(clock()))
+    clock.Advance(0.25)
+    program.Step()
+    # a loop that fell behind gets one tick, not a burst
+    clock.Advance(1)
+    program.Step()
+    assert ticks == [1000.25, 1001.25] and program.Timeout() == 0.25
+    t.Cancel()
+    clock.Advance(1)
+    program.Step()
+    assert len(ticks) == 2
+    program.Finish()
+
+def test_callbacks_can_schedule_and_cancel(clock):
+    program, vt = headless(fps = 0)
+    program.Begin(Counter())
+    fired = []
+    later = program.After(0.5, fired.append, "later")
+    program.After(0.25, lambda: (later.Cancel(), program.After(0, fired.append, "now")))
+    clock.Advance(1)
+    program.Step()
+    assert fired == ["now"]
+    program.Finish()
+
+def test_cancelled_timers_are_compacted(clock):
+    program, vt = headless(fps = 0)
+    program.Begin(Counter())
+    timers = [program.After(10 + i, print) for i in range(100)]
+    for t in timers[:90]:
+        t.Cancel()
+    assert len(program.timers) < 50
+    assert program.Timeout() == 100
+    program.Finish()
+
+def test_timers_end_with_their_state(clock):
+    program, vt = headless(fps = 0)
+    program.Begin(Counter())
+    fired = []
+    program.Every(0.25, fired.append, "every")
+    program.After(0.25, fired.append, "after")
+    # a timer without a state outlives switches, like the demo's ledger commits
+    program.After(0.25, fired.append, "detached").state = None
+    program.SwitchState(Counter())
+    clock.Advance(0.5)
+    program.Step()
+    assert fired == ["detached"]
+    program.Finish()
+
+# user-019: input coalescing
+
+class Typing(Counter):
+    def __init__(self):
+        super().__init__()
+        self.texts = []
+
+    def Text(self, text: str):
+        self.texts.append(text)
+
+def test_input_limit_keeps_text_and_the_kill_key():
+    program = Program(10, 3)
+    keys = program.Coalesce(list("1234567890" * 30))
+    assert len(keys) == 300 and program.droppedKeys == 0
+    keys = program.Coalesce(["down"] * 300 + list("ab") + ["escape"])
+    assert keys.count("down") == 255 and keys[-3:] == ["a", "b", "escape"]
+    program.inputLimit = 2
+    assert program.Coalesce(["escape", "up", "a", "down", "left"]) == ["a", "down", "left", "escape"]
+    program.dropPolicy = "newest"
+    assert program.Coalesce(["up", "a", "down", "left"]) == ["up", "a", "down"]
+
+def test_repeated_keys_are_cut():
+    program = Program(10, 3)
+    program.repeatLimit = 2
+    assert program.Coalesce(["down"] * 10 + ["a"] * 3 + ["up"]) == ["down", "down", "a", "a", "a", "up"]
+    assert program.droppedKeys == 8
+
+def test_typed_text_is_merged_for_text_states():
+    program = Program(10, 3, killKey = "q")
+    assert program.Coalesce(list("hi")) == ["h", "i"]
+    program.currentState = Typing()
+    keys = program.Coalesce(["h", "i", "space", "!", "enter", "x", PasteEvent("yo"), "a", "q", "b"])
+    assert keys == ["hi !", "enter", "x", "yo", "a", "q", "b"]
+    assert [type(key) for key in keys] == [TextEvent, str, TextEvent, PasteEvent, TextEvent, str, TextEvent]
+
+def test_printable_kill_key_ends_the_program():
+    program, vt = headless(keys = ["a", "b", "q", "c"], killKey = "q", fps = 0)
+    state = Typing()
+    program.Run(state)
+    assert state.texts == ["ab"] and state.keys == []
+
+# user-020: paste and text editing
+
+def test_chunked_paste_survives_escape_timeouts():
+    decoder = KeyDecoder()
+    text = ("line\r" * 2000).encode()
+    data = KeyDecoder.pasteStart + text + KeyDecoder.pasteEnd + b"x"
+    keys = []
+    for i in range(0, len(data), 4096):
+        keys += decoder.Feed(data[i:i + 4096])
+        # what a backend does when no more input comes within the escape timeout
+        keys += decoder.Feed(final = True)
+    assert len(keys) == 2
+    assert type(keys[0]) == PasteEvent and keys[0] == text.decode()
+    assert keys[1] == "x"
+
+def test_lost_paste_end_is_let_out(clock):
+    decoder = KeyDecoder()
+    assert decoder.Feed(KeyDecoder.pasteStart + b"abc", final = True) == []
+    clock.Advance(decoder.pasteTimeout / 2)
+    assert decoder.Feed(final = True) == []
+    clock.Advance(decoder.pasteTimeout / 2)
+    assert decoder.Feed(final = True) == ["abc"] and not decoder.Pending()
+
+def test_gap_buffer_edits():
+    buffer = GapBuffer("hello", 2)
+    buffer.Move(0)
+    buffer.Insert(">> ")
+    buffer.Move(100)
+    buffer.Insert(" world")
+    assert str(buffer) == ">> hello world" and buffer.cursor == len(buffer) == 14
+    buffer.Move(3)
+    buffer.Delete(-5)
+    buffer.Delete(1)
+    assert str(buffer) == ">> world" and buffer.cursor == 2
+    assert buffer.Slice(1, 5) == "> wo" and buffer[3] == "w"
+
+def test_text_input_filters_edits():
+    field = TextInput("pin", validate = lambda text: len(text) <= 4, accept = str.isdigit)
+    for key in "1a2":
+        field.Keypress(key)
+    assert field.value == "12"
+    assert not field.Insert("345") and field.Insert("34")
+    assert field.value == "1234"
+    field.Keypress("left")
+    field.Keypress("backspace")
+    assert field.value == "124" and field.cursor == 2
+    limited = TextInput("n", maxLength = 5)
+    assert limited.Insert("line one\r\nline two") and limited.value == "line "
+
+def test_long_text_input_draws_only_what_shows(monkeypatch):
+    screen = Screen(40, 1)
+    field = TextInput("v", "", 0, 0, 20)
+    field.Insert("x" * 50000)
+    calls = [0]
+    width = winter.charWidth
+    def counted(c: str):
+        calls[0] += 1
+        return width(c)
+    monkeypatch.setattr(winter, "charWidth", counted)
+    field.Draw(screen, 0, 0)
+    # the work is bounded by the field's width, not the text's length
+    assert 0 < calls[0] < 200
+    assert "".join(screen.back.chars[0][:20]) == "v: " + "x" * 16 + " "
+
+# user-021: canvas
+
+needsNumpy = pytest.mark.skipif(winter.np is None, reason = "needs numpy")
+
+def paintedCanvas(depth: int):
+    canvas = Canvas(0, 0, 3, 2, depth)
+    canvas.pixels[0] = (255, 0, 0)
+    canvas.pixels[1] = (0, 0, 255)
+    canvas.pixels[2:] = (0, 200, 0)
+    return canvas
+
+@needsNumpy
+@pytest.mark.parametrize("depth, top, bottom", [(24, (0, "38;2;255;0;0", "48;2;0;0;255"), (0, "38;2;0;200;0", "48;2;0;200;0")),
+                                                (8, (0, "38;5;196", "48;5;21"), (0, "38;5;40", "48;5;40")),
+                                                (4, (0, "91", "44"), (0, "32", "42"))])
+def test_canvas_cells_take_the_nearest_colors(depth, top, bottom):
+    screen = Screen(4, 3)
+    paintedCanvas(depth).Blit(screen, 1, 1)
+    # two pixels a cell, a cell whose halves match is a space in the background color
+    assert screen.back.chars[1] == [" ", "▀", "▀", "▀"] and screen.back.chars[2] == [" "] * 4
+    assert screen.back.pens[1] == [Terminal.defaultPen] + [top] * 3
+    assert screen.back.pens[2] == [Terminal.defaultPen] + [bottom] * 3
+
+@needsNumpy
+def test_canvas_render_matches_blit():
+    canvas = paintedCanvas(8)
+    canvas.pixels[:, 1] = (255, 255, 0)
+    screen, vt = Screen(5, 4), VirtualTerminal(5, 4)
+    canvas.Blit(screen, 2, 1)
+    vt.Write(canvas.Render(2, 1).encode())
+    assertShows(vt, screen.back)
+
+@needsNumpy
+def test_sparkline_scales_the_last_values():
+    canvas = Canvas(0, 0, 4, 2)
+    canvas.Sparkline([9, 0, 1, 2, 3], (255, 255, 255))
+    filled = canvas.pixels[..., 0] == 255
+    assert filled.sum(0).tolist() == [0, 1, 3, 4]
+    canvas.Sparkline([], (255, 255, 255), (1, 2, 3))
+    assert (canvas.pixels == (1, 2, 3)).all()
+
+# user-022: layers
+
+class Decorated(ProgramState):
+    def __init__(self, program: Program):
+        self.program, self.statics = program, 0
+
+    def Static(self, layer: Layer):
+        self.statics += 1
+        layer.Print(1, 1, "static")
+
+    def Enter(self, prev: ProgramState):
+        self.program.Clear()
+        Terminal.Flush()
+
+def test_static_layer_is_drawn_once():
+    program, vt = headless()
+    state, other = Decorated(program), Decorated(program)
+    program.Begin(state)
+    program.SwitchState(other)
+    program.SwitchState(state)
+    assert vt.Line(1).startswith("║static") and state.statics == 1
+    program.InvalidateStatic()
+    program.SwitchState(state)
+    assert state.statics == 2
+    program.Finish()
+
+def test_overlay_reprint_uses_composited_row():
+    vt, screen = VirtualTerminal(10, 1), Screen(10, 1)
+    screen.back.PutString(0, 0, "abcdefghij")
+    flush(screen, vt)
+    layer = Layer(2, 1, 2, 0)
+    layer.Print(0, 0, "##")
+    screen.overlays.append(layer)
+    flush(screen, vt)
+    screen.back.Put(1, 0, "B")
+    screen.back.Put(4, 0, "E")
+    flush(screen, vt)
+    assert vt.Line(0) == "aB##Efghij"
+    screen.overlays.remove(layer)
+    flush(screen, vt)
+    assert vt.Line(0) == "aBcdEfghij"
+
+def test_higher_overlays_cover_lower_ones():
+    program, vt = headless()
+    program.Begin(Counter())
+    top, bottom = Layer(3, 1, 2, 2, 5), Layer(5, 1, 1, 2, 1)
+    top.Print(0, 0, "TOP")
+    bottom.Print(0, 0, "-----")
+    program.AddOverlay(top)
+    program.AddOverlay(bottom)
+    assert vt.Line(2)[1:6] == "-TOP-"
+    program.RemoveOverlay(top)
+    assert vt.Line(2)[1:6] == "-----"
+    program.RemoveOverlay(bottom)
+    assert vt.Line(2)[1:6] == "     "
+    program.Finish()
+
+def test_toast_is_removed_after_its_duration(clock):
+    program, vt = headless(fps = 0)
+    program.Begin(Counter())
+    before = vt.Text()
+    program.Toast("hi", 0.5)
+    assert "│hi│" in vt.Text()
+    # it outlives the state that showed it
+    program.SwitchState(Counter())
+    clock.Advance(0.25)
+    program.Step()
+    assert "│hi│" in vt.Text() and program.Timeout() == 0.25
+    clock.Advance(0.25)
+    program.Step()
+    assert vt.Text() == before and not program.screen.overlays
+    program.Finish()
+
+# user-023: recordings
+
+class Echo(ProgramState):
+    def Keypress(self, key: str):
+        Terminal.SetCursorPosition(1, 1)
+        Terminal.Print(key)
+        Terminal.Flush()
+
+def record(path: str, compress: bool, keys: list, clock: Clock = None):
+    program, vt = headless(keys = keys, fps = 0)
+    vt.batch = 1
+    program.Record(path, compress)
+    program.Begin(Echo())
+    while vt.keys:
+        if clock:
+            clock.Advance(0.5)
+        program.Step()
+    return (program, vt)
+
+def crash(program: Program):
+    # the process dies: the file is closed by the OS, nothing else happens
+    program.recorder.file.close()
+    Terminal.recorder = Input.recorder = None
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_recording_round_trip(tmp_path, compress, clock):
+    path = str(tmp_path / "session.wrec")
+    program, vt = record(path, compress, list("abc"), clock)
+    # everything up to the last frame is on disk before Stop, as after a crash
+    assert Recording(path).Keys() == list("abc")
+    program.Exit()
+    program.Finish()
+    recording = Recording(path)
+    assert recording.Size() == (22, 7)
+    assert recording.Batches() == [["a"], ["b"], ["c"]]
+    assert [t for (t, _) in recording.Frames()][-4:-1] == [0.5, 1.0, 1.5]
+    replay = VirtualTerminal(22, 7)
+    recording.Play(replay, speed = 0)
+    assert replay.Text() == vt.Text()
+
+def test_recorded_data_may_contain_the_header(tmp_path):
+    path = str(tmp_path / "session.wrec")
+    header = "WREC\x02\x00"
+    program, vt = record(path, False, [PasteEvent(header), header[0]])
+    program.Exit()
+    program.Finish()
+    keys = Recording(path).Keys()
+    assert keys == [header, "W"] and type(keys[0]) == PasteEvent
+
+def test_crashed_session_is_repaired(tmp_path):
+    path = str(tmp_path / "session.wrec")
+    program, _ = record(path, False, list("ab"))
+    crash(program)
+    # a torn last block
+    with open(path, "ab") as f:
+        f.write(b"\x40\x01")
+    program, vt = record(path, False, list("xy"))
+    program.Exit()
+    program.Finish()
+    recording = Recording(path)
+    assert len(recording.segments) == 2
+    assert recording.Keys() == list("abxy")
+    (segments, end) = Recording.Scan(open(path, "rb").read())
+    assert [closed for (_, _, _, closed) in segments] == [True, True] and end == os.path.getsize(path)
+
+def test_other_files_are_not_recordings(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_bytes(b"just some text, long enough for a header")
+    with pytest.raises(ValueError, match = "is not a recording"):
+        Recording(str(path))
+    with pytest.raises(ValueError):
+        Recorder(str(path)).Start()
+
+def test_replay_drives_a_program(tmp_path):
+    path = str(tmp_path / "session.wrec")
+    program, vt = record(path, True, list("ab") + ["escape"])
+    program.Finish()
+    replayed = Recording(path).Replay(headless(fps = 0)[0], Echo())
+    assert replayed.Text() == vt.Text()
+
+# user-024: ledger
+
+def test_ledger_persists_and_recovers(tmp_path):
+    demo = loadScript("atm-demo")
+    path = str(tmp_path / "ledger")
+    ledger = demo.Account.all = demo.Ledger().Open(path)
+    for name in "abc":
+        demo.Account.Register(name, 1234, 1234)
+    demo.Account.Find("a").Deposit(100.0)
+    demo.Account.Find("a").Send("b", 30.0)
+    demo.Account.Remove(demo.Account.Find("c"), True)
+    ledger.Commit()
+    # a crash: the journal isn't compacted and ends with a torn record
+    with open(path + ".journal", "ab") as f:
+        f.write(b'["B", "a", 5')
+    ledger = demo.Account.all = demo.Ledger().Open(path)
+    assert [(a.name, a.balance) for a in ledger.Slice(0, 10)] == [("a", 70.0), ("b", 30.0)]
+    assert ledger.Names(0, 10) == ["a", "b"]
+    ledger.Close()
+    assert os.path.getsize(path + ".journal") == 0
+    ledger = demo.Account.all = demo.Ledger().Open(path)
+    assert ledger.Find("b").balance == 30.0 and not ledger.Exists("c")
+    ledger.Close()
+
+def test_ledger_commits_a_group_once(tmp_path):
+    demo = loadScript("atm-demo")
+    path = str(tmp_path / "ledger")
+    ledger = demo.Account.all = demo.Ledger().Open(path)
+    ledger.commitInterval = 3600
+    scheduled = []
+    ledger.schedule = lambda delay, callback: scheduled.append(callback)
+    for name in "abc":
+        demo.Account.Register(name, 1234, 1234)
+    # one timer for the whole group, nothing is written before it fires
+    assert len(scheduled) == 1 and os.path.getsize(path + ".journal") == 0
+    scheduled.pop()()
+    assert os.path.getsize(path + ".journal") > 0 and not ledger.pending
+    demo.Account.Find("a").Deposit(5.0)
+    assert len(scheduled) == 1
+    ledger.Close()
+
+def test_ledger_compacts_into_a_snapshot(tmp_path):
+    demo = loadScript("atm-demo")
+    path = str(tmp_path / "ledger")
+    ledger = demo.Account.all = demo.Ledger().Open(path)
+    ledger.compactAfter = 3
+    for name in "abcd":
+        demo.Account.Register(name, 1234, 1234)
+    demo.Account.Remove(demo.Account.Find("b"), True)
+    ledger.Commit()
+    assert os.path.getsize(path + ".journal") == 0 and ledger.records == 0
+    demo.Account.Find("d").Deposit(1.0)
+    ledger.Commit()
+    ledger.journal.close()
+    ledger = demo.Account.all = demo.Ledger().Open(path)
+    assert ledger.Names(0, 10) == ["a", "c", "d"] and ledger.Find("d").balance == 1.0
+    ledger.Close()
+
+# user-025: resizing
+
+class Resizing(Counter):
+    def __init__(self):
+        super().__init__()
+        self.sizes = []
+
+    def Resize(self, width: int, height: int):
+        self.sizes.append((width, height))
+
+def settle(program: Program, clock: Clock):
+    # one size poll that sees the change, then the end of its debounce
+    for _ in range(2):
+        clock.Advance(program.sizePollInterval + program.resizeDelay)
+        program.Step()
+
+def windowLines(program: Program):
+    return ["".join(row) for row in program.screen.back.chars]
+
+def test_wide_character_across_crop_edge():
+    screen = Screen(10, 2)
+    screen.columns, screen.rows = 5, 2
+    screen.back.PutString(0, 0, "abcd")
+    screen.back.chars[0][4:6] = ["界", '']
+    vt = VirtualTerminal(5, 2)
+    flush(screen, vt)
+    assert vt.Line(0) == "abcd "
+    vt.Resize(10, 2)
+    screen.Viewport(10, 2)
+    flush(screen, vt)
+    assert vt.Line(0).startswith("abcd界")
+
+def test_fixed_window_is_cropped_and_restored(clock):
+    program, vt = headless(20, 4, fps = 0)
+    vt.Resize(30, 8)
+    program.sizePollInterval = 0.25
+    program.Begin(Counter())
+    full = windowLines(program)
+    assert [vt.Line(y)[:22] for y in range(6)] == full
+    vt.Resize(15, 4)
+    settle(program, clock)
+    assert [vt.Line(y) for y in range(4)] == [line[:15] for line in full[:4]]
+    vt.Resize(30, 8)
+    settle(program, clock)
+    assert [vt.Line(y)[:22] for y in range(6)] == full
+    program.Finish()
+
+def test_resize_storm_is_applied_once(clock):
+    program, vt = headless(10, 3, fps = 0)
+    vt.Resize(30, 8)
+    program.resizable, program.sizePollInterval = True, 0.0625
+    state = Resizing()
+    program.Begin(state)
+    assert (program.width, program.height) == (28, 6)
+    for width in range(40, 28, -2):
+        vt.Resize(width, 9)
+        clock.Advance(0.0625)
+        program.Step()
+    assert state.sizes == []
+    clock.Advance(program.resizeDelay)
+    program.Step()
+    # the window reflows to the final size, its border is drawn again
+    assert state.sizes == [(28, 7)]
+    assert vt.Line(0).startswith("╔") and vt.Line(0).endswith("╗")
+    assert vt.Line(8) == "╚" + "═" * 28 + "╝"
+    assertShows(vt, program.screen.back)
+    # a storm that doesn't end is still applied resizeMaxDelay after it started
+    for i in range(12):
+        vt.Resize(24 + i % 2 * 2, 9)
+        clock.Advance(0.0625)
+        program.Step()
+    assert len(state.sizes) >= 2
+    program.Finish()
@@ -26,44 +26,771 @@ SOFTWARE.
 
 from __future__ import annotations
 from math import floor, ceil
-from time import perf_counter as timer
-from msvcrt import kbhit, getch
-from re import finditer
+from time import perf_counter as timer, sleep, time as wallClock
+from re import compile as regex
 from traceback import format_exc
+from collections import deque
+from functools import lru_cache
+from unicodedata import east_asian_width, combining
+from array import array
+from bisect import bisect_left
+from weakref import WeakKeyDictionary
+from heapq import heappush, heappop, heapify
+from threading import Thread, Condition, current_thread, main_thread
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+import json, asyncio, signal, struct, zlib
+from shutil import get_terminal_size
+import os, sys
+if os.name == "nt":
+    from msvcrt import kbhit, getch
+else:
+    import termios
+    from select import select
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-def centerString(s: str, width: int, pad: str = ' '):
-    ls = len(s)
-    for m in finditer('\x1b.*?\0', s):
-        ls -= len(m.group(0))
+escapeSequence = regex('\x1b\\[[0-?]*[ -/]*[@-~]\0?|\x1b[@-Z\\\\-_]\0?|\0')
+
+@lru_cache(maxsize = None)
+def charWidth(c: str):
+    if c < ' ' or combining(c):
+        return 0
+    return 2 if east_asian_width(c) in ('W', 'F') else 1
+
+def splitString(s: str):
+    tokens, i = [], 0
+    for m in escapeSequence.finditer(s):
+        tokens += [(c, charWidth(c)) for c in s[i:m.start()]]
+        tokens.append((m.group(0), 0))
+        i = m.end()
+    tokens += [(c, charWidth(c)) for c in s[i:]]
+    return tokens
+
+@lru_cache(maxsize = 4096)
+def measureString(s: str):
+    if s.isascii() and s.isprintable():
+        return len(s)
+    return sum(w for (_, w) in splitString(s))
+
+def cropString(s: str, start: int, width: int, pad: str = ' '):
+    out, col, end = [], 0, start + width
+    for (t, w) in splitString(s):
+        if w == 0:
+            if t[0] == '\x1b' or start < col <= end:
+                out.append(t)
+        elif start <= col and col + w <= end:
+            out.append(t)
+        elif col < end and start < col + w:
+            # the half of a wide character the crop cuts off is padded, so the result is still width columns
+            out.append(pad * (min(col + w, end) - max(col, start)))
+        col += w
+    return "".join(out)
+
+@lru_cache(maxsize = 4096)
+def layoutString(s: str, width: int, align: str = "center", pad: str = ' '):
+    ls = measureString(s)
     if ls > width:
-        return s[floor((ls - width) / 2):][:width]
+        start = 0 if align in ("left", "justify") else ls - width if align == "right" else floor((ls - width) / 2)
+        if s.isascii() and s.isprintable():
+            return s[start:start + width]
+        return cropString(s, start, width, pad[0])
     elif ls < width:
+        if align == "left":
+            return s + pad[0] * (width - ls)
+        elif align == "right":
+            return pad[0] * (width - ls) + s
+        elif align == "justify":
+            words = s.split(' ')
+            if len(words) < 2:
+                return s + pad[0] * (width - ls)
+            gaps = len(words) - 1
+            extra, rest = divmod(width - ls, gaps)
+            return "".join(w + ' ' * (1 + extra + (i < rest)) for (i, w) in enumerate(words[:-1])) + words[-1]
         return pad[0] * floor((width - ls) / 2) + s + pad[0] * ceil((width - ls) / 2)
     else:
         return s
 
+def centerString(s: str, width: int, pad: str = ' '):
+    return layoutString(s, width, "center", pad)
+
+def leftString(s: str, width: int, pad: str = ' '):
+    return layoutString(s, width, "left", pad)
+
+def rightString(s: str, width: int, pad: str = ' '):
+    return layoutString(s, width, "right", pad)
+
+def justifyString(s: str, width: int, pad: str = ' '):
+    return layoutString(s, width, "justify", pad)
+
+class FrameBuffer:
+    def __init__(self, width: int, height: int, char: str = ' ', pen: tuple = None):
+        self.width, self.height = width, height
+        self.Fill(char, pen)
+
+    def Fill(self, char: str = ' ', pen: tuple = None):
+        pen = pen or Terminal.defaultPen
+        if not hasattr(self, "chars"):
+            self.chars, self.pens = [], []
+        self.chars[:] = [[char] * self.width for _ in range(self.height)]
+        self.pens[:] = [[pen] * self.width for _ in range(self.height)]
+
+    def FillRect(self, x: int, y: int, width: int, height: int, char: str = ' ', pen: tuple = None):
+        pen = pen or Terminal.defaultPen
+        x0, x1 = max(x, 0), min(x + width, self.width)
+        for row in range(max(y, 0), min(y + height, self.height)):
+            self.chars[row][x0:x1] = [char] * (x1 - x0)
+            self.pens[row][x0:x1] = [pen] * (x1 - x0)
+
+    def Put(self, x: int, y: int, char: str, pen: tuple = None):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self.chars[y][x] = char
+            self.pens[y][x] = pen or Terminal.defaultPen
+
+    def Get(self, x: int, y: int):
+        return (self.chars[y][x], self.pens[y][x])
+
+    def PutString(self, x: int, y: int, s: str, pen: tuple = None):
+        for (i, c) in enumerate(s):
+            self.Put(x + i, y, c, pen)
+
+    def CopyRow(self, other: FrameBuffer, y: int):
+        self.chars[y] = other.chars[y][:]
+        self.pens[y] = other.pens[y][:]
+
+    def Resize(self, width: int, height: int, char: str = ' ', pen: tuple = None):
+        # keeps the cells both sizes share, new ones are filled with char
+        pen = pen or Terminal.defaultPen
+        for rows, fill in ((self.chars, char), (self.pens, pen)):
+            del rows[height:]
+            for row in rows:
+                del row[width:]
+                row += [fill] * (width - len(row))
+            rows += [[fill] * width for _ in range(height - len(rows))]
+        self.width, self.height = width, height
+
+class Screen:
+    def __init__(self, width: int, height: int, emulate: bool = False):
+        self.width, self.height = width, height
+        # emulate: behave like the terminal itself (line feeds scroll) instead of recording scrolls for Diff
+        self.emulate = emulate
+        self.region = (0, height - 1)
+        self.scrolls = []
+        self.back = FrameBuffer(width, height)
+        self.front = FrameBuffer(width, height)
+        self.x = self.y = 0
+        self.pen = Terminal.defaultPen
+        self.passthrough = []
+        self.terminalPen = None
+        self.cursorX = self.cursorY = None
+        # size of the terminal, Diff doesn't draw the cells outside it
+        self.columns = self.rows = None
+        self.invalid = True
+        # layers composited over the back buffer by Diff, lowest z first
+        self.overlays: list[Layer] = []
+
+    def Invalidate(self):
+        self.invalid = True
+
+    def Clear(self):
+        self.back.Fill(' ', self.pen)
+
+    def Resize(self, width: int, height: int):
+        # the back buffer keeps its content, front cells the terminal doesn't show yet are unknown (None) so Diff draws them
+        self.back.Resize(width, height)
+        self.front.Resize(width, height, None)
+        self.width, self.height = width, height
+        self.region = (0, height - 1)
+
+    def Viewport(self, columns: int, rows: int):
+        # the terminal was resized: lines that fit both sizes are left alone by terminals that crop as well as by
+        # those that rewrap, so only cells uncovered by growing are redrawn; cutting into the screen redraws everything
+        oldColumns, oldRows = self.columns or self.width, self.rows or self.height
+        self.columns, self.rows = columns, rows
+        if columns >= oldColumns and rows >= oldRows:
+            for y in range(self.height):
+                x = 0 if y >= oldRows else oldColumns
+                if 0 < x < self.width and self.back.chars[y][x] == '':
+                    # the terminal only showed half of this wide character
+                    x -= 1
+                if x < self.width:
+                    self.front.chars[y][x:] = [None] * (self.width - x)
+        elif self.width > columns or self.height > rows:
+            self.Invalidate()
+
+    def SetCursorPosition(self, x: int, y: int):
+        self.x, self.y = x, y
+
+    def ScrollRegion(self, top: int, bottom: int, n: int = 1, left: int = 0, right: int = None):
+        # n > 0 scrolls the rows top..bottom up, n < 0 down; the terminal always scrolls whole lines,
+        # so cells outside left..right are kept in the back buffer and repaired by Diff
+        top, bottom = max(top, 0), min(bottom, self.height - 1)
+        if top >= bottom or n == 0:
+            return
+        Screen.ShiftRows(self.back, top, bottom, n, left, right)
+        if not self.emulate and not self.invalid:
+            self.scrolls.append((top, bottom, n))
+
+    @staticmethod
+    def ShiftRows(buffer: FrameBuffer, top: int, bottom: int, n: int, left: int = 0, right: int = None):
+        left, right = max(left, 0), buffer.width if right is None else min(right, buffer.width)
+        rows = range(top, bottom + 1) if n > 0 else range(bottom, top - 1, -1)
+        for y in rows:
+            src = y + n
+            if top <= src <= bottom:
+                buffer.chars[y][left:right] = buffer.chars[src][left:right]
+                buffer.pens[y][left:right] = buffer.pens[src][left:right]
+            else:
+                buffer.chars[y][left:right] = [' '] * (right - left)
+                buffer.pens[y][left:right] = [Terminal.defaultPen] * (right - left)
+
+    def Write(self, s: str):
+        i, n = 0, len(s)
+        chars, pens = self.back.chars, self.back.pens
+        while i < n:
+            c = s[i]
+            if c == '\x1b':
+                i = self.Escape(s, i + 1)
+                continue
+            elif c == '\n':
+                if self.emulate and self.y == self.region[1]:
+                    self.ScrollRegion(self.region[0], self.region[1], 1)
+                    self.x = 0
+                else:
+                    self.x, self.y = 0, self.y + 1
+            elif c == '\r':
+                self.x = 0
+            elif c == '\b':
+                self.x = max(self.x - 1, 0)
+            elif c >= ' ':
+                w = 1 if c < '\u0300' else charWidth(c)
+                x, y = self.x, self.y
+                if 0 <= y < self.height:
+                    row = chars[y]
+                    if w == 0:
+                        if 0 < x <= self.width:
+                            row[x - 1 if row[x - 1] or x < 2 else x - 2] += c
+                    elif 0 <= x and x + w <= self.width:
+                        if x > 0 and row[x] == '':
+                            row[x - 1] = ' '
+                        if x + w < self.width and row[x + w] == '':
+                            row[x + w] = ' '
+                        row[x] = c
+                        pens[y][x] = self.pen
+                        if w == 2:
+                            row[x + 1] = ''
+                            pens[y][x + 1] = self.pen
+                self.x += w
+            i += 1
+
+    def Escape(self, s: str, i: int):
+        n = len(s)
+        if i >= n:
+            return i
+        if s[i] in ']P_^':
+            # OSC (window title, ...) and other strings run to BEL or ST, the terminal handles them
+            j = i + 1
+            while j < n and s[j] != '\x07' and s[j:j + 2] != '\x1b\\':
+                j += 1
+            end = min(j + (1 if s[j:j + 1] == '\x07' else 2), n)
+            self.passthrough.append(s[i - 1:end])
+            return end
+        if s[i] != '[':
+            # two byte escapes (ESC 7, ESC 8, ESC =, ...), charset designators take an intermediate byte first
+            j = i
+            while j < n - 1 and ' ' <= s[j] <= '/':
+                j += 1
+            self.passthrough.append(s[i - 1:j + 1])
+            return j + 1
+        j = i + 1
+        while j < n and '0' <= s[j] <= '?':
+            j += 1
+        while j < n and ' ' <= s[j] <= '/':
+            j += 1
+        if j >= n or not '@' <= s[j] <= '~':
+            return j
+        params, final, end = s[i + 1:j], s[j], j + 1
+        if end < n and s[end] == '\0':
+            end += 1
+        if params[:1] in ('?', '=', '>', '<'):
+            self.passthrough.append(s[i - 1:j + 1])
+            return end
+        if final == 'm':
+            self.pen = Terminal.ParseSGR(params, self.pen)
+        elif final in 'Hf':
+            y, _, x = params.partition(';')
+            self.x, self.y = int(x or 1) - 1, int(y or 1) - 1
+        elif final == 'J':
+            if params == '2':
+                self.back.Fill(' ', self.pen)
+            else:
+                self.passthrough.append(s[i - 1:j + 1])
+        elif final == 'K':
+            if 0 <= self.y < self.height:
+                if params in ('', '0'):
+                    self.back.FillRect(self.x, self.y, self.width - self.x, 1, ' ', self.pen)
+                elif params == '1':
+                    self.back.FillRect(0, self.y, self.x + 1, 1, ' ', self.pen)
+                else:
+                    self.back.FillRect(0, self.y, self.width, 1, ' ', self.pen)
+        elif final in 'ABCD':
+            d = int(params or 1)
+            if final == 'A':
+                self.y -= d
+            elif final == 'B':
+                self.y += d
+            elif final == 'C':
+                self.x += d
+            else:
+                self.x -= d
+        elif final == 'r':
+            top, _, bottom = params.partition(';')
+            self.region = (int(top or 1) - 1, int(bottom or self.height) - 1)
+            self.x = self.y = 0
+        elif final in 'ST':
+            self.ScrollRegion(self.region[0], self.region[1], int(params or 1) * (1 if final == 'S' else -1))
+        else:
+            self.passthrough.append(s[i - 1:j + 1])
+        return end
+
+    def Diff(self, out: list = None):
+        out = [] if out is None else out
+        if self.passthrough:
+            out += self.passthrough
+            if any(e[-1] not in 'hl' for e in self.passthrough):
+                self.cursorX = self.cursorY = None
+            self.passthrough = []
+        back, front = self.back, self.front
+        if self.invalid:
+            out.append("\x1b[0m\x1b[2J\x1b[H")
+            front.Fill(' ', Terminal.defaultPen)
+            self.terminalPen = Terminal.defaultPen
+            self.cursorX = self.cursorY = 0
+            self.invalid = False
+            self.scrolls.clear()
+        # the part of the screen the terminal shows
+        width, height = min(self.width, self.columns or self.width), min(self.height, self.rows or self.height)
+        if self.scrolls and (width < self.width or height < self.height):
+            # the terminal would scroll cells that are cut off, the rows are redrawn instead
+            self.scrolls.clear()
+        if self.scrolls:
+            # hardware scrolls: set the region, scroll (new lines take the default pen) and reset the region, which homes the cursor
+            out.append(Terminal.Transition(self.terminalPen, Terminal.defaultPen))
+            self.terminalPen = Terminal.defaultPen
+            for (top, bottom, n) in self.scrolls:
+                out.append(f"\x1b[{top + 1};{bottom + 1}r\x1b[{abs(n)}{'S' if n > 0 else 'T'}")
+                Screen.ShiftRows(front, top, bottom, n)
+            out.append("\x1b[r")
+            self.scrolls.clear()
+            self.cursorX = self.cursorY = 0
+        pen, cx, cy = self.terminalPen, self.cursorX, self.cursorY
+        columns = self.columns or self.width
+        overlays = [layer for layer in self.overlays if layer.visible]
+        for y in range(height):
+            bc, bp, fc, fp = back.chars[y], back.pens[y], front.chars[y], front.pens[y]
+            composed = False
+            for layer in overlays:
+                if layer.y <= y < layer.y + layer.height:
+                    if not composed:
+                        bc, bp, composed = bc[:], bp[:], True
+                    layer.ComposeRow(y - layer.y, bc, bp)
+            if bc == fc and bp == fp:
+                continue
+            x = 0
+            while x < width:
+                if bc[x] == fc[x] and bp[x] == fp[x]:
+                    x += 1
+                    continue
+                if x > 0 and bc[x] == '':
+                    # the right half of a wide character changed, its left half is printed even if it didn't
+                    x -= 1
+                if x != cx or y != cy:
+                    out.append(self.Move(cx, cy, x, y, pen, bc, bp))
+                start = x
+                while x < width and (x == start or bc[x] != fc[x] or bp[x] != fp[x]):
+                    if x + 1 == width < self.width and bc[x + 1] == '':
+                        # a wide character cut by the edge of the terminal would wrap, Viewport has it drawn once the terminal grows
+                        x = width
+                        break
+                    if bp[x] != pen:
+                        out.append(Terminal.Transition(pen, bp[x]))
+                        pen = bp[x]
+                    out.append(bc[x])
+                    x += 1
+                cx, cy = (x, y) if x < columns else (None, None)
+            if width < self.width:
+                fc[:width], fp[:width] = bc[:width], bp[:width]
+            elif composed:
+                front.chars[y], front.pens[y] = bc, bp
+            else:
+                front.CopyRow(back, y)
+        self.terminalPen, self.cursorX, self.cursorY = pen, cx, cy
+        return out
+
+    maxReprint = 12
+
+    def Move(self, cx: int, cy: int, x: int, y: int, pen: tuple, chars: list = None, pens: list = None):
+        # cheapest of absolute CUP, relative moves, CR/LF and re-printing cells the terminal already shows;
+        # chars and pens are row y as drawn (with overlays composited), the back buffer's row by default
+        best = f"\x1b[{y + 1};{x + 1}H" if x else f"\x1b[{y + 1}H" if y else "\x1b[H"
+        if cx is None or cy is None:
+            return best
+        dy = y - cy
+        vertical = "" if dy == 0 else ("\x1b[B" if dy == 1 else f"\x1b[{dy}B") if dy > 0 else ("\x1b[A" if dy == -1 else f"\x1b[{-dy}A")
+        options = [(vertical, cx)]
+        if cx:
+            options.append(("\r" + vertical, 0))
+            if 0 < dy <= 2:
+                options.append(("\r\n" * dy, 0))
+        cost = len(best)
+        for (prefix, fromX) in options:
+            if len(prefix) >= cost:
+                continue
+            move = prefix + self.Horizontal(fromX, x, y, pen, cost - len(prefix), chars, pens)
+            if len(move.encode()) < cost:
+                best, cost = move, len(move.encode())
+        return best
+
+    def Horizontal(self, fromX: int, x: int, y: int, pen: tuple, limit: int, chars: list = None, pens: list = None):
+        d = x - fromX
+        if d == 0:
+            return ""
+        elif d < 0:
+            return "\b" * -d if -d < 4 else f"\x1b[{-d}D"
+        move = "\x1b[C" if d == 1 else f"\x1b[{d}C"
+        if d <= self.maxReprint and d < limit:
+            if chars is None:
+                chars, pens = self.back.chars[y], self.back.pens[y]
+            if chars[fromX] != '' and all(p == pen for p in pens[fromX:x]):
+                text = "".join(chars[fromX:x])
+                if len(text.encode()) < len(move):
+                    return text
+        return move
+
+class Layer:
+    # cells stamped under a screen's content (static layers) or composited over it (overlays), None chars are transparent
+    def __init__(self, width: int, height: int, x: int = 0, y: int = 0, z: int = 0):
+        self.x, self.y, self.z = x, y, z
+        self.buffer = FrameBuffer(width, height, None)
+        self.visible = True
+        self.painter: Screen = None
+        self.spans: list = None
+
+    @property
+    def width(self):
+        return self.buffer.width
+
+    @property
+    def height(self):
+        return self.buffer.height
+
+    def Print(self, x: int, y: int, text: str):
+        # text with escape sequences, like Terminal.Print
+        if not self.painter:
+            self.painter = Screen(self.width, self.height)
+            self.painter.back = self.buffer
+        self.painter.x, self.painter.y, self.painter.pen = x, y, Terminal.defaultPen
+        self.painter.Write(text)
+        self.spans = None
+
+    def Fill(self, char: str = None, pen: tuple = None):
+        self.buffer.Fill(char, pen)
+        self.spans = None
+
+    def FillRect(self, x: int, y: int, width: int, height: int, char: str = None, pen: tuple = None):
+        self.buffer.FillRect(x, y, width, height, char, pen)
+        self.spans = None
+
+    def Spans(self):
+        # opaque runs of every row, kept until the layer is drawn on again
+        if self.spans is None:
+            self.spans = []
+            for row in self.buffer.chars:
+                spans, x = [], 0
+                while x < len(row):
+                    if row[x] is None:
+                        x += 1
+                        continue
+                    start = x
+                    while x < len(row) and row[x] is not None:
+                        x += 1
+                    spans.append((start, x))
+                self.spans.append(spans)
+        return self.spans
+
+    def ComposeRow(self, row: int, chars: list, pens: list):
+        width = len(chars)
+        lc, lp = self.buffer.chars[row], self.buffer.pens[row]
+        for (a, b) in self.Spans()[row]:
+            x0, x1 = max(self.x + a, 0), min(self.x + b, width)
+            if x0 < x1:
+                chars[x0:x1] = lc[x0 - self.x:x1 - self.x]
+                pens[x0:x1] = lp[x0 - self.x:x1 - self.x]
+
+    def Stamp(self, buffer: FrameBuffer):
+        for row in range(max(-self.y, 0), min(self.height, buffer.height - self.y)):
+            self.ComposeRow(row, buffer.chars[self.y + row], buffer.pens[self.y + row])
+
+    def Erase(self, buffer: FrameBuffer):
+        # blanks the cells Stamp covers
+        for (row, spans) in enumerate(self.Spans()):
+            for (a, b) in spans:
+                buffer.FillRect(self.x + a, self.y + row, b - a, 1)
+
+class Output:
+    def __init__(self, backend: Backend = None, encoding: str = "utf-8"):
+        self.backend = backend
+        self.encoding = encoding
+        self.chunks = []
+        self.bytesWritten = 0
+        self.writes = 0
+        self.flushes = 0
+        self.lastFrameBytes = 0
+
+    def Write(self, s: str):
+        self.chunks.append(s)
+
+    def Clear(self):
+        self.chunks.clear()
+
+    def Pending(self):
+        return len(self.chunks) > 0
+
+    def Flush(self):
+        if not self.chunks:
+            return 0
+        data = "".join(self.chunks).encode(self.encoding, "replace")
+        self.chunks.clear()
+        self.flushes += 1
+        self.lastFrameBytes = len(data)
+        return self.Emit(data)
+
+    def Emit(self, data: bytes):
+        if Terminal.recorder:
+            Terminal.recorder.Output(data)
+        self.writes += (self.backend or Terminal.backend).Write(data)
+        self.bytesWritten += len(data)
+        return len(data)
+
+def writeAll(fd: int, data: bytes):
+    view, sent, calls = memoryview(data), 0, 0
+    while sent < len(data):
+        sent += os.write(fd, view[sent:])
+        calls += 1
+    return calls
+
+class Writer:
+    # writes frames on a background thread, so a slow output never blocks input handling or Update;
+    # at most depth frames wait behind the one being written, later ones are appended to the last
+    syncBegin, syncEnd = b"\x1b[?2026h", b"\x1b[?2026l"
+    retryInterval = 0.002
+    def __init__(self, backend: Backend, depth: int = 1, sync: bool = True):
+        self.backend = backend
+        self.depth = max(depth, 1)
+        # wrap every write in synchronized output mode (DEC 2026), terminals without it ignore the mode
+        self.sync = sync
+        self.queue = deque()
+        self.condition = Condition()
+        self.thread: Thread = None
+        self.running = False
+        self.error: Exception = None
+        # set by Terminal.Flush when a frame was skipped because the queue was full
+        self.deferred = False
+        self.writes = self.frames = self.coalesced = self.dropped = 0
+
+    def Start(self):
+        self.running = True
+        self.thread = Thread(target = self.Run, name = "winter-writer", daemon = True)
+        self.thread.start()
+
+    def Stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def Busy(self):
+        with self.condition:
+            return len(self.queue) >= self.depth
+
+    def Write(self, data: bytes):
+        if self.error:
+            raise self.error
+        with self.condition:
+            if len(self.queue) >= self.depth:
+                self.queue[-1] += data
+                self.coalesced += 1
+            else:
+                self.queue.append(data)
+            self.condition.notify_all()
+        return 0
+
+    def Run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait()
+                if not self.queue:
+                    break
+                data = b"".join(self.queue)
+                self.coalesced += len(self.queue) - 1
+                self.queue.clear()
+            if self.sync:
+                data = self.syncBegin + data + self.syncEnd
+            try:
+                self.writes += self.backend.Write(data)
+            except Exception as e:
+                self.error = e
+                break
+            self.frames += 1
+        with self.condition:
+            self.queue.clear()
+            self.running = False
+
 class Terminal:
-    buffer = ""
+    backend: Backend = None
+    output = Output()
+    writer: Writer = None
+    recorder: Recorder = None
+    hold = held = False
+    screen: Screen = None
+    profiler: Profiler = None
+    # pen requested by the program / pen the terminal currently has (None = unknown)
+    pen = outputPen = None
 
     @staticmethod
     def Print(s = '', end = ''):
-        Terminal.buffer += s + end
+        if Terminal.screen:
+            Terminal.screen.Write(s + end)
+        else:
+            Terminal.WriteStyled(s + end)
+
+    @staticmethod
+    def WriteStyled(s: str):
+        out = Terminal.output
+        if not '\x1b' in s and not '\0' in s:
+            if s:
+                Terminal.SyncPen()
+                out.Write(s)
+            return
+        i = 0
+        for m in escapeSequence.finditer(s):
+            if m.start() > i:
+                Terminal.SyncPen()
+                out.Write(s[i:m.start()])
+            e = m.group(0).rstrip('\0')
+            if e[:2] == '\x1b[' and e[-1] == 'm':
+                Terminal.pen = Terminal.ParseSGR(e[2:-1], Terminal.pen or Terminal.defaultPen)
+            elif e:
+                Terminal.SyncPen()
+                out.Write(e)
+            i = m.end()
+        if i < len(s):
+            Terminal.SyncPen()
+            out.Write(s[i:])
+
+    @staticmethod
+    def SyncPen():
+        if Terminal.pen is not None and Terminal.pen != Terminal.outputPen:
+            Terminal.output.Write(Terminal.Transition(Terminal.outputPen, Terminal.pen))
+            Terminal.outputPen = Terminal.pen
     
     @staticmethod
     def EmptyBuffer():
-        Terminal.buffer = ""
+        Terminal.output.Clear()
+
+    @staticmethod
+    def Hold():
+        # Flush calls are postponed until Release, so a batch of events renders once
+        Terminal.hold = True
+
+    @staticmethod
+    def Release(flush: bool = True):
+        held, Terminal.hold, Terminal.held = Terminal.held, False, False
+        if held and flush:
+            Terminal.Flush()
 
     @staticmethod
     def Flush():
-        print(Terminal.buffer)
-        Terminal.EmptyBuffer()
+        if Terminal.hold:
+            Terminal.held = True
+            return
+        profiler = Terminal.profiler
+        if profiler:
+            profiler.Begin("flush")
+            if Terminal.screen and (profiler.hud or profiler.hudLayer):
+                profiler.DrawHUD(Terminal.screen)
+        writer = Terminal.writer
+        if Terminal.screen and writer and writer.Busy():
+            # the output can't keep up: skip this frame, the next Flush diffs the newest state instead
+            writer.deferred = True
+            writer.dropped += 1
+            if profiler:
+                profiler.End()
+            return
+        if writer:
+            writer.deferred = False
+        if Terminal.screen:
+            Terminal.screen.Diff(Terminal.output.chunks)
+        else:
+            Terminal.SyncPen()
+        n = Terminal.output.Flush()
+        if profiler:
+            profiler.bytes += n
+            profiler.End()
+
+    @staticmethod
+    def Use(backend: Backend):
+        Terminal.StopWriter()
+        Terminal.backend = Input.device = backend
+        Terminal.output = Output(backend)
+        Terminal.pen = Terminal.outputPen = None
+
+    @staticmethod
+    def Size():
+        return Terminal.backend.Size()
+
+    @staticmethod
+    def StartWriter(depth: int = 1, sync: bool = True):
+        Terminal.StopWriter()
+        Terminal.writer = Writer(Terminal.output.backend or Terminal.backend, depth, sync)
+        Terminal.output.backend = Terminal.writer
+        Terminal.writer.Start()
+        return Terminal.writer
+
+    @staticmethod
+    def StopWriter():
+        # waits until everything queued is written
+        writer, Terminal.writer = Terminal.writer, None
+        if writer:
+            Terminal.output.backend = writer.backend
+            writer.Stop()
+
+    @staticmethod
+    def Attach(screen: Screen):
+        Terminal.SyncPen()
+        Terminal.screen = screen
+        screen.terminalPen = Terminal.outputPen
+        screen.columns, screen.rows = Terminal.Size()
+
+    @staticmethod
+    def Detach():
+        if Terminal.screen:
+            Terminal.pen = Terminal.outputPen = Terminal.screen.terminalPen
+        Terminal.screen = None
 
     @staticmethod
     def Escape(s: str, inst = False, gen = False):
         if gen:
             return f"\x1b[{s}\0"
         elif inst:
-            print(end=f"\x1b[{s}")
+            Terminal.output.Emit(f"\x1b[{s}".encode())
         else:
             Terminal.Print(f"\x1b[{s}")
 
@@ -81,18 +808,10 @@ class Terminal:
 
     @staticmethod
     def GetCursorPosition():
+        if Terminal.screen:
+            return (Terminal.screen.x + 1, Terminal.screen.y + 1)
         Terminal.Escape("6n", True)
-        x = y = ''
-        if getch() == b'\x1b' and getch() == b'[':
-            c = getch()
-            while c != b';':
-                y += c.decode()
-                c = getch()
-            c = getch()
-            while c != b'R':
-                x += c.decode()
-                c = getch()
-            return (int(x), int(y))
+        return Input.device.CursorPosition()
 
     @staticmethod
     def HomeCursor(**kwargs):
@@ -110,6 +829,22 @@ class Terminal:
     def LoadCursorPosition(**kwargs):
         return Terminal.Escape(" 8", **kwargs)
 
+    @staticmethod
+    def SetScrollRegion(top: int, bottom: int, **kwargs):
+        return Terminal.Escape(f"{top + 1};{bottom + 1}r", **kwargs)
+
+    @staticmethod
+    def ResetScrollRegion(**kwargs):
+        return Terminal.Escape("r", **kwargs)
+
+    @staticmethod
+    def ScrollUp(n: int = 1, **kwargs):
+        return Terminal.Escape(f"{n}S", **kwargs)
+
+    @staticmethod
+    def ScrollDown(n: int = 1, **kwargs):
+        return Terminal.Escape(f"{n}T", **kwargs)
+
     @staticmethod
     def HideCursor(**kwargs):
         return Terminal.Escape("?25l", **kwargs)
@@ -129,6 +864,11 @@ class Terminal:
         "strikethrough": ("9", "29"),
     }
 
+    styleBits = {int(on): 1 << i for (i, (on, off)) in enumerate(style.values())}
+    styleCodes = [(bit, str(code)) for (code, bit) in styleBits.items()]
+    styleOffCodes = [(1 << i, off) for (i, (on, off)) in enumerate(style.values())]
+    styleSets = (lambda codes: [[on for (bit, on) in codes if mask & bit] for mask in range(1 << len(codes))])(styleCodes)
+
     colors = {
         "black": ("30", "40"),
         "red": ("31", "41"),
@@ -141,6 +881,100 @@ class Terminal:
         "default": ("39", "49")
     }
 
+    defaultPen = (0, None, None)
+
+    sgrCache = {}
+    transitions = {}
+    cacheSize = 65536
+
+    @staticmethod
+    def ParseSGR(params: str, pen: tuple = defaultPen):
+        key = (params, pen)
+        if key in Terminal.sgrCache:
+            return Terminal.sgrCache[key]
+        if len(Terminal.sgrCache) >= Terminal.cacheSize:
+            Terminal.sgrCache.clear()
+        new = Terminal.sgrCache[key] = Terminal.ApplySGR(params, pen)
+        return new
+
+    @staticmethod
+    def ApplySGR(params: str, pen: tuple):
+        attrs, fg, bg = pen
+        codes = params.split(';') if params else ['0']
+        i = 0
+        while i < len(codes):
+            c = int(codes[i]) if codes[i].isdigit() else 0
+            if c == 0:
+                attrs, fg, bg = Terminal.defaultPen
+            elif 1 <= c <= 9:
+                attrs |= Terminal.styleBits.get(c, 0)
+            elif c == 22:
+                attrs &= ~(Terminal.styleBits[1] | Terminal.styleBits[2])
+            elif 23 <= c <= 29:
+                attrs &= ~Terminal.styleBits.get(c - 20, 0)
+            elif 30 <= c <= 37 or 90 <= c <= 97:
+                fg = str(c)
+            elif 40 <= c <= 47 or 100 <= c <= 107:
+                bg = str(c)
+            elif c == 39:
+                fg = None
+            elif c == 49:
+                bg = None
+            elif c in (38, 48):
+                n = 3 if codes[i + 1:i + 2] == ['5'] else 5 if codes[i + 1:i + 2] == ['2'] else 1
+                color = ';'.join(codes[i:i + n])
+                if c == 38:
+                    fg = color
+                else:
+                    bg = color
+                i += n - 1
+            i += 1
+        return (attrs, fg, bg)
+
+    @staticmethod
+    def SGR(pen: tuple):
+        attrs, fg, bg = pen
+        codes = ['0'] + Terminal.styleSets[attrs]
+        if fg:
+            codes.append(fg)
+        if bg:
+            codes.append(bg)
+        return f"\x1b[{';'.join(codes)}m"
+
+    @staticmethod
+    def Transition(old: tuple, new: tuple):
+        key = (old, new)
+        t = Terminal.transitions.get(key)
+        if t is None:
+            if len(Terminal.transitions) >= Terminal.cacheSize:
+                Terminal.transitions.clear()
+            t = Terminal.transitions[key] = Terminal.ComputeTransition(old, new)
+        return t
+
+    @staticmethod
+    def ComputeTransition(old: tuple, new: tuple):
+        if old == new:
+            return ""
+        reset = Terminal.SGR(new)
+        if old is None:
+            return reset
+        (oa, of, ob), (na, nf, nb) = old, new
+        removed, added, codes = oa & ~na, na & ~oa, []
+        intensity = Terminal.styleBits[1] | Terminal.styleBits[2]
+        if removed & intensity:
+            codes.append('22')
+            added |= na & intensity
+        for (bit, off) in Terminal.styleOffCodes:
+            if removed & bit & ~intensity:
+                codes.append(off)
+        codes += Terminal.styleSets[added]
+        if nf != of:
+            codes.append(nf or '39')
+        if nb != ob:
+            codes.append(nb or '49')
+        incremental = f"\x1b[{';'.join(codes)}m"
+        return incremental if len(incremental) < len(reset) else reset
+
     @staticmethod
     def EnableStyle(*args, **kwargs):
         return Terminal.Escape(f"{';'.join([Terminal.style.get(arg, ('',''))[0] for arg in args])}m", **kwargs)
@@ -236,19 +1070,1001 @@ class Input:
         b'\x1a': 'ctrl+z'
     }
 
+    sequences = {
+        b'\x1b[A': 'up',
+        b'\x1b[B': 'down',
+        b'\x1b[C': 'right',
+        b'\x1b[D': 'left',
+        b'\x1b[E': 'center',
+        b'\x1b[F': 'end',
+        b'\x1b[H': 'home',
+        b'\x1b[Z': 'shift+tab',
+        b'\x1bOA': 'up',
+        b'\x1bOB': 'down',
+        b'\x1bOC': 'right',
+        b'\x1bOD': 'left',
+        b'\x1bOE': 'center',
+        b'\x1bOF': 'end',
+        b'\x1bOH': 'home',
+        b'\x1bOP': 'f1',
+        b'\x1bOQ': 'f2',
+        b'\x1bOR': 'f3',
+        b'\x1bOS': 'f4',
+        b'\x1b[[A': 'f1', # linux console
+        b'\x1b[[B': 'f2',
+        b'\x1b[[C': 'f3',
+        b'\x1b[[D': 'f4',
+        b'\x1b[[E': 'f5',
+        b'\x1b[1~': 'home',
+        b'\x1b[2~': 'insert',
+        b'\x1b[3~': 'delete',
+        b'\x1b[4~': 'end',
+        b'\x1b[5~': 'pageup',
+        b'\x1b[6~': 'pagedown',
+        b'\x1b[7~': 'home',
+        b'\x1b[8~': 'end',
+        b'\x1b[11~': 'f1',
+        b'\x1b[12~': 'f2',
+        b'\x1b[13~': 'f3',
+        b'\x1b[14~': 'f4',
+        b'\x1b[15~': 'f5',
+        b'\x1b[17~': 'f6',
+        b'\x1b[18~': 'f7',
+        b'\x1b[19~': 'f8',
+        b'\x1b[20~': 'f9',
+        b'\x1b[21~': 'f10',
+        b'\x1b[23~': 'f11',
+        b'\x1b[24~': 'f12',
+        b'\x7f': 'backspace',
+        b'\n': 'enter'
+    }
+
+    modifiers = {
+        2: 'shift+',
+        3: 'alt+',
+        4: 'alt+shift+',
+        5: 'ctrl+',
+        6: 'ctrl+shift+',
+        7: 'ctrl+alt+',
+        8: 'ctrl+alt+shift+'
+    }
+
+    device = None
+    queue = deque()
+    recorder: Recorder = None
+
+    @staticmethod
+    def Start():
+        Input.device.Start()
+
+    @staticmethod
+    def Stop():
+        Input.device.Stop()
+
     @staticmethod
     def HasKeypress():
-        return kbhit()
+        return len(Input.queue) > 0 or Input.device.HasKeypress()
+
+    @staticmethod
+    def Wait(timeout: float = None):
+        return len(Input.queue) > 0 or Input.device.Wait(timeout)
+
+    @staticmethod
+    def GetKeypresses():
+        keys = list(Input.queue)
+        Input.queue.clear()
+        if Input.device.HasKeypress():
+            keys += Input.ReadDevice()
+        return keys
+
+    @staticmethod
+    def GetKeypress():
+        if not Input.queue and Input.device.HasKeypress():
+            Input.queue.extend(Input.ReadDevice())
+        if Input.queue:
+            return Input.queue.popleft()
+
+    @staticmethod
+    def ReadDevice():
+        keys = Input.device.Read()
+        if Input.recorder and keys:
+            Input.recorder.Keys(keys)
+        return keys
+
+class TextEvent(str):
+    # consecutive typed characters merged by Program.Coalesce, delivered to ProgramState.Text
+    pass
+
+class PasteEvent(TextEvent):
+    # text pasted in bracketed paste mode (\x1b[200~ ... \x1b[201~), decoded as one event
+    pass
+
+class KeyDecoder:
+    tries = {}
+    pasteStart, pasteEnd = b"\x1b[200~", b"\x1b[201~"
+    # final doesn't cut an open paste short, only one whose end marker hasn't come for pasteTimeout seconds
+    pasteTimeout = 1.0
+
+    def __init__(self, sequences: dict = None, codes: dict = None):
+        self.trie = KeyDecoder.Compile(sequences or Input.sequences, codes or Input.keycodes)
+        self.buffer = b""
+        self.fed = 0
 
     @staticmethod
-    def GetKeypress(codes: dict[bytes] = keycodes):
-        if kbhit():
-            ch = getch()
+    def Compile(sequences: dict, codes: dict):
+        key = (id(sequences), id(codes))
+        if key in KeyDecoder.tries:
+            return KeyDecoder.tries[key]
+        table = {c: k for (c, k) in codes.items() if type(k) == str and c != b'\x1b'}
+        table.update(sequences)
+        for (seq, name) in sequences.items():
+            if seq[:2] == b'\x1b[' and seq[-1:] in b'ABCDEFHPQRS' and not seq[2:-1]:
+                for (m, mod) in Input.modifiers.items():
+                    table[b'\x1b[1;%d' % m + seq[-1:]] = mod + name
+            elif seq[:2] == b'\x1b[' and seq[-1:] == b'~' and seq[2:-1].isdigit():
+                for (m, mod) in Input.modifiers.items():
+                    table[seq[:-1] + b';%d~' % m] = mod + name
+        for (m, mod) in Input.modifiers.items():
+            for (final, name) in zip(b'PQRS', ('f1', 'f2', 'f3', 'f4')):
+                table[b'\x1b[1;%d%c' % (m, final)] = mod + name
+        trie = {}
+        for (seq, name) in table.items():
+            node = trie
+            for b in seq[:-1]:
+                node = node.setdefault(b, {})
+            node[seq[-1]] = name
+        KeyDecoder.tries[key] = trie
+        return trie
+
+    @staticmethod
+    def CharSize(b: int):
+        return 1 if b < 0x80 else 2 if 0xc0 <= b < 0xe0 else 3 if 0xe0 <= b < 0xf0 else 4 if 0xf0 <= b < 0xf8 else 1
+
+    def Pending(self):
+        return len(self.buffer) > 0
+
+    def Feed(self, data: bytes = b"", final: bool = False):
+        now = timer()
+        if data:
+            self.fed = now
+        data = self.buffer + data if self.buffer else data
+        trie, keys, i, n = self.trie, [], 0, len(data)
+        while i < n:
+            if data[i] == 0x1b and data.startswith(KeyDecoder.pasteStart, i):
+                end = data.find(KeyDecoder.pasteEnd, i + 6)
+                if end < 0 and not (final and now - self.fed >= self.pasteTimeout):
+                    break
+                keys.append(PasteEvent(data[i + 6:n if end < 0 else end].decode(errors = "replace")))
+                i = n if end < 0 else end + 6
+                continue
+            node, j = trie, i
+            while j < n and type(node) == dict:
+                node = node.get(data[j])
+                j += 1
+            if type(node) == str:
+                keys.append(node)
+                i = j
+                continue
+            if node is not None and not final:
+                break
+            b = data[i]
+            if b == 0x1b:
+                if i + 1 >= n and not final:
+                    break
+                nb = data[i + 1] if i + 1 < n else None
+                if nb == 0x5b:
+                    k = i + 2
+                    while k < n and not 0x40 <= data[k] <= 0x7e:
+                        k += 1
+                    if k < n:
+                        i = k + 1
+                        continue
+                    if not final:
+                        break
+                elif nb is not None and nb != 0x1b:
+                    alt = trie.get(nb)
+                    if type(alt) == str:
+                        keys.append('alt+' + alt)
+                        i += 2
+                        continue
+                    elif nb >= 0x20:
+                        size = KeyDecoder.CharSize(nb)
+                        if i + 1 + size > n and not final:
+                            break
+                        ch = data[i + 1:i + 1 + size].decode(errors = "replace")
+                        keys.append('alt+' + ('space' if ch == ' ' else ch))
+                        i += 1 + size
+                        continue
+                keys.append('escape')
+                i += 1
+                continue
+            size = KeyDecoder.CharSize(b)
+            if i + size > n and not final:
+                break
+            keys.append(data[i:i + size].decode(errors = "replace"))
+            i += size
+        self.buffer = data[i:]
+        return keys
+
+class Backend:
+    def __init__(self, outFD: int = None, stream = None):
+        self.outFD, self.stream = outFD, stream
+
+    def Start(self):
+        pass
+
+    def Stop(self):
+        pass
+
+    def Size(self):
+        return tuple(get_terminal_size())
+
+    def Write(self, data: bytes):
+        if self.stream is not None:
+            self.stream.write(data)
+            self.stream.flush()
+            return 1
+        if self.outFD is not None:
+            return writeAll(self.outFD, data)
+        stream = sys.stdout
+        stream.flush()
+        if os.name != "nt":
+            try:
+                return writeAll(stream.fileno(), data)
+            except (AttributeError, OSError, ValueError):
+                pass
+        if hasattr(stream, "buffer"):
+            stream.buffer.write(data)
+            stream.buffer.flush()
+        else:
+            stream.write(data.decode("utf-8", "replace"))
+            stream.flush()
+        return 1
+
+    def HasKeypress(self):
+        return False
+
+    def Wait(self, timeout: float = None):
+        return False
+
+    def Wake(self):
+        # makes a pending Wait return, may be called from a signal handler
+        pass
+
+    def Read(self):
+        return []
+
+    def CursorPosition(self):
+        return None
+
+class WindowsConsole(Backend):
+    pollInterval = 0.005
+
+    def HasKeypress(self):
+        return kbhit()
+
+    def Wait(self, timeout: float = None):
+        deadline = None if timeout is None else timer() + timeout
+        while not kbhit():
+            if deadline is None:
+                sleep(self.pollInterval)
+            else:
+                left = deadline - timer()
+                if left <= 0:
+                    return False
+                sleep(min(left, self.pollInterval))
+        return True
+
+    def Read(self):
+        keys = []
+        while kbhit():
+            codes, ch = Input.keycodes, getch()
             k = codes.get(ch)
-            if type(k) == dict:
-                return Input.GetKeypress(k)
+            while type(k) == dict:
+                codes, ch = k, getch()
+                k = codes.get(ch)
+            keys.append(k or ch.decode(errors = "replace"))
+        return keys
+
+    def CursorPosition(self):
+        x = y = ''
+        if getch() == b'\x1b' and getch() == b'[':
+            c = getch()
+            while c != b';':
+                y += c.decode()
+                c = getch()
+            c = getch()
+            while c != b'R':
+                x += c.decode()
+                c = getch()
+            return (int(x), int(y))
+
+class PosixConsole(Backend):
+    escTimeout = 0.025
+    readSize = 65536
+    cursorReport = regex(rb'\x1b\[(\d+);(\d+)R')
+
+    def __init__(self, inFD: int = None, outFD: int = None, stream = None):
+        super().__init__(outFD, stream)
+        self.inFD = inFD
+        self.decoder = KeyDecoder()
+        self.keys = []
+        self.attrs = None
+        # self-pipe that Wake writes to, Wait selects on it along with the input
+        self.wakeFDs: tuple = None
+
+    def Start(self):
+        if self.inFD is None:
+            self.inFD = sys.stdin.fileno()
+        if self.attrs is None and os.isatty(self.inFD):
+            self.attrs = PosixConsole.RawMode(self.inFD)
+        if self.wakeFDs is None:
+            self.wakeFDs = os.pipe()
+            os.set_blocking(self.wakeFDs[1], False)
+
+    @staticmethod
+    def RawMode(fd: int):
+        # returns the previous attributes
+        attrs = termios.tcgetattr(fd)
+        mode = termios.tcgetattr(fd)
+        mode[0] &= ~(termios.BRKINT | termios.ICRNL | termios.INPCK | termios.ISTRIP | termios.IXON)
+        mode[3] &= ~(termios.ECHO | termios.ICANON | termios.IEXTEN | termios.ISIG)
+        mode[6][termios.VMIN], mode[6][termios.VTIME] = 1, 0
+        termios.tcsetattr(fd, termios.TCSAFLUSH, mode)
+        return attrs
+
+    def Stop(self):
+        if self.attrs is not None:
+            termios.tcsetattr(self.inFD, termios.TCSAFLUSH, self.attrs)
+            self.attrs = None
+        if self.wakeFDs is not None:
+            for fd in self.wakeFDs:
+                os.close(fd)
+            self.wakeFDs = None
+
+    def Readable(self, timeout: float = 0):
+        if self.inFD is None:
+            self.inFD = sys.stdin.fileno()
+        return len(select([self.inFD], [], [], timeout)[0]) > 0
+
+    def HasKeypress(self):
+        return len(self.keys) > 0 or self.decoder.Pending() or self.Readable()
+
+    def Wait(self, timeout: float = None):
+        if self.HasKeypress():
+            return True
+        if self.wakeFDs is None:
+            return self.Readable(timeout)
+        ready = select([self.inFD, self.wakeFDs[0]], [], [], timeout)[0]
+        if self.wakeFDs[0] in ready:
+            os.read(self.wakeFDs[0], 512)
+        return self.inFD in ready
+
+    def Wake(self):
+        if self.wakeFDs is not None:
+            try:
+                os.write(self.wakeFDs[1], b"\0")
+            except OSError:
+                pass
+
+    def Read(self):
+        keys, self.keys = self.keys, []
+        if self.Readable():
+            keys += self.decoder.Feed(os.read(self.inFD, self.readSize))
+        if self.decoder.Pending():
+            if self.Readable(self.escTimeout):
+                keys += self.decoder.Feed(os.read(self.inFD, self.readSize))
+            if self.decoder.Pending():
+                keys += self.decoder.Feed(final = True)
+        return keys
+
+    def CursorPosition(self, timeout: float = 0.5):
+        data, deadline = b"", timer() + timeout
+        while not self.cursorReport.search(data) and self.Readable(max(deadline - timer(), 0)):
+            data += os.read(self.inFD, self.readSize)
+        m = self.cursorReport.search(data)
+        if m:
+            data = data[:m.start()] + data[m.end():]
+        self.keys += self.decoder.Feed(data)
+        if m:
+            return (int(m.group(2)), int(m.group(1)))
+
+class VirtualTerminal(Backend):
+    def __init__(self, width: int = 80, height: int = 24, keys = (), batch: int = None, realtime: bool = False, batches = ()):
+        super().__init__()
+        self.width, self.height = width, height
+        self.screen = Screen(width, height, emulate = True)
+        self.decoder = KeyDecoder()
+        self.keys = deque(keys)
+        self.batch = batch
+        # sizes of the next reads, before batch applies
+        self.batches = deque(batches)
+        self.realtime = realtime
+        self.modes = {}
+        self.keepFrames = True
+        self.ResetStats()
+
+    def ResetStats(self):
+        self.bytes = self.escapes = self.flushes = 0
+        self.frames = []
+        self.readTime = None
+
+    def Size(self):
+        return (self.width, self.height)
+
+    def Write(self, data: bytes):
+        now = timer()
+        self.screen.Write(data.decode("utf-8", "replace"))
+        for e in self.screen.passthrough:
+            if e[-1] in 'hl':
+                self.modes[e[2:-1]] = e[-1] == 'h'
+        self.screen.passthrough.clear()
+        escapes = data.count(b'\x1b')
+        self.bytes += len(data)
+        self.escapes += escapes
+        self.flushes += 1
+        if self.keepFrames:
+            self.frames.append({"time": now, "bytes": len(data), "escapes": escapes, "latency": None if self.readTime is None else now - self.readTime})
+        self.readTime = None
+        return 1
+
+    def Resize(self, width: int, height: int):
+        # like a terminal that crops its lines: cells cut off are lost, uncovered ones are blank
+        self.screen.Resize(width, height)
+        self.width, self.height = width, height
+
+    def Send(self, *keys: str):
+        self.keys.extend(keys)
+
+    def SendBytes(self, data: bytes):
+        self.keys.extend(self.decoder.Feed(data, final = True))
+
+    def HasKeypress(self):
+        return len(self.keys) > 0
+
+    def Wait(self, timeout: float = None):
+        if not self.keys and self.realtime and timeout:
+            sleep(timeout)
+        return len(self.keys) > 0
+
+    def Read(self):
+        n = self.batches.popleft() if self.batches else len(self.keys) if self.batch is None else self.batch
+        n = min(n, len(self.keys))
+        keys = [self.keys.popleft() for _ in range(n)]
+        if keys and self.readTime is None:
+            self.readTime = timer()
+        return keys
+
+    def CursorPosition(self):
+        return (self.screen.x + 1, self.screen.y + 1)
+
+    def Cell(self, x: int, y: int):
+        return self.screen.back.Get(x, y)
+
+    def Line(self, y: int):
+        return "".join(self.screen.back.chars[y])
+
+    def Text(self):
+        return "\n".join(self.Line(y) for y in range(self.height))
+
+class StreamConsole(Backend):
+    # console of a hosted session: output goes to a write callable (an asyncio transport), input is fed by the host
+    def __init__(self, write, width: int = 80, height: int = 24):
+        super().__init__()
+        self.send = write
+        self.width, self.height = width, height
+        self.decoder = KeyDecoder()
+        self.keys = deque()
+
+    def Size(self):
+        return (self.width, self.height)
+
+    def Write(self, data: bytes):
+        self.send(data)
+        return 1
+
+    def Feed(self, data: bytes = b"", final: bool = False):
+        self.keys.extend(self.decoder.Feed(data, final))
+
+    def HasKeypress(self):
+        return len(self.keys) > 0
+
+    def Wait(self, timeout: float = None):
+        return len(self.keys) > 0
+
+    def Read(self):
+        keys = list(self.keys)
+        self.keys.clear()
+        return keys
+
+class Session:
+    # Terminal and Input keep the state of one console in class attributes, a Session holds its own copy
+    # of that state and Activate swaps it in, so many programs can share a process as long as they take turns
+    current: Session = None
+
+    def __init__(self, backend: Backend = None):
+        self.backend = backend
+        self.output = Output(backend)
+        self.screen: Screen = None
+        self.profiler: Profiler = None
+        self.writer: Writer = None
+        self.recorder: Recorder = None
+        self.pen = self.outputPen = None
+        self.queue = deque()
+
+    @staticmethod
+    def Capture():
+        session = Session.__new__(Session)
+        session.Save()
+        return session
+
+    def Save(self):
+        self.backend, self.output, self.screen = Terminal.backend, Terminal.output, Terminal.screen
+        self.profiler, self.writer, self.recorder = Terminal.profiler, Terminal.writer, Terminal.recorder
+        self.pen, self.outputPen = Terminal.pen, Terminal.outputPen
+        self.queue = Input.queue
+
+    def Load(self):
+        Terminal.backend = Input.device = self.backend
+        Terminal.output, Terminal.screen = self.output, self.screen
+        Terminal.profiler, Terminal.writer, Terminal.recorder = self.profiler, self.writer, self.recorder
+        Terminal.pen, Terminal.outputPen = self.pen, self.outputPen
+        Input.queue, Input.recorder = self.queue, self.recorder
+
+    def Activate(self):
+        if Session.current is not self:
+            if Session.current:
+                Session.current.Save()
+            self.Load()
+            Session.current = self
+        return self
+
+class SessionServer:
+    # hosts one Program per connection in a single asyncio process, factory() returns (program, state);
+    # a Program instance must not be shared between sessions and should not use Threaded()
+    IAC, SB, SE, NAWS = 255, 250, 240, 31
+    telnetHello = bytes((255, 251, 1, 255, 251, 3, 255, 253, 31)) # WILL ECHO, WILL SUPPRESS GO AHEAD, DO NAWS
+
+    def __init__(self, factory, width: int = 80, height: int = 24, telnet: bool = True):
+        self.factory = factory
+        self.width, self.height = width, height
+        self.telnet = telnet
+        self.sessions = set()
+        # the session of the process' own console, active whenever no hosted program is running
+        self.home = Session.current
+
+    async def Host(self, backend: StreamConsole, read):
+        # read() returns the next chunk of input, None once the client is gone
+        session = Session(backend).Activate()
+        self.sessions.add(session)
+        program, state = self.factory()
+        # the read outlives a timeout, cancelling it could lose the chunk it was about to return
+        reading = None
+        try:
+            program.Begin(state)
+            while not program.exit:
+                # a free-running program (fps = None) polls instead of spinning
+                timeout = program.Timeout() if program.fps is not None else program.pollInterval
+                if backend.decoder.Pending():
+                    timeout = PosixConsole.escTimeout if timeout is None else min(timeout, PosixConsole.escTimeout)
+                if not backend.keys:
+                    reading = reading or asyncio.ensure_future(read())
+                    await asyncio.wait((reading,), timeout = timeout)
+                    if reading.done():
+                        data, reading = reading.result(), None
+                        if data is None:
+                            program.Exit()
+                            break
+                        backend.Feed(data)
+                    elif backend.decoder.Pending():
+                        backend.Feed(final = True)
+                session.Activate()
+                program.Step()
+            session.Activate()
+            program.Finish()
+        except Exception:
+            session.Activate()
+            program.Abort()
+            print(format_exc(), file = sys.stderr)
+        finally:
+            if reading:
+                reading.cancel()
+            session.Activate()
+            Input.Stop()
+            self.sessions.discard(session)
+            self.home.Activate()
+
+    async def Connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        backend = StreamConsole(writer.write, self.width, self.height)
+        pending = [b""]
+        async def read():
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return None
+                if not self.telnet:
+                    return data
+                data = self.Telnet(backend, pending, data)
+                if data:
+                    return data
+        if self.telnet:
+            writer.write(self.telnetHello)
+        try:
+            await self.Host(backend, read)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def Telnet(self, backend: StreamConsole, pending: list, data: bytes):
+        # strips telnet commands from the input, window size reports (NAWS) resize the console
+        data, out, i = pending[0] + data, bytearray(), 0
+        while i < len(data):
+            c = data[i]
+            if c != self.IAC:
+                out.append(c)
+                i += 1
+                continue
+            if i + 1 >= len(data):
+                break
+            cmd = data[i + 1]
+            if cmd == self.IAC:
+                out.append(c)
+                i += 2
+            elif 251 <= cmd <= 254: # WILL, WONT, DO, DONT + option
+                if i + 2 >= len(data):
+                    break
+                i += 3
+            elif cmd == self.SB:
+                end = data.find(bytes((self.IAC, self.SE)), i)
+                if end < 0:
+                    break
+                sub = data[i + 2:end]
+                if len(sub) >= 5 and sub[0] == self.NAWS:
+                    backend.width, backend.height = sub[1] << 8 | sub[2], sub[3] << 8 | sub[4]
+                i = end + 2
             else:
-                return k or ch.decode()
+                i += 2
+        pending[0] = data[i:]
+        # telnet sends enter as \r\0 or \r\n
+        return bytes(out).replace(b"\r\0", b"\r").replace(b"\r\n", b"\r")
+
+    async def Serve(self, host: str = "127.0.0.1", port: int = 0):
+        return await asyncio.start_server(self.Connection, host, port)
+
+    async def OpenPty(self):
+        # hosts a session on a new pseudo terminal, returns the path of its slave end (attach with screen, cu, ...)
+        loop = asyncio.get_running_loop()
+        master, slave = os.openpty()
+        PosixConsole.RawMode(slave)
+        reader = asyncio.StreamReader()
+        readTransport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(master, "rb", 0))
+        writeTransport, _ = await loop.connect_write_pipe(asyncio.Protocol, os.fdopen(os.dup(master), "wb", 0))
+        backend = StreamConsole(writeTransport.write, self.width, self.height)
+        async def read():
+            try:
+                return await reader.read(65536) or None
+            except OSError:
+                return None
+        async def host():
+            try:
+                await self.Host(backend, read)
+            finally:
+                # both ends of the master are closed, so an attached client gets a hangup
+                readTransport.close()
+                writeTransport.close()
+                os.close(slave)
+        asyncio.ensure_future(host())
+        return os.ttyname(slave)
+
+    def Run(self, host: str = "127.0.0.1", port: int = 2323):
+        async def serve():
+            server = await self.Serve(host, port)
+            async with server:
+                await server.serve_forever()
+        asyncio.run(serve())
+
+Terminal.Use(WindowsConsole() if os.name == "nt" else PosixConsole())
+Session.current = Session.Capture()
+
+class Profiler:
+    phases = ("input", "keypress", "update", "flush")
+
+    def __init__(self, size: int = 1024, dump: str = None, hud: bool = False):
+        self.size = size
+        self.dump = dump
+        self.hud = hud
+        self.hudLayer: Layer = None
+        self.samples = {phase: array('d', bytes(8 * size)) for phase in self.phases + ("frame",)}
+        self.outputBytes = array('q', bytes(8 * size))
+        self.index = self.count = 0
+        self.acc = dict.fromkeys(self.phases, 0.0)
+        self.bytes = 0
+        self.stack = []
+        self.started = 0
+        self.averageTime = self.averageBytes = 0
+
+    # phases nest (a flush inside a keypress handler), each phase only accumulates its exclusive time
+    def Begin(self, phase: str):
+        now = timer()
+        if self.stack:
+            self.acc[self.stack[-1]] += now - self.started
+        self.stack.append(phase)
+        self.started = now
+
+    def End(self):
+        now = timer()
+        self.acc[self.stack.pop()] += now - self.started
+        self.started = now
+
+    def EndFrame(self):
+        acc, i = self.acc, self.index
+        total = 0
+        for phase in self.phases:
+            self.samples[phase][i] = acc[phase]
+            total += acc[phase]
+            acc[phase] = 0.0
+        self.samples["frame"][i] = total
+        self.outputBytes[i] = self.bytes
+        self.averageTime += (total - self.averageTime) * 0.1
+        self.averageBytes += (self.bytes - self.averageBytes) * 0.1
+        self.bytes = 0
+        self.index = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def Frames(self):
+        start = (self.index - self.count) % self.size
+        return [(start + i) % self.size for i in range(self.count)]
+
+    def Percentile(self, phase: str, p: float):
+        data = self.outputBytes if phase == "bytes" else self.samples[phase]
+        values = sorted(data[i] for i in self.Frames())
+        if not values:
+            return 0
+        return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+    def Stats(self, percentiles = (50, 90, 99)):
+        stats = {}
+        for phase in self.phases + ("frame", "bytes"):
+            scale = 1 if phase == "bytes" else 1000
+            data = self.outputBytes if phase == "bytes" else self.samples[phase]
+            values = sorted(data[i] for i in self.Frames()) or [0]
+            stats[phase] = {f"p{p}": values[min(int(len(values) * p / 100), len(values) - 1)] * scale for p in percentiles}
+            stats[phase]["mean"] = sum(values) / len(values) * scale
+            stats[phase]["max"] = values[-1] * scale
+        return stats
+
+    def Dump(self, path: str = None):
+        frames = [{phase: self.samples[phase][i] * 1000 for phase in self.phases + ("frame",)} | {"bytes": self.outputBytes[i]} for i in self.Frames()]
+        with open(path or self.dump, "w") as f:
+            json.dump({"stats": self.Stats(), "frames": frames}, f, indent = 1)
+
+    def DrawHUD(self, screen: Screen):
+        # an overlay on the bottom border, what it covers comes back when hud is turned off
+        if not self.hud:
+            self.HideHUD(screen)
+            return
+        text = f" {self.averageTime * 1000:.2f}ms {self.averageBytes:.0f}B "
+        layer = self.hudLayer
+        if not layer or layer.width != len(text):
+            self.HideHUD(screen)
+            layer = self.hudLayer = Layer(len(text), 1, 0, 0, 1000)
+            screen.overlays.append(layer)
+            screen.overlays.sort(key = lambda l: l.z)
+        layer.x, layer.y = screen.width - len(text) - 1, screen.height - 1
+        layer.Print(0, 0, f"\x1b[7m{text}")
+
+    def HideHUD(self, screen: Screen):
+        if self.hudLayer in screen.overlays:
+            screen.overlays.remove(self.hudLayer)
+        self.hudLayer = None
+
+class Recorder:
+    # appends timestamped output frames and input batches to a file, see Recording for the format
+    magic = b"WREC"
+    version = 2
+    OUTPUT, KEYS, SIZE = 0, 1, 2
+
+    def __init__(self, path: str, compress: bool = False):
+        self.path = path
+        self.compress = compress
+        self.file = None
+        self.compressor = None
+        self.last = 0
+
+    @staticmethod
+    def Varint(n: int):
+        out = bytearray()
+        while n >= 0x80:
+            out.append(n & 0x7f | 0x80)
+            n >>= 7
+        out.append(n)
+        return bytes(out)
+
+    def Start(self, size: tuple = None):
+        # every Start appends a new segment, so one file can collect many sessions
+        segments, end = [], 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                (segments, end) = Recording.Scan(f.read())
+        self.file = open(self.path, "ab")
+        # a session that crashed left its segment open, maybe with a torn block: it is cut there and closed
+        self.file.truncate(end)
+        if segments and not segments[-1][3]:
+            self.file.write(b"\0")
+        self.file.write(self.magic + bytes((self.version, 1 if self.compress else 0)) + struct.pack("<d", wallClock()))
+        self.compressor = zlib.compressobj() if self.compress else None
+        self.last = timer()
+        Terminal.recorder = Input.recorder = self
+        if size:
+            self.Record(self.SIZE, struct.pack("<HH", *size))
+
+    def Stop(self):
+        if Terminal.recorder is self:
+            Terminal.recorder = Input.recorder = None
+        if self.file:
+            if self.compressor:
+                self.Block(self.compressor.flush())
+            # an empty block closes the segment
+            self.file.write(b"\0")
+            self.file.close()
+            self.file = self.compressor = None
+
+    def Record(self, kind: int, payload: bytes):
+        # kind, microseconds since the previous record, length, payload
+        now = timer()
+        data = bytes((kind,)) + self.Varint(int((now - self.last) * 1e6)) + self.Varint(len(payload)) + payload
+        self.last = now
+        # every record reaches the file as it happens (a sync flush ends the compressed data on a byte boundary),
+        # so a session that crashes leaves everything up to its last frame on disk
+        self.Block(self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH) if self.compressor else data)
+        self.file.flush()
+
+    def Block(self, data: bytes):
+        # length prefixed, so the reader never looks for headers inside recorded output
+        if data:
+            self.file.write(self.Varint(len(data)) + data)
+
+    def Output(self, data: bytes):
+        # frames are recorded as written, Screen.Diff has already reduced them to the changes since the previous one
+        self.Record(self.OUTPUT, data)
+
+    def Keys(self, keys: list):
+        payload = bytearray()
+        for key in keys:
+            data = key.encode()
+            payload += bytes((type(key) == PasteEvent,)) + self.Varint(len(data)) + data
+        self.Record(self.KEYS, bytes(payload))
+
+class Recording:
+    # a file written by Recorder: segments of a header (magic, version, flags, start time) and length prefixed blocks
+    # up to an empty one, the blocks hold records of (time in seconds since the segment started, kind, data)
+    def __init__(self, path: str):
+        self.segments = []
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            (segments, _) = Recording.Scan(data)
+        except ValueError:
+            raise ValueError(f"{path} is not a recording")
+        for (start, flags, blocks, _) in segments:
+            body = b"".join(blocks)
+            if flags & 1:
+                try:
+                    body = zlib.decompressobj().decompress(body)
+                except zlib.error:
+                    body = b""
+            self.segments.append((start, Recording.Parse(body)))
+        self.records = [record for (_, records) in self.segments for record in records]
+
+    @staticmethod
+    def Varint(data: bytes, i: int):
+        n = shift = 0
+        while True:
+            b = data[i]
+            n |= (b & 0x7f) << shift
+            i += 1
+            if b < 0x80:
+                return (n, i)
+            shift += 7
+
+    @staticmethod
+    def Scan(data: bytes):
+        # returns the segments as (start, flags, blocks, closed) and where the whole blocks end,
+        # a segment a crash left open can only be the last one (see Recorder.Start), its torn block is dropped
+        segments, i = [], 0
+        while len(data) - i >= 14:
+            if data[i:i + 4] != Recorder.magic or data[i + 4] != Recorder.version:
+                raise ValueError("not a recording")
+            flags, (start,) = data[i + 5], struct.unpack("<d", data[i + 6:i + 14])
+            blocks, closed = [], False
+            i += 14
+            while i < len(data):
+                try:
+                    (n, j) = Recording.Varint(data, i)
+                except IndexError:
+                    break
+                if j + n > len(data):
+                    break
+                i = j + n
+                if n == 0:
+                    closed = True
+                    break
+                blocks.append(data[j:i])
+            segments.append((start, flags, blocks, closed))
+            if not closed:
+                break
+        return (segments, i)
+
+    @staticmethod
+    def Parse(body: bytes):
+        # a truncated last record is dropped
+        records, i, t = [], 0, 0.0
+        while i < len(body):
+            try:
+                kind = body[i]
+                (dt, i) = Recording.Varint(body, i + 1)
+                (n, i) = Recording.Varint(body, i)
+            except IndexError:
+                break
+            if i + n > len(body):
+                break
+            t += dt / 1e6
+            payload = body[i:i + n]
+            i += n
+            if kind == Recorder.KEYS:
+                payload = Recording.DecodeKeys(payload)
+            elif kind == Recorder.SIZE:
+                payload = struct.unpack("<HH", payload)
+            records.append((t, kind, payload))
+        return records
+
+    @staticmethod
+    def DecodeKeys(payload: bytes):
+        keys, i = [], 0
+        while i < len(payload):
+            paste = payload[i]
+            (n, i) = Recording.Varint(payload, i + 1)
+            key = payload[i:i + n].decode(errors = "replace")
+            keys.append(PasteEvent(key) if paste else key)
+            i += n
+        return keys
+
+    def Size(self):
+        return next((size for (_, kind, size) in self.records if kind == Recorder.SIZE), None)
+
+    def Batches(self):
+        return [keys for (_, kind, keys) in self.records if kind == Recorder.KEYS]
+
+    def Keys(self):
+        return [key for batch in self.Batches() for key in batch]
+
+    def Frames(self):
+        return [(t, data) for (t, kind, data) in self.records if kind == Recorder.OUTPUT]
+
+    def Replay(self, program: Program, state: ProgramState, *args, **kwargs):
+        # feeds the recorded input batches to the program headlessly as fast as it takes them, returns the VirtualTerminal
+        width, height = self.Size() or (program.width + 2, program.height + 2)
+        vt = VirtualTerminal(width, height, self.Keys(), batches = [len(batch) for batch in self.Batches()])
+        previous = Terminal.backend
+        Terminal.Use(vt)
+        try:
+            program.Run(state, *args, **kwargs)
+        finally:
+            Terminal.Use(previous)
+        return vt
+
+    def Play(self, backend: Backend = None, speed: float = 1.0):
+        # writes the recorded output with its original timing (speed 2 = twice as fast, 0 = no waiting)
+        backend = backend or Terminal.backend
+        start = timer()
+        for (t, data) in self.Frames():
+            if speed:
+                delay = start + t / speed - timer()
+                if delay > 0:
+                    sleep(delay)
+            backend.Write(data)
 
 class ProgramState:
     def Enter(self, prev: ProgramState, *args, **kwargs):
@@ -257,67 +2073,1374 @@ class ProgramState:
         pass
     def Keypress(self, key: str):
         pass
+    # typed characters arrive here merged into one string if a state overrides Text, otherwise one Keypress each
+    def Text(self, text: str):
+        pass
+    # content that doesn't change while the state is active, drawn once into a cached layer that Program.Clear stamps
+    def Static(self, layer: Layer):
+        pass
+    # the window changed size (see Program.Resize), the content drawn so far is kept where it still fits
+    def Resize(self, width: int, height: int):
+        pass
     def Exit(self, next: ProgramState):
         pass
 
+class Job:
+    # work submitted with Program.Submit, its result is delivered on the main loop to the state that submitted it
+    def __init__(self, future: Future, state: ProgramState, then = None, error = None):
+        self.future = future
+        self.state = state
+        self.then, self.error = then, error
+        self.cancelled = False
+
+    def Cancel(self):
+        # a job that already started can't be stopped, its result is discarded instead
+        self.cancelled = True
+        self.future.cancel()
+
+    def Done(self):
+        return self.future.done()
+
+class Timer:
+    # handle returned by Program.After and Program.Every
+    def __init__(self, program: Program, deadline: float, interval: float, callback, args: tuple, state: ProgramState):
+        self.program = program
+        self.deadline = deadline
+        self.interval = interval
+        self.callback, self.args = callback, args
+        self.state = state
+        self.cancelled = False
+
+    def __lt__(self, other: Timer):
+        return self.deadline < other.deadline
+
+    def Cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.program.cancelledTimers += 1
+            self.program.CompactTimers()
+
 class Program:
     # state machine
     currentState: ProgramState = None
     exit = False
     deltaTime: float = 0
-    def __init__(self, width: int, height: int, name: str = None, killKey = "escape"):
+    lastT = nextT = 0
+    wakeup: asyncio.Event = None
+    pollInterval = 0.005
+    # key names of characters in text that is handed to Keypress one key at a time
+    textKeys = {" ": "space", "\r": "enter", "\n": "enter", "\t": "tab"}
+    # busy indicator drawn on the top border while jobs are running
+    spinner = "|/-\\"
+    spinnerInterval = 0.1
+    def __init__(self, width: int, height: int, name: str = None, killKey = "escape", fps: float = None):
         self.width, self.height = width, height
         self.name = name
         self.killKey = killKey
+        self.fps = fps
+        self.screen = Screen(width + 2, height + 2)
+        self.profiler: Profiler = None
+        self.threaded: tuple = None
+        self.recorder: Recorder = None
+        # RunAsync: running hook tasks -> the state they belong to, the pending Keypress/Update tasks
+        self.loop: asyncio.AbstractEventLoop = None
+        self.tasks: dict[asyncio.Task, ProgramState] = {}
+        self.keyTask = self.updateTask = None
+        self.error: Exception = None
+        # Submit: running jobs, jobs whose future completed (appended by worker threads), lazily created pools
+        self.jobs: list[Job] = []
+        self.finished = deque()
+        self.pools = {}
+        self.workers: int = None
+        self.busyIndicator = True
+        self.spinnerFrame = None
+        # After/Every: heap of timers ordered by deadline, cancelled ones are dropped when they reach the top
+        self.timers: list[Timer] = []
+        self.cancelledTimers = 0
+        # input batches: at most inputLimit command keys per Step, typed text is never dropped (dropPolicy "oldest" or "newest" decides which go),
+        # runs of a repeatKeys key are cut to repeatLimit, batchRender flushes once per Step
+        self.inputLimit = 256
+        self.dropPolicy = "oldest"
+        self.repeatKeys = {"up", "down", "left", "right", "pageup", "pagedown"}
+        self.repeatLimit: int = None
+        self.batchRender = True
+        self.droppedKeys = 0
+        # pasted text arrives as one PasteEvent, terminals without bracketed paste ignore the mode
+        self.bracketedPaste = True
+        # cached layers: the border and title, the Static layer of each state; overlays are shared with the screen
+        self.background: Layer = None
+        self.backgroundKey = None
+        self.staticLayers = WeakKeyDictionary()
+        self.overlays = self.screen.overlays
+        # terminal resizes: SIGWINCH (the process' own console) or polling every sizePollInterval notices them, they are
+        # applied once the size stays put for resizeDelay, at most resizeMaxDelay after the first; resizable: the window fills the terminal
+        self.resizable = False
+        self.sizePollInterval = 0.25
+        self.resizeDelay = 0.1
+        self.resizeMaxDelay = 0.5
+        self.terminalSize: tuple = None
+        self.pendingSize = self.smallestSize = None
+        self.resizeStart = self.resizeDue = self.sizeCheckT = None
+        self.sizeChanged = self.watchingSize = False
+        self.previousSizeHandler = None
     def SwitchState(self, state: ProgramState, *args, **kwargs):
         if isinstance(state, ProgramState):
             prev = None
             if self.currentState:
-                self.currentState.Exit(state)
+                # handlers of the old state that are still waiting are cancelled, except the one switching
+                self.CancelTasks(self.currentState)
+                self.CancelJobs(self.currentState)
+                self.CancelTimers(self.currentState)
+                self.Dispatch(self.currentState.Exit(state))
                 prev = self.currentState
             self.currentState = state
-            self.currentState.Enter(prev, *args, **kwargs)
+            self.Dispatch(self.currentState.Enter(prev, *args, **kwargs), state)
         else:
             raise TypeError("All states must inherit from ProgramState")
+    def Dispatch(self, result, state: ProgramState = None):
+        # async def hooks run as tasks under RunAsync, so their awaits don't block input or rendering
+        if not asyncio.iscoroutine(result):
+            return None
+        if not self.loop:
+            result.close()
+            raise TypeError("async state hooks require Program.RunAsync")
+        task = self.loop.create_task(result)
+        self.tasks[task] = state
+        task.add_done_callback(self.TaskDone)
+        return task
+    def TaskDone(self, task: asyncio.Task):
+        self.tasks.pop(task, None)
+        if not task.cancelled() and task.exception():
+            # stop the loop and raise in RunAsync, like an exception in a synchronous hook would
+            self.error = self.error or task.exception()
+            self.Exit()
+        if task is self.keyTask:
+            self.keyTask = None
+        if task is self.updateTask:
+            self.updateTask = None
+        if self.wakeup:
+            self.wakeup.set()
+    def CancelTasks(self, state: ProgramState = None):
+        current = asyncio.current_task() if self.loop else None
+        for (task, owner) in list(self.tasks.items()):
+            if (state is None or owner is state) and task is not current:
+                task.cancel()
+    def Submit(self, fn, *args, then = None, error = None, process: bool = False, **kwargs):
+        # runs fn(*args, **kwargs) on a thread pool (or a process pool, fn and its arguments must then be picklable),
+        # then(result) or error(exception) is called on the main loop unless the state was exited before;
+        # without an error handler the exception is raised on the main loop
+        kind = "process" if process else "thread"
+        if not kind in self.pools:
+            self.pools[kind] = (ProcessPoolExecutor if process else ThreadPoolExecutor)(self.workers)
+        job = Job(self.pools[kind].submit(fn, *args, **kwargs), self.currentState, then, error)
+        self.jobs.append(job)
+        job.future.add_done_callback(lambda _: self.JobDone(job))
+        return job
+    def JobDone(self, job: Job):
+        # called from the worker thread
+        self.finished.append(job)
+        loop, wakeup = self.loop, self.wakeup
+        if loop and wakeup:
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                pass
+        else:
+            Input.device.Wake()
+    def DeliverJobs(self):
+        while self.finished:
+            job = self.finished.popleft()
+            self.jobs.remove(job)
+            if job.cancelled or job.future.cancelled():
+                continue
+            e = job.future.exception()
+            if e is None:
+                if job.then:
+                    self.Dispatch(job.then(job.future.result()), job.state)
+            elif job.error:
+                self.Dispatch(job.error(e), job.state)
+            else:
+                raise e
+    def CancelJobs(self, state: ProgramState = None):
+        for job in self.jobs:
+            if state is None or job.state is state:
+                job.Cancel()
+    def Busy(self):
+        return any(not job.cancelled for job in self.jobs)
+    def Shutdown(self):
+        self.CancelJobs()
+        for (kind, pool) in self.pools.items():
+            # a process pool left running breaks the interpreter's exit handler, so it waits for its workers
+            pool.shutdown(wait = kind == "process", cancel_futures = True)
+        self.pools.clear()
+    def DrawBusy(self):
+        busy = self.busyIndicator and self.Busy()
+        frame = int(timer() / self.spinnerInterval) % len(self.spinner) if busy else None
+        if frame != self.spinnerFrame and Terminal.screen is self.screen and self.screen.width >= 6:
+            self.spinnerFrame = frame
+            x, chars = self.screen.width - 5, self.screen.back.chars[0]
+            if busy:
+                if chars[x] == '':
+                    # the spinner cuts a wide character of the title
+                    chars[x - 1] = ' '
+                self.screen.back.PutString(x, 0, f" {self.spinner[frame]} ", Terminal.defaultPen)
+            else:
+                # the border and the title under the spinner come back from the background, whole wide characters included
+                background = self.Background().buffer
+                left, right = x - (background.chars[0][x] == ''), x + 3 + (background.chars[0][x + 3:x + 4] == [''])
+                chars[left:right] = background.chars[0][left:right]
+                self.screen.back.pens[0][left:right] = background.pens[0][left:right]
+            Terminal.Flush()
+    def Coalesce(self, keys: list):
+        if self.inputLimit and len(keys) > self.inputLimit:
+            # typed and pasted text is never dropped, only the keys that are commands count towards the limit
+            commands = [i for (i, key) in enumerate(keys) if not Program.IsText(key)]
+            if len(commands) > self.inputLimit:
+                kill = self.killKey in keys
+                dropped = set(commands[:-self.inputLimit] if self.dropPolicy == "oldest" else commands[self.inputLimit:])
+                self.droppedKeys += len(dropped)
+                keys = [key for (i, key) in enumerate(keys) if not i in dropped]
+                if kill and not self.killKey in keys:
+                    keys.append(self.killKey)
+        if self.repeatLimit:
+            out, run = [], 0
+            for key in keys:
+                run = run + 1 if out and key == out[-1] else 1
+                if run <= self.repeatLimit or not key in self.repeatKeys:
+                    out.append(key)
+                else:
+                    self.droppedKeys += 1
+            keys = out
+        if self.currentState and Program.AcceptsText(self.currentState):
+            out = []
+            for key in keys:
+                c = " " if key == "space" else key
+                # a printable kill key ends the run, Step has to see it on its own
+                if len(c) == 1 and c.isprintable() and type(key) != PasteEvent and key != self.killKey:
+                    if out and type(out[-1]) == TextEvent:
+                        out[-1] = TextEvent(out[-1] + c)
+                    else:
+                        out.append(TextEvent(c))
+                else:
+                    out.append(key)
+            keys = out
+        return keys
+    @staticmethod
+    def IsText(key: str):
+        return isinstance(key, TextEvent) or key == "space" or (len(key) == 1 and key.isprintable())
+    @staticmethod
+    def AcceptsText(state: ProgramState):
+        return type(state).Text is not ProgramState.Text
+    @staticmethod
+    def TextKeys(text: str):
+        return [Program.textKeys.get(c, c) for c in text.replace("\r\n", "\r")]
+    def After(self, delay: float, callback, *args):
+        # calls callback(*args) once after delay seconds, unless the current state is left before
+        return self.Schedule(Timer(self, timer() + delay, None, callback, args, self.currentState))
+    def Every(self, interval: float, callback, *args):
+        # calls callback(*args) every interval seconds while the current state is active
+        return self.Schedule(Timer(self, timer() + interval, interval, callback, args, self.currentState))
+    def Schedule(self, t: Timer):
+        heappush(self.timers, t)
+        if self.wakeup:
+            self.wakeup.set()
+        return t
+    def CancelTimers(self, state: ProgramState = None):
+        for t in self.timers:
+            if not t.cancelled and (state is None or t.state is state):
+                t.cancelled = True
+                self.cancelledTimers += 1
+        self.CompactTimers()
+    def CompactTimers(self):
+        # cancelled timers stay in the heap until they reach the top, unless they make up most of it
+        if self.cancelledTimers > len(self.timers) // 2:
+            self.timers = [t for t in self.timers if not t.cancelled]
+            heapify(self.timers)
+            self.cancelledTimers = 0
+    def RunTimers(self, now: float):
+        # callbacks may schedule or cancel timers, so self.timers is looked up on every iteration
+        while self.timers and (self.timers[0].cancelled or self.timers[0].deadline <= now):
+            t = heappop(self.timers)
+            if t.cancelled:
+                self.cancelledTimers -= 1
+                continue
+            if t.interval:
+                # a timer that fell behind skips the missed ticks instead of firing in a burst
+                t.deadline = t.deadline + t.interval if t.deadline + t.interval > now else now + t.interval
+                heappush(self.timers, t)
+            else:
+                t.cancelled = True
+            self.Dispatch(t.callback(*t.args), t.state)
+    def NextDeadline(self):
+        while self.timers and self.timers[0].cancelled:
+            heappop(self.timers)
+            self.cancelledTimers -= 1
+        return self.timers[0].deadline if self.timers else None
+    def Profile(self, size: int = 1024, dump: str = None, hud: bool = False):
+        self.profiler = Profiler(size, dump, hud)
+        return self.profiler
+    def Record(self, path: str, compress: bool = False):
+        # record output and input of every Run to path, see Recorder
+        self.recorder = Recorder(path, compress)
+        return self.recorder
+    def Threaded(self, depth: int = 1, sync: bool = True):
+        # write frames on a background thread, see Writer
+        self.threaded = (depth, sync)
     def Run(self, state: ProgramState, *args, **kwargs):
+        try:
+            self.Begin(state, *args, **kwargs)
+            while not self.exit:
+                # fps = None: free-running loop, fps = 0: update only on input, fps > 0: fixed update rate
+                if self.fps is not None:
+                    Input.Wait(self.Timeout())
+                self.Step()
+            self.Finish()
+        except Exception:
+            self.Abort()
+            print(format_exc())
+        finally:
+            Input.Stop()
+
+    async def RunAsync(self, state: ProgramState, *args, **kwargs):
+        # Run on an asyncio event loop: state hooks may be async def, input is watched by a loop reader
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.error = None
+        fd = None
+        try:
+            self.Begin(state, *args, **kwargs)
+            if isinstance(Input.device, PosixConsole) and Input.device.inFD is not None:
+                fd = Input.device.inFD
+                self.loop.add_reader(fd, self.wakeup.set)
+            while not self.exit:
+                if self.fps is None:
+                    await asyncio.sleep(0)
+                elif not self.Ready():
+                    timeout = self.Timeout()
+                    if fd is None:
+                        timeout = self.pollInterval if timeout is None else min(timeout, self.pollInterval)
+                    self.wakeup.clear()
+                    if not self.Ready():
+                        try:
+                            await asyncio.wait_for(self.wakeup.wait(), timeout)
+                        except asyncio.TimeoutError:
+                            pass
+                if not self.exit:
+                    self.Step()
+            self.CancelTasks()
+            if self.error:
+                raise self.error
+            self.Finish()
+            if self.tasks:
+                await asyncio.wait(list(self.tasks))
+        except Exception:
+            self.CancelTasks()
+            self.Abort()
+            print(format_exc())
+        finally:
+            if fd is not None:
+                self.loop.remove_reader(fd)
+            Input.Stop()
+            self.loop = self.wakeup = None
+
+    def Ready(self):
+        # input that Step can handle right now, keys queued behind a pending async Keypress don't count
+        return Input.device.HasKeypress() or (len(Input.queue) > 0 and not self.keyTask)
+
+    # Run split into its parts, so a host (see SessionServer) can drive the loop itself
+    def Begin(self, state: ProgramState, *args, **kwargs):
+        Input.Start()
+        if self.recorder:
+            self.recorder.Start(Terminal.Size())
+        if self.threaded:
+            Terminal.StartWriter(*self.threaded)
         Terminal.Escape("=7l")
+        if self.bracketedPaste:
+            Terminal.Escape("?2004h")
         Terminal.HideCursor()
         Terminal.Flush()
+        Terminal.Attach(self.screen)
+        self.WatchSize()
+        if self.resizable:
+            # nothing is drawn yet, the window just takes the terminal's size
+            self.width, self.height = max(self.terminalSize[0] - 2, 1), max(self.terminalSize[1] - 2, 1)
+            self.screen.Resize(self.width + 2, self.height + 2)
+            self.staticLayers.clear()
+        self.screen.Invalidate()
         self.Clear()
         self.SwitchState(state, *args, **kwargs)
-        lastT = timer()
-        try:
-            while not self.exit:
-                while Input.HasKeypress():
-                    key = Input.GetKeypress()
-                    if key == self.killKey:
-                        self.Exit()
-                    elif self.currentState:
-                        self.currentState.Keypress(key)
-                self.deltaTime = timer() - lastT
-                lastT = timer()
-                if self.currentState:
-                    self.currentState.Update(self.deltaTime)
-            if self.currentState:
-                self.currentState.Exit(None)
-            Terminal.ResetStyle()
-            Terminal.SetCursorPosition(0, self.height + 1)
-            Terminal.ShowCursor()
+        self.lastT = self.nextT = timer()
+        Terminal.profiler = self.profiler
+
+    def Timeout(self):
+        # how long the loop may wait for input before the next Step is due (None = until a key arrives)
+        now = timer()
+        timeout = max(self.nextT - now, 0) if self.fps else None
+        for deadline in (self.NextDeadline(), self.resizeDue, self.sizeCheckT):
+            if deadline is not None:
+                timeout = max(deadline - now, 0) if timeout is None else min(timeout, max(deadline - now, 0))
+        writer = Terminal.writer
+        if writer and writer.deferred:
+            timeout = Writer.retryInterval if timeout is None else min(timeout, Writer.retryInterval)
+        if self.jobs:
+            # worker threads wake the loop (see JobDone), Run only polls for them on a console that can't be woken
+            woken = self.loop or (isinstance(Input.device, PosixConsole) and Input.device.wakeFDs is not None)
+            wait = self.spinnerInterval if woken and self.busyIndicator else None if woken else self.pollInterval
+            if wait is not None:
+                timeout = wait if timeout is None else min(timeout, wait)
+        return timeout
+
+    def Step(self):
+        prof = self.profiler
+        if prof:
+            prof.Begin("input")
+        keys = Input.GetKeypresses()
+        if keys:
+            keys = self.Coalesce(keys)
+        if prof:
+            prof.End()
+        if self.batchRender:
+            Terminal.Hold()
+        i = 0
+        while i < len(keys):
+            key = keys[i]
+            if key == self.killKey:
+                self.Exit()
+                break
+            elif self.keyTask:
+                # an async Keypress is still running, the rest of the keys wait for it
+                if self.killKey in keys[i:]:
+                    self.Exit()
+                else:
+                    Input.queue.extendleft(reversed(keys[i:]))
+                break
+            elif self.currentState:
+                if isinstance(key, TextEvent) and not Program.AcceptsText(self.currentState):
+                    # pasted, or merged for a state that has been left in the meantime
+                    keys[i:i + 1] = Program.TextKeys(key)
+                    continue
+                if prof:
+                    prof.Begin("keypress")
+                handler = self.currentState.Text if isinstance(key, TextEvent) else self.currentState.Keypress
+                self.keyTask = self.Dispatch(handler(key), self.currentState)
+                if prof:
+                    prof.End()
+            i += 1
+        if self.finished:
+            self.DeliverJobs()
+        now = timer()
+        if self.timers:
+            self.RunTimers(now)
+        if self.sizeChanged or (self.sizeCheckT is not None and now >= self.sizeCheckT):
+            self.CheckSize(now)
+        if self.resizeDue is not None and now >= self.resizeDue:
+            self.ApplySize()
+        updated = not self.fps or now >= self.nextT
+        if updated:
+            if self.fps:
+                self.nextT = self.nextT + 1 / self.fps if self.nextT + 1 / self.fps > now else now + 1 / self.fps
+            # while an async Update is pending the tick is skipped, its time goes to the next deltaTime
+            if self.currentState and not self.updateTask:
+                self.deltaTime = now - self.lastT
+                self.lastT = now
+                if prof:
+                    prof.Begin("update")
+                self.updateTask = self.Dispatch(self.currentState.Update(self.deltaTime), self.currentState)
+                if prof:
+                    prof.End()
+        if self.jobs or self.spinnerFrame is not None:
+            self.DrawBusy()
+        writer = Terminal.writer
+        if writer and writer.deferred and not writer.Busy():
             Terminal.Flush()
+        if self.batchRender:
+            Terminal.Release()
+        if prof and (keys or updated):
+            prof.EndFrame()
+
+    def Finish(self):
+        self.Shutdown()
+        self.CancelTimers()
+        self.UnwatchSize()
+        if self.currentState:
+            self.Dispatch(self.currentState.Exit(None))
+        Terminal.StopWriter()
+        Terminal.Flush()
+        Terminal.profiler = None
+        if self.profiler:
+            self.profiler.HideHUD(self.screen)
+        if self.profiler and self.profiler.dump:
+            self.profiler.Dump()
+        Terminal.Detach()
+        Terminal.ResetStyle()
+        if self.bracketedPaste:
+            Terminal.Escape("?2004l")
+        Terminal.SetCursorPosition(0, self.height + 1)
+        Terminal.ShowCursor()
+        Terminal.Print(end = "\r\n")
+        Terminal.Flush()
+        if self.recorder:
+            self.recorder.Stop()
+
+    def Abort(self):
+        self.Shutdown()
+        self.CancelTimers()
+        self.UnwatchSize()
+        Terminal.Release(False)
+        Terminal.profiler = None
+        if self.profiler:
+            self.profiler.HideHUD(self.screen)
+        try:
+            Terminal.StopWriter()
         except Exception:
-            Terminal.ResetStyle()
-            Terminal.SetCursorPosition(0, self.height + 1)
-            Terminal.ShowCursor()
-            Terminal.Flush()
-            print(format_exc())
-            
+            pass
+        Terminal.Detach()
+        Terminal.EmptyBuffer()
+        Terminal.ResetStyle()
+        if self.bracketedPaste:
+            Terminal.Escape("?2004l")
+        Terminal.SetCursorPosition(0, self.height + 1)
+        Terminal.ShowCursor()
+        Terminal.Print(end = "\r\n")
+        Terminal.Flush()
+        if self.recorder:
+            self.recorder.Stop()
+
+    # resizing
+    def WatchSize(self):
+        self.terminalSize = tuple(Terminal.Size())
+        self.pendingSize = self.smallestSize = self.resizeDue = None
+        self.sizeChanged = False
+        if hasattr(signal, "SIGWINCH") and isinstance(Input.device, PosixConsole) and current_thread() is main_thread():
+            if self.loop:
+                self.loop.add_signal_handler(signal.SIGWINCH, self.SizeSignal)
+            else:
+                self.previousSizeHandler = signal.signal(signal.SIGWINCH, lambda *_: self.SizeSignal())
+            self.watchingSize = True
+        self.sizeCheckT = None if self.watchingSize or not self.sizePollInterval else timer() + self.sizePollInterval
+    def SizeSignal(self):
+        # runs in the signal handler: only flags the change and wakes the loop, Step does the rest
+        self.sizeChanged = True
+        if self.wakeup:
+            self.wakeup.set()
+        else:
+            Input.device.Wake()
+    def UnwatchSize(self):
+        if self.watchingSize:
+            if self.loop:
+                self.loop.remove_signal_handler(signal.SIGWINCH)
+            else:
+                signal.signal(signal.SIGWINCH, self.previousSizeHandler or signal.SIG_DFL)
+            self.watchingSize = False
+        self.sizeCheckT = self.resizeDue = None
+    def CheckSize(self, now: float):
+        self.sizeChanged = False
+        if not self.watchingSize and self.sizePollInterval:
+            self.sizeCheckT = now + self.sizePollInterval
+        size = tuple(Terminal.Size())
+        if size != (self.pendingSize or self.terminalSize):
+            # a storm of resizes is applied once, after the last one or resizeMaxDelay after the first
+            if self.pendingSize is None:
+                self.resizeStart, self.smallestSize = now, self.terminalSize
+            self.pendingSize = size
+            self.smallestSize = (min(self.smallestSize[0], size[0]), min(self.smallestSize[1], size[1]))
+            self.resizeDue = min(now + self.resizeDelay, self.resizeStart + self.resizeMaxDelay)
+    def ApplySize(self):
+        (columns, rows), smallest = self.pendingSize, self.smallestSize
+        self.terminalSize, self.pendingSize, self.smallestSize, self.resizeDue = self.pendingSize, None, None, None
+        # the terminal may have cut the screen off in the middle of the storm, even if it grew back since
+        self.screen.Viewport(*smallest)
+        if self.resizable:
+            self.Resize(columns - 2, rows - 2)
+        self.screen.Viewport(columns, rows)
+        Terminal.Flush()
+    def Resize(self, width: int, height: int):
+        # changes the window size keeping the back buffer: the border and the Static layer move,
+        # the state reflows the rest in ProgramState.Resize
+        width, height = max(width, 1), max(height, 1)
+        if (width, height) == (self.width, self.height):
+            return False
+        attached = Terminal.screen is self.screen
+        back = self.screen.back
+        # a Static layer that was stamped (by Clear) is stamped again at the new size
+        static = self.staticLayers.get(self.currentState) if attached and self.currentState else None
+        if attached:
+            if static:
+                static.Erase(back)
+            back.FillRect(self.width + 1, 0, 1, self.height + 2)
+            back.FillRect(0, self.height + 1, self.width + 2, 1)
+        self.width, self.height = width, height
+        self.screen.Resize(width + 2, height + 2)
+        self.staticLayers.clear()
+        if attached:
+            self.Background().Stamp(back)
+            if static:
+                self.StaticLayer(self.currentState).Stamp(back)
+        if self.currentState:
+            self.Dispatch(self.currentState.Resize(width, height), self.currentState)
+        Terminal.Flush()
+        return True
+
     def Exit(self):
         self.exit = True
     
     # graphics
+    def Background(self):
+        key = (self.name, self.width, self.height)
+        if self.background is None or self.backgroundKey != key:
+            self.background, self.backgroundKey = Layer(self.width + 2, self.height + 2), key
+            self.background.Print(0, 0, ("╔" + centerString(f" {self.name} " if self.name else "", self.width, "═") + "╗\n") + ("║" + " " * self.width + "║\n") * self.height + ("╚" + "═" * self.width + "╝"))
+            # only the border is opaque, so a resize can stamp it over what's inside
+            self.background.FillRect(1, 1, self.width, self.height)
+        return self.background
+    def StaticLayer(self, state: ProgramState):
+        if type(state).Static is ProgramState.Static:
+            return None
+        if not state in self.staticLayers:
+            layer = self.staticLayers[state] = Layer(self.width + 2, self.height + 2)
+            state.Static(layer)
+        return self.staticLayers[state]
+    def InvalidateStatic(self, state: ProgramState = None):
+        # redraw the Static layer of the state (default: the current one) the next time it's used
+        self.staticLayers.pop(state or self.currentState, None)
+    def AddOverlay(self, layer: Layer):
+        self.overlays.append(layer)
+        self.overlays.sort(key = lambda l: l.z)
+        Terminal.Flush()
+        return layer
+    def RemoveOverlay(self, layer: Layer):
+        if layer in self.overlays:
+            self.overlays.remove(layer)
+            Terminal.Flush()
+    def Toast(self, text: str, duration: float = 2.0):
+        # a boxed message over the bottom of the window, removed after duration seconds whatever the state
+        w = min(measureString(text), self.width - 2)
+        layer = Layer(w + 2, 3, (self.width + 2 - w - 2) // 2, self.height - 2, 100)
+        layer.Print(0, 0, f"┌{'─' * w}┐\n│{layoutString(text, w)}│\n└{'─' * w}┘")
+        self.Schedule(Timer(self, timer() + duration, None, self.RemoveOverlay, (layer,), None))
+        return self.AddOverlay(layer)
     def Clear(self):
+        if Terminal.screen is self.screen:
+            # stamp the cached layers instead of printing the frame again
+            self.screen.back.Fill()
+            self.Background().Stamp(self.screen.back)
+            static = self.StaticLayer(self.currentState) if self.currentState else None
+            if static:
+                static.Stamp(self.screen.back)
+            Terminal.ResetStyle()
+            Terminal.HomeCursor()
+            Terminal.Flush()
+            return
         Terminal.Clear()
         Terminal.ResetStyle()
         Terminal.HomeCursor()
         Terminal.Print(("╔" + centerString(f" {self.name} " if self.name else "", self.width, "═") + "╗\n") + ("║" + " " * self.width + "║\n") * self.height + ("╚" + "═" * self.width + "╝"), end="")
         Terminal.Flush()
+
+class Widget:
+    def __init__(self, x: int = 0, y: int = 0, width: int = 0, height: int = 1):
+        self.x, self.y, self.width, self.height = x, y, width, height
+        self.parent: Widget = None
+        self.children: list[Widget] = []
+        self.visible = True
+        # dirty: the whole widget needs repainting, dirtyRows: only these rows do, damaged: something in this subtree does
+        self.dirty = self.damaged = True
+        self.dirtyRows = set()
+
+    def Add(self, *widgets: Widget):
+        for widget in widgets:
+            widget.parent = self
+            self.children.append(widget)
+            widget.Invalidate()
+        return widgets[0] if len(widgets) == 1 else widgets
+
+    def Remove(self, widget: Widget):
+        if widget in self.children:
+            self.children.remove(widget)
+            widget.parent = None
+            self.Invalidate()
+
+    def Invalidate(self, row: int = None):
+        if row is None:
+            self.dirty = True
+        else:
+            self.dirtyRows.add(row)
+        widget = self
+        while widget and not widget.damaged:
+            widget.damaged = True
+            widget = widget.parent
+
+    def Set(self, **attrs):
+        changed = False
+        for (name, value) in attrs.items():
+            if getattr(self, name) != value:
+                setattr(self, name, value)
+                changed = True
+        if changed:
+            if self.parent and {"x", "y", "width", "height", "visible"} & attrs.keys():
+                self.parent.Invalidate()
+            self.Invalidate()
+        return changed
+
+    def Position(self):
+        x, y, widget = self.x, self.y, self.parent
+        while widget:
+            x, y, widget = x + widget.x, y + widget.y, widget.parent
+        return (x, y)
+
+    def Paint(self, screen: Screen, ox: int = 0, oy: int = 0, force: bool = False):
+        x, y = ox + self.x, oy + self.y
+        if not self.visible:
+            self.dirty = self.damaged = False
+            self.dirtyRows.clear()
+            return
+        if force or self.dirty:
+            self.Draw(screen, x, y)
+            force = True
+        elif self.dirtyRows:
+            for row in sorted(self.dirtyRows):
+                if 0 <= row < self.height:
+                    self.DrawRow(screen, x, y, row)
+        self.dirty = False
+        self.dirtyRows.clear()
+        for child in self.children:
+            if force or child.damaged:
+                child.Paint(screen, x, y, force)
+        self.damaged = False
+
+    def Draw(self, screen: Screen, x: int, y: int):
+        screen.back.FillRect(x, y, self.width, self.height)
+
+    def DrawRow(self, screen: Screen, x: int, y: int, row: int):
+        screen.back.FillRect(x, y + row, self.width, 1)
+
+    def Keypress(self, key: str):
+        return False
+
+    # typed or pasted text, widgets that don't take text as a whole get it one key at a time
+    def Insert(self, text: str):
+        return any([self.Keypress(key) for key in Program.TextKeys(text)])
+
+    @staticmethod
+    def Text(screen: Screen, x: int, y: int, text: str):
+        sx, sy, pen = screen.x, screen.y, screen.pen
+        screen.x, screen.y, screen.pen = x, y, Terminal.defaultPen
+        screen.Write(text)
+        screen.x, screen.y, screen.pen = sx, sy, pen
+
+class Box(Widget):
+    def __init__(self, x: int = 0, y: int = 0, width: int = 0, height: int = 1, title: str = None, border: bool = False):
+        super().__init__(x, y, width, height)
+        self.title = title
+        self.border = border
+
+    def Draw(self, screen: Screen, x: int, y: int):
+        screen.back.FillRect(x, y, self.width, self.height)
+        if self.border and self.width >= 2 and self.height >= 2:
+            w = self.width - 2
+            Widget.Text(screen, x, y, "┌" + centerString(f" {self.title} " if self.title else "", w, "─") + "┐")
+            for row in range(1, self.height - 1):
+                Widget.Text(screen, x, y + row, "│")
+                Widget.Text(screen, x + w + 1, y + row, "│")
+            Widget.Text(screen, x, y + self.height - 1, "└" + "─" * w + "┘")
+
+class Label(Widget):
+    def __init__(self, text: str = "", x: int = 0, y: int = 0, width: int = 0, height: int = None, align: str = "center"):
+        super().__init__(x, y, width, height or text.count('\n') + 1)
+        self.text = text
+        self.align = align
+
+    def Draw(self, screen: Screen, x: int, y: int):
+        lines = self.text.split('\n')
+        for row in range(self.height):
+            Widget.Text(screen, x, y + row, layoutString(lines[row] if row < len(lines) else "", self.width, self.align))
+
+class ListView(Widget):
+    def __init__(self, items: list = [], x: int = 0, y: int = 0, width: int = 0, height: int = None, selected: int = 0, decorator: str = None, align: str = "center", onSelect = None):
+        super().__init__(x, y, width, height or max(len(items), 1))
+        self.items = items
+        self.selected = selected
+        self.decorator = Terminal.EnableStyle('bold', gen = True) + Terminal.SetColor('yellow', gen = True) if decorator is None else decorator
+        self.align = align
+        self.onSelect = onSelect
+
+    @staticmethod
+    def ItemText(item):
+        return item if type(item) == str else getattr(item, "name", str(item))
+
+    def SetItems(self, items: list):
+        self.items = items
+        self.selected = min(self.selected, max(len(items) - 1, 0))
+        self.Invalidate()
+
+    def Select(self, index: int):
+        index = max(0, min(index, len(self.items) - 1))
+        if index != self.selected:
+            self.Invalidate(self.selected)
+            self.selected = index
+            self.Invalidate(index)
+
+    def Draw(self, screen: Screen, x: int, y: int):
+        for row in range(self.height):
+            self.DrawRow(screen, x, y, row)
+
+    def DrawRow(self, screen: Screen, x: int, y: int, row: int):
+        if row < len(self.items):
+            text = ListView.ItemText(self.items[row])
+            if row == self.selected:
+                text = f"{self.decorator}{text}{Terminal.ResetStyle(gen = True)}"
+        else:
+            text = ""
+        Widget.Text(screen, x, y + row, layoutString(text, self.width, self.align))
+
+    def Keypress(self, key: str):
+        if key == "up":
+            self.Select(self.selected - 1)
+        elif key == "down":
+            self.Select(self.selected + 1)
+        elif key == "enter" and 0 <= self.selected < len(self.items):
+            item = self.items[self.selected]
+            if self.onSelect:
+                self.onSelect(item)
+            elif hasattr(item, "Select"):
+                item.Select()
+        else:
+            return False
+        return True
+
+class VirtualList(Widget):
+    def __init__(self, items: list = None, x: int = 0, y: int = 0, width: int = 0, height: int = 1, provider = None, count = None, key = None, selected: int = 0, decorator: str = None, align: str = "center", onSelect = None, filterable: bool = True, keys = None):
+        super().__init__(x, y, width, height)
+        if items is not None:
+            provider = provider or (lambda start, stop: items[start:stop])
+            count = (lambda: len(items)) if count is None else count
+        self.provider, self.count = provider, count
+        self.key = key or ListView.ItemText
+        # keys(start, stop): the filter keys of a range without creating its items, like provider
+        self.keys = keys
+        self.decorator = Terminal.EnableStyle('bold', gen = True) + Terminal.SetColor('yellow', gen = True) if decorator is None else decorator
+        self.align = align
+        self.onSelect = onSelect
+        self.filterable = filterable
+        self.filter = ""
+        # prefix index: items sorted by lowercase key, ranges[k] = index range matching filter[:k + 1]
+        self.index = self.indexKeys = None
+        self.ranges = []
+        self.window = (0, [])
+        self.top = self.selected = 0
+        self.Select(selected)
+
+    def Refresh(self):
+        self.index = self.indexKeys = None
+        self.ranges, self.filter = [], ""
+        self.window = (0, [])
+        self.selected = min(self.selected, max(self.Size() - 1, 0))
+        self.top = min(self.top, self.selected)
+        self.Invalidate()
+
+    def Total(self):
+        return self.count() if callable(self.count) else self.count
+
+    def Size(self):
+        if self.filter:
+            lo, hi = self.ranges[-1]
+            return hi - lo
+        return self.Total()
+
+    def Rows(self):
+        return self.height - 1 if self.filter else self.height
+
+    def SourceIndex(self, i: int):
+        return self.index[self.ranges[-1][0] + i][1] if self.filter else i
+
+    def Fetch(self, start: int, stop: int):
+        if not self.filter:
+            return list(self.provider(start, stop))
+        items = []
+        for i in range(start, stop):
+            j = self.SourceIndex(i)
+            items += list(self.provider(j, j + 1))
+        return items
+
+    def Item(self, i: int):
+        top, items = self.window
+        if not top <= i < top + len(items):
+            self.window = (self.top, self.Fetch(self.top, min(self.top + self.Rows(), self.Size())))
+            top, items = self.window
+        return items[i - top] if top <= i < top + len(items) else None
+
+    def BuildIndex(self, chunk: int = 4096):
+        total, keys = self.Total(), []
+        for start in range(0, total, chunk):
+            stop = min(start + chunk, total)
+            keys += [k.lower() for k in self.keys(start, stop)] if self.keys else [self.key(item).lower() for item in self.provider(start, stop)]
+        self.index = sorted(zip(keys, range(len(keys))))
+        self.indexKeys = [k for (k, _) in self.index]
+
+    def SetFilter(self, text: str):
+        text = text.lower()
+        if text and self.index is None:
+            self.BuildIndex()
+        while len(self.ranges) > len(text) or (self.ranges and self.filter[:len(self.ranges)] != text[:len(self.ranges)]):
+            self.ranges.pop()
+        for k in range(len(self.ranges), len(text)):
+            lo, hi = self.ranges[-1] if self.ranges else (0, len(self.index))
+            prefix = text[:k + 1]
+            lo = bisect_left(self.indexKeys, prefix, lo, hi)
+            self.ranges.append((lo, bisect_left(self.indexKeys, prefix + '\U0010ffff', lo, hi)))
+        self.filter = text
+        self.window = (0, [])
+        self.top = self.selected = 0
+        self.Invalidate()
+
+    def Select(self, index: int):
+        index = max(0, min(index, self.Size() - 1))
+        rows = self.Rows()
+        if index < self.top or index >= self.top + rows:
+            self.top = index if index < self.top else index - rows + 1
+            self.selected = index
+            self.Invalidate()
+        elif index != self.selected:
+            self.Invalidate(self.selected - self.top)
+            self.selected = index
+            self.Invalidate(index - self.top)
+
+    def Draw(self, screen: Screen, x: int, y: int):
+        for row in range(self.height):
+            self.DrawRow(screen, x, y, row)
+
+    def DrawRow(self, screen: Screen, x: int, y: int, row: int):
+        if self.filter and row == self.height - 1:
+            Widget.Text(screen, x, y + row, layoutString(f"filter: {self.filter}", self.width, "left"))
+            return
+        i, text = self.top + row, ""
+        if i < self.Size():
+            text = self.key(self.Item(i))
+            if i == self.selected:
+                text = f"{self.decorator}{text}{Terminal.ResetStyle(gen = True)}"
+        Widget.Text(screen, x, y + row, layoutString(text, self.width, self.align))
+
+    def Keypress(self, key: str):
+        rows = self.Rows()
+        if key == "up":
+            self.Select(self.selected - 1)
+        elif key == "down":
+            self.Select(self.selected + 1)
+        elif key == "pageup":
+            self.Select(self.selected - rows)
+        elif key == "pagedown":
+            self.Select(self.selected + rows)
+        elif key == "home":
+            self.Select(0)
+        elif key == "end":
+            self.Select(self.Size() - 1)
+        elif key == "enter" and self.selected < self.Size():
+            item = self.Item(self.selected)
+            if self.onSelect:
+                self.onSelect(item)
+            elif hasattr(item, "Select"):
+                item.Select()
+        elif key == "backspace" and self.filter:
+            self.SetFilter(self.filter[:-1])
+        elif self.filterable and (len(key) == 1 or key == "space"):
+            self.SetFilter(self.filter + (" " if key == "space" else key))
+        else:
+            return False
+        return True
+
+class LogView(Widget):
+    def __init__(self, x: int = 0, y: int = 0, width: int = 0, height: int = 1, limit: int = 1000, align: str = "left"):
+        super().__init__(x, y, width, height)
+        self.lines = deque(maxlen = max(limit, height))
+        self.align = align
+        self.pendingScroll = 0
+
+    def Append(self, *lines: str):
+        for line in lines:
+            self.lines.extend(line.split('\n'))
+            self.pendingScroll += line.count('\n') + 1
+        self.Invalidate(self.height - 1)
+
+    def Clear(self):
+        self.lines.clear()
+        self.pendingScroll = 0
+        self.Invalidate()
+
+    def Paint(self, screen: Screen, ox: int = 0, oy: int = 0, force: bool = False):
+        # appended lines scroll the region in hardware, only the new bottom rows are drawn
+        n, self.pendingScroll = self.pendingScroll, 0
+        if n and not (force or self.dirty):
+            if n >= self.height:
+                self.dirty = True
+            else:
+                y = oy + self.y
+                x = ox + self.x
+                screen.ScrollRegion(y, y + self.height - 1, n, x, x + self.width)
+                self.dirtyRows = {row - n for row in self.dirtyRows if row >= n} | set(range(self.height - n, self.height))
+        super().Paint(screen, ox, oy, force)
+
+    def Draw(self, screen: Screen, x: int, y: int):
+        for row in range(self.height):
+            self.DrawRow(screen, x, y, row)
+
+    def DrawRow(self, screen: Screen, x: int, y: int, row: int):
+        i = len(self.lines) - self.height + row
+        Widget.Text(screen, x, y + row, layoutString(self.lines[i] if i >= 0 else "", self.width, self.align))
+
+class Field(Widget):
+    def __init__(self, name: str, value = "", x: int = 0, y: int = 0, width: int = 0, choices: list = None, encrypt = lambda v: v, decorator: str = None):
+        super().__init__(x, y, width, 1)
+        self.name = name
+        self.value = value if value or not choices else 0
+        self.choices = choices
+        self.encrypt = encrypt
+        self.focused = False
+        self.decorator = Terminal.EnableStyle('bold', gen = True) + Terminal.SetColor('yellow', gen = True) if decorator is None else decorator
+
+    def ValueText(self):
+        if self.choices:
+            return f"{'< ' if self.value > 0 else ''}{self.choices[self.value]}{' >' if self.value < len(self.choices) - 1 else ''}"
+        return self.encrypt(self.value)
+
+    def Draw(self, screen: Screen, x: int, y: int):
+        name = f"{self.decorator}{self.name}{Terminal.ResetStyle(gen = True)}" if self.focused else self.name
+        Widget.Text(screen, x, y, centerString(f"{name}: {self.ValueText()}", self.width))
+
+    def Keypress(self, key: str):
+        if self.choices:
+            if key == "left" and self.value > 0:
+                self.Set(value = self.value - 1)
+            elif key == "right" and self.value < len(self.choices) - 1:
+                self.Set(value = self.value + 1)
+            else:
+                return False
+        elif key == "backspace":
+            self.Set(value = self.value[:-1])
+        elif len(key) == 1 or key == "space":
+            self.Set(value = self.value + (" " if key == "space" else key))
+        else:
+            return False
+        return True
+
+class GapBuffer:
+    # text with a movable gap at the cursor, so edits at the cursor don't move the rest of the text
+    def __init__(self, text: str = "", gap: int = 16):
+        self.data = list(text) + [''] * gap
+        self.start, self.end = len(text), len(text) + gap
+
+    def __len__(self):
+        return len(self.data) - self.end + self.start
+
+    def __str__(self):
+        return "".join(self.data[:self.start]) + "".join(self.data[self.end:])
+
+    def __getitem__(self, i: int):
+        return self.data[i] if i < self.start else self.data[i - self.start + self.end]
+
+    @property
+    def cursor(self):
+        return self.start
+
+    def Move(self, pos: int):
+        pos = min(max(pos, 0), len(self))
+        if pos < self.start:
+            k = self.start - pos
+            self.data[self.end - k:self.end] = self.data[pos:self.start]
+            self.start, self.end = pos, self.end - k
+        elif pos > self.start:
+            k = pos - self.start
+            self.data[self.start:pos] = self.data[self.end:self.end + k]
+            self.start, self.end = pos, self.end + k
+
+    def Insert(self, text: str):
+        if len(text) > self.end - self.start:
+            grow = max(len(text), len(self.data))
+            self.data[self.end:self.end] = [''] * grow
+            self.end += grow
+        self.data[self.start:self.start + len(text)] = text
+        self.start += len(text)
+
+    def Delete(self, n: int = 1):
+        # n > 0 deletes before the cursor, n < 0 after it
+        if n > 0:
+            self.start -= min(n, self.start)
+        else:
+            self.end += min(-n, len(self.data) - self.end)
+
+    def Slice(self, a: int, b: int):
+        a, b = max(a, 0), min(b, len(self))
+        if b <= self.start:
+            return "".join(self.data[a:b])
+        if a >= self.start:
+            return "".join(self.data[a - self.start + self.end:b - self.start + self.end])
+        return "".join(self.data[a:self.start]) + "".join(self.data[self.end:b - self.start + self.end])
+
+class TextInput(Widget):
+    # single line editor: validate(text) sees the value an edit would produce and may reject it,
+    # accept(c) filters single characters before that, a paste is one edit
+    def __init__(self, name: str = "", value: str = "", x: int = 0, y: int = 0, width: int = 0, validate = None, accept = None, encrypt = None, maxLength: int = None, decorator: str = None):
+        super().__init__(x, y, width, 1)
+        self.name = name
+        self.buffer = GapBuffer(value)
+        self.validate, self.accept = validate, accept
+        self.encrypt = encrypt
+        self.maxLength = maxLength
+        self.focused = False
+        self.decorator = Terminal.EnableStyle('bold', gen = True) + Terminal.SetColor('yellow', gen = True) if decorator is None else decorator
+        self.offset = 0
+        self.cached = value
+
+    @property
+    def value(self):
+        if self.cached is None:
+            self.cached = str(self.buffer)
+        return self.cached
+
+    @property
+    def cursor(self):
+        return self.buffer.cursor
+
+    def Edit(self):
+        self.cached = None
+        self.Invalidate()
+
+    def Insert(self, text: str):
+        text = text.replace("\r\n", "\n").replace("\r", "\n").strip("\n").replace("\n", " ")
+        if self.accept:
+            text = "".join(c for c in text if self.accept(c))
+        if self.maxLength is not None:
+            text = text[:max(self.maxLength - len(self.buffer), 0)]
+        if not text:
+            return False
+        if self.validate:
+            i = self.cursor
+            if not self.validate(self.value[:i] + text + self.value[i:]):
+                return False
+        self.buffer.Insert(text)
+        self.Edit()
+        return True
+
+    def Keypress(self, key: str):
+        buffer = self.buffer
+        if key == "left" and buffer.cursor > 0:
+            buffer.Move(buffer.cursor - 1)
+        elif key == "right" and buffer.cursor < len(buffer):
+            buffer.Move(buffer.cursor + 1)
+        elif key == "home":
+            buffer.Move(0)
+        elif key == "end":
+            buffer.Move(len(buffer))
+        elif key == "backspace" and buffer.cursor > 0:
+            buffer.Delete(1)
+            self.Edit()
+        elif key == "delete" and buffer.cursor < len(buffer):
+            buffer.Delete(-1)
+            self.Edit()
+        elif len(key) == 1 or key == "space":
+            return self.Insert(" " if key == "space" else key)
+        else:
+            return False
+        self.Invalidate()
+        return True
+
+    def Draw(self, screen: Screen, x: int, y: int):
+        label = f"{self.name}: " if self.name else ""
+        area = max(self.width - measureString(label), 0)
+        name = f"{self.decorator}{label}{Terminal.ResetStyle(gen = True)}" if self.focused else label
+        if self.encrypt:
+            Widget.Text(screen, x, y, name + layoutString(self.encrypt(self.value), area, "left"))
+            return
+        # scroll horizontally so the cursor cell stays visible and no space is wasted after a deletion
+        # (walking at most an area's worth of characters from the cursor and from the offset)
+        buffer, cursor, n = self.buffer, self.cursor, len(self.buffer)
+        end = 1 if cursor == n else 0
+        used, first = end + (charWidth(buffer[cursor]) if cursor < n else 0), cursor
+        while first > 0 and used + charWidth(buffer[first - 1]) <= area:
+            first -= 1
+            used += charWidth(buffer[first])
+        offset = max(min(self.offset, cursor), first)
+        used, i = end, offset
+        while i < n and used <= area:
+            used += charWidth(buffer[i])
+            i += 1
+        while offset > 0 and used <= area and used + charWidth(buffer[offset - 1]) <= area:
+            offset -= 1
+            used += charWidth(buffer[offset])
+        self.offset = offset
+        at = buffer.Slice(cursor, cursor + 1)
+        if self.focused:
+            at = f"{Terminal.EnableStyle('invert', gen = True)}{at or ' '}{Terminal.ResetStyle(gen = True)}"
+        text = buffer.Slice(self.offset, cursor) + at + buffer.Slice(cursor + 1, cursor + 1 + area)
+        Widget.Text(screen, x, y, name + layoutString(text, area, "left"))
+
+class Form(Widget):
+    def __init__(self, fields: list[Field] = [], x: int = 0, y: int = 0, width: int = 0):
+        super().__init__(x, y, width, len(fields))
+        self.selected = 0
+        for (i, field) in enumerate(fields):
+            field.x, field.y, field.width = 0, i, field.width or width
+            self.Add(field)
+        if fields:
+            fields[0].focused = True
+
+    def Focus(self, index: int):
+        index = max(0, min(index, len(self.children) - 1))
+        if index != self.selected:
+            self.children[self.selected].Set(focused = False)
+            self.selected = index
+            self.children[index].Set(focused = True)
+
+    def Keypress(self, key: str):
+        if key == "up":
+            self.Focus(self.selected - 1)
+        elif key == "down":
+            self.Focus(self.selected + 1)
+        elif self.children:
+            return self.children[self.selected].Keypress(key)
+        else:
+            return False
+        return True
+
+class WidgetState(ProgramState):
+    def __init__(self, root: Widget = None, focus: Widget = None):
+        self.root = root or Widget()
+        self.focus = focus
+
+    def Enter(self, prev: ProgramState, *args, **kwargs):
+        self.root.Invalidate()
+        self.Render()
+
+    def Keypress(self, key: str):
+        if self.focus:
+            self.focus.Keypress(key)
+
+    def Update(self, dt: float):
+        self.Render()
+
+    def Resize(self, width: int, height: int):
+        # widgets keep their geometry, an override moves them with Set (only what changed is repainted) and calls super
+        self.Render()
+
+    def Render(self):
+        if self.root.damaged and Terminal.screen:
+            self.root.Paint(Terminal.screen)
+            Terminal.Flush()
+
+class Canvas(Widget):
+    # RGB pixels in a NumPy array, two pixels per cell drawn as ▀ with the foreground on top and background below;
+    # depth: 24 = truecolor, 8 = 256 colors, 4 = 16 colors
+    halfBlock = '▀'
+    palettes = {}
+    xterm16 = ((0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0), (0, 0, 238), (205, 0, 205), (0, 205, 205), (229, 229, 229),
+               (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0), (92, 92, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255))
+
+    def __init__(self, x: int = 0, y: int = 0, width: int = 0, height: int = 1, depth: int = 24):
+        if np is None:
+            raise ImportError("Canvas requires numpy")
+        super().__init__(x, y, width, height)
+        self.depth = depth
+        self.pixels = np.zeros((height * 2, width, 3), np.uint8)
+        self.pens = {}
+
+    @staticmethod
+    def Palette(depth: int):
+        # lookup table from 15 bit color (5 bits per channel) to the nearest palette index, built once per depth
+        if not depth in Canvas.palettes:
+            if depth == 4:
+                colors = np.array(Canvas.xterm16)
+            else:
+                levels = np.array((0, 95, 135, 175, 215, 255))
+                cube = np.stack(np.meshgrid(levels, levels, levels, indexing = "ij"), -1).reshape(-1, 3)
+                gray = np.repeat(np.arange(8, 248, 10)[:, None], 3, 1)
+                # the first 16 colors depend on the terminal's theme, only the cube and the gray ramp are used
+                colors = np.concatenate((np.zeros((16, 3), int) - 1000, cube, gray))
+            grid = (np.arange(32) << 3) + 4
+            rgb = np.stack(np.meshgrid(grid, grid, grid, indexing = "ij"), -1).reshape(-1, 3)
+            # nearest by |c|^2 - 2 rgb.c (|rgb|^2 is the same for every candidate), in chunks to bound the memory
+            norms = (colors ** 2).sum(-1)
+            Canvas.palettes[depth] = np.concatenate([(norms - 2 * chunk @ colors.T).argmin(-1) for chunk in np.split(rgb, 8)]).astype(np.int64)
+        return Canvas.palettes[depth]
+
+    def Quantize(self, rgb):
+        rgb = rgb.astype(np.int64)
+        if self.depth == 24:
+            return rgb[..., 0] << 16 | rgb[..., 1] << 8 | rgb[..., 2]
+        return Canvas.Palette(self.depth)[(rgb[..., 0] >> 3) << 10 | (rgb[..., 1] >> 3) << 5 | rgb[..., 2] >> 3]
+
+    def ColorCode(self, k: int, background: bool):
+        if self.depth == 24:
+            return f"{48 if background else 38};2;{k >> 16};{k >> 8 & 255};{k & 255}"
+        elif self.depth == 8:
+            return f"{48 if background else 38};5;{k}"
+        return str((40 if background else 30) + k if k < 8 else (100 if background else 90) + k - 8)
+
+    def Pen(self, key: int):
+        pen = self.pens.get(key)
+        if pen is None:
+            pen = self.pens[key] = (0, self.ColorCode(key >> 25, False), self.ColorCode(key >> 1 & 0xffffff, True))
+        return pen
+
+    def Cells(self):
+        # one int per cell: foreground << 25 | background << 1 | both halves equal (drawn as a space)
+        top, bottom = self.Quantize(self.pixels[0::2]), self.Quantize(self.pixels[1::2])
+        equal = top == bottom
+        return np.where(equal, bottom, top) << 25 | bottom << 1 | equal
+
+    def Spans(self):
+        # run-length groups of equal cells: rows of (start, end, key)
+        keys = self.Cells()
+        for row in keys:
+            ends = np.flatnonzero(row[1:] != row[:-1]) + 1
+            starts = [0] + ends.tolist()
+            yield list(zip(starts, ends.tolist() + [len(row)], row[starts].tolist()))
+
+    def Blit(self, screen: Screen, x: int, y: int):
+        buffer = screen.back
+        for (row, spans) in enumerate(self.Spans()):
+            if not 0 <= y + row < buffer.height:
+                continue
+            chars, pens = buffer.chars[y + row], buffer.pens[y + row]
+            for (a, b, key) in spans:
+                a, b = max(x + a, 0), min(x + b, buffer.width)
+                if a < b:
+                    chars[a:b] = [' ' if key & 1 else self.halfBlock] * (b - a)
+                    pens[a:b] = [self.Pen(key)] * (b - a)
+
+    def Render(self, x: int, y: int):
+        # the canvas as escape sequences for programs that don't use a Screen
+        out = []
+        for (row, spans) in enumerate(self.Spans()):
+            out.append(f"\x1b[{y + row + 1};{x + 1}H")
+            for (a, b, key) in spans:
+                (_, fg, bg) = self.Pen(key)
+                out.append(f"\x1b[0;{fg};{bg}m" + (' ' if key & 1 else self.halfBlock) * (b - a))
+        out.append("\x1b[0m")
+        return "".join(out)
+
+    def Draw(self, screen: Screen, x: int, y: int):
+        self.Blit(screen, x, y)
+
+    def Clear(self, color: tuple = (0, 0, 0)):
+        self.pixels[:] = color
+        self.Invalidate()
+
+    def Fill(self, x: int, y: int, width: int, height: int, color: tuple):
+        self.pixels[max(y, 0):max(y + height, 0), max(x, 0):max(x + width, 0)] = color
+        self.Invalidate()
+
+    def Sparkline(self, values, color: tuple, background: tuple = (0, 0, 0), low: float = None, high: float = None):
+        # one column per value (the last width values), bars scaled between low and high
+        values = np.asarray(values, float).ravel()
+        values = values[max(len(values) - self.width, 0):]
+        if not len(values):
+            self.Clear(background)
+            return
+        low = values.min() if low is None else low
+        high = values.max() if high is None else high
+        h = self.pixels.shape[0]
+        bars = np.zeros(self.width, int)
+        bars[self.width - len(values):] = np.rint((values - low) / ((high - low) or 1) * h).clip(0, h)
+        filled = np.arange(h)[::-1, None] < bars[None, :]
+        self.pixels[:] = background
+        self.pixels[filled] = color
+        self.Invalidate()